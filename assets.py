@@ -0,0 +1,74 @@
+import json
+import os
+from collections import namedtuple
+
+# label is the coin picker's button text; pool holds pre-derived deposit addresses (see deposits.py).
+CoinAsset = namedtuple("CoinAsset", "symbol label decimals price_id wallet pool")
+# decimals: 2 for pence and cents, 0 for yen.
+Fiat = namedtuple("Fiat", "code symbol decimals")
+
+# Used when ASSETS_FILE is not set; a file has the same shape.
+DEFAULT_ASSETS = {
+    "default_fiat": "GBP",
+    "fiats": {
+        "GBP": {"symbol": "£", "decimals": 2},
+    },
+    # decimals are the smallest on-chain unit: satoshi, wei, litoshi, lamport. price_id is CoinGecko's.
+    "coins": {
+        "BTC": {"decimals": 8, "price_id": "bitcoin"},
+        "ETH": {"decimals": 18, "price_id": "ethereum"},
+        "LTC": {"decimals": 8, "price_id": "litecoin"},
+        "SOL": {"decimals": 9, "price_id": "solana"},
+    },
+}
+
+
+class AssetRegistry:
+    """Every coin and fiat currency the bot trades, loaded once at startup.
+
+    Lookup tables the hot paths need (decimals, price ids, wallets, the coin
+    picker's buttons) are built here once, so adding an asset is a config
+    change. A coin's wallet and address pool come from ``<COIN>_WALLET`` and
+    ``<COIN>_ADDRESS_POOL`` when set, otherwise from the file. A coin with
+    open trades must stay listed, or their rows no longer load.
+    """
+
+    def __init__(self, coins, fiats, default_fiat=None):
+        self.coins = {coin.symbol: coin for coin in coins}
+        self.fiats = {fiat.code: fiat for fiat in fiats}
+        if not self.coins or not self.fiats:
+            raise ValueError("the asset registry needs at least one coin and one fiat currency")
+        self.default_fiat = self.fiats[default_fiat.upper()] if default_fiat else next(iter(self.fiats.values()))
+        self.coin_decimals = {symbol: coin.decimals for symbol, coin in self.coins.items()}
+        self.fiat_decimals = {code: fiat.decimals for code, fiat in self.fiats.items()}
+        self.price_ids = {symbol: coin.price_id for symbol, coin in self.coins.items()}
+        self.wallets = {symbol: coin.wallet for symbol, coin in self.coins.items()}
+        self.pools = {symbol: list(coin.pool) for symbol, coin in self.coins.items()}
+        # Coin picker items; escrow_buttons only adds the keyboard version.
+        self.coin_buttons = tuple((coin.label, f"crypto_{symbol}") for symbol, coin in self.coins.items())
+
+    def fiat(self, code=None):
+        """The currency for ``code`` in any case, the default one for None; KeyError if not listed."""
+        return self.default_fiat if code is None else self.fiats[code.upper()]
+
+    @classmethod
+    def load(cls, path=None, environ=os.environ):
+        config = DEFAULT_ASSETS
+        if path:
+            with open(path) as f:
+                config = json.load(f)
+        coins = []
+        for symbol, spec in config["coins"].items():
+            symbol = symbol.upper()
+            pool = environ.get(f"{symbol}_ADDRESS_POOL")
+            pool = [address for address in pool.split(",") if address] if pool else spec.get("pool", [])
+            coins.append(CoinAsset(
+                symbol, spec.get("label", symbol), int(spec["decimals"]), spec["price_id"],
+                environ.get(f"{symbol}_WALLET") or spec.get("wallet"), tuple(pool),
+            ))
+        fiats = [Fiat(code.upper(), spec.get("symbol", code.upper()), int(spec.get("decimals", 2)))
+                 for code, spec in config["fiats"].items()]
+        return cls(coins, fiats, config.get("default_fiat"))
+
+
+ASSETS = AssetRegistry.load(os.environ.get("ASSETS_FILE"))  # JSON file replacing DEFAULT_ASSETS
@@ -0,0 +1,524 @@
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import namedtuple
+
+from escrow import Escrow, Status
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"K1AUDIT1"  # first bytes of every segment
+INDEX_MAGIC = b"K1AIDX01"  # first bytes of a sealed segment's index file
+FRAME = struct.Struct("<II")  # body length, crc32 of the body
+HEAD = struct.Struct("<dB")  # event time, ticket length
+CLOSED = frozenset({Status.COMPLETED.value, Status.CANCELLED.value})
+
+# Value tags of the row encoding; rows hold only what Escrow.to_row() produces.
+NONE, FALSE, TRUE, INT, FLOAT, TEXT, INTS = range(7)
+DOUBLE = struct.Struct("<d")
+
+Event = namedtuple("Event", "at ticket action role row")  # row: Escrow.to_row() as it stood after the event
+
+
+def _varint(out, n):
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    n = data[pos]
+    if n < 0x80:
+        return n, pos + 1
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _text(out, text):
+    encoded = text.encode()
+    _varint(out, len(encoded))
+    out += encoded
+
+
+def _read_text(data, pos):
+    length, pos = _read_varint(data, pos)
+    return str(data[pos:pos + length], "utf-8"), pos + length
+
+
+def _value(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True or value is False:
+        out.append(TRUE if value else FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        _varint(out, _zigzag(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(TEXT)
+        _text(out, value)
+    else:  # keyboard message ids
+        out.append(INTS)
+        _varint(out, len(value))
+        for n in value:
+            _varint(out, _zigzag(n))
+
+
+def _read_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == INT:
+        n, pos = _read_varint(data, pos)
+        return _unzigzag(n), pos
+    if tag == TEXT:
+        return _read_text(data, pos)
+    if tag == FLOAT:
+        return DOUBLE.unpack_from(data, pos)[0], pos + DOUBLE.size
+    if tag == INTS:
+        count, pos = _read_varint(data, pos)
+        values = []
+        for _ in range(count):
+            n, pos = _read_varint(data, pos)
+            values.append(_unzigzag(n))
+        return values, pos
+    return (None, False, True)[tag], pos
+
+
+def encode(at, ticket, action, role, row, previous=None):
+    """One event body: header, then only the row fields that differ from ``previous`` (all of them without one)."""
+    ticket = ticket.encode()
+    out = bytearray(HEAD.pack(at, len(ticket)))
+    out += ticket
+    _text(out, action)
+    _text(out, role)
+    if previous is None:
+        changed = range(len(row))
+    else:
+        changed = [i for i, value in enumerate(row) if i >= len(previous) or previous[i] != value]
+    mask = 0
+    for i in changed:
+        mask |= 1 << i
+    _varint(out, mask)
+    for i in changed:
+        _value(out, row[i])
+    return out
+
+
+def decode(body, rows):
+    """Decode an event body, applying its fields to the ticket's row in ``rows`` (ticket -> row) and updating it."""
+    at, length = HEAD.unpack_from(body)
+    pos = HEAD.size + length
+    ticket = str(body[HEAD.size:pos], "utf-8")
+    action, pos = _read_text(body, pos)
+    role, pos = _read_text(body, pos)
+    mask, pos = _read_varint(body, pos)
+    previous = rows.get(ticket)
+    row = list(previous) if previous is not None else []
+    if len(row) < mask.bit_length():
+        row.extend([None] * (mask.bit_length() - len(row)))
+    while mask:
+        low = mask & -mask  # fields in position order, set bits only
+        row[low.bit_length() - 1], pos = _read_value(body, pos)
+        mask ^= low
+    rows[ticket] = row
+    return Event(at, ticket, action, role, row)
+
+
+def _little(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def encode_index(size, positions):
+    """A sealed segment's index: its length, its tickets, and each one's packed positions as little-endian arrays."""
+    body = bytearray()
+    _varint(body, size)
+    _text(body, "\n".join(positions))
+    body += _little(array("I", map(len, positions.values()))).tobytes()
+    for packed in positions.values():
+        body += _little(array("Q", packed)).tobytes()
+    return INDEX_MAGIC + FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_index(data):
+    """(segment length, ticket -> packed positions) from an index file, or None if it is torn or corrupt."""
+    start = len(INDEX_MAGIC) + FRAME.size
+    if not data.startswith(INDEX_MAGIC) or len(data) < start:
+        return None
+    length, crc = FRAME.unpack_from(data, len(INDEX_MAGIC))
+    body = memoryview(data)[start:]
+    if len(body) != length or zlib.crc32(body) != crc:
+        return None
+    size, pos = _read_varint(body, 0)
+    tickets, pos = _read_text(body, pos)
+    tickets = tickets.split("\n") if tickets else []
+    counts = array("I")
+    counts.frombytes(body[pos:pos + 4 * len(tickets)])
+    packed = array("Q")
+    packed.frombytes(body[pos + 4 * len(tickets):])
+    _little(counts)
+    _little(packed)
+    positions = {}
+    at = 0
+    for ticket, count in zip(tickets, counts):
+        positions[ticket] = packed[at:at + count]
+        at += count
+    return size, positions
+
+
+def frames(data, pos=len(MAGIC)):
+    """(offset, body) for each intact frame of a segment, stopping at the first torn or corrupt one."""
+    end = len(data)
+    while pos + FRAME.size <= end:
+        length, crc = FRAME.unpack_from(data, pos)
+        start = pos + FRAME.size
+        body = data[start:start + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        yield pos, body
+        pos = start + length
+
+
+class NoAuditLog:
+    """Audit log that records nothing; ``/ticket`` then shows open escrows only."""
+
+    stats = {}
+
+    def __len__(self):
+        return 0
+
+    def record(self, escrow, action, role):
+        pass
+
+    async def history(self, ticket):
+        return []
+
+    def replay(self):
+        return iter(())
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class AuditLog:
+    """Every escrow event in append-only segment files, indexed by ticket.
+
+    ``record`` encodes the event on the spot: time, ticket, action, role and
+    the escrow's ``to_row()`` fields that changed since the ticket's previous
+    event, each tagged and varint-packed. A ticket's first event in each
+    segment carries the whole row, so any segment replays on its own.
+    Frames are length- and crc32-prefixed. Writes are group-committed like
+    SQLiteStore: frames collect in memory and are written and fsynced off
+    the event loop shortly afterwards, or once ``batch_bytes`` are waiting.
+    The log moves to a new segment after ``segment_bytes``.
+
+    The ticket index (ticket -> packed segment/offset of each event) is
+    held in memory. Once a segment is full and written, its part of the
+    index goes to a ``.idx`` file beside it, so opening the log reads those
+    and scans only the open segment, truncating a frame torn by a crash. A
+    sealed segment without a valid index is scanned and its index written.
+    ``history`` reads one ticket's events straight from the offsets;
+    ``replay`` streams every event for rebuilding state.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 2**20, batch_bytes=256 * 2**10, flush_interval=0.05,
+                 clock=time.time):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.stats = {"events": 0, "bytes": 0, "fsyncs": 0, "failed": 0}
+        self._index = {}  # ticket -> array("Q") of segment << 32 | offset, oldest first
+        self._last = {}  # ticket -> row of its latest event in the current segment
+        self._open = {}  # ticket -> array("Q") of its positions in the current segment, as in _index
+        self._seals = []  # (segment, size, positions) of full segments whose index is still to be written
+        self._chunks = []  # [segment, bytearray] awaiting write, in order
+        self._pending = 0  # bytes in _chunks
+        self._file = None
+        self._file_segment = None
+        self._flush_lock = asyncio.Lock()
+        self._timer = None
+        os.makedirs(directory, exist_ok=True)
+        self._segment, self._size = self._scan()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.log")
+
+    def _index_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.idx")
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def _scan(self):
+        segments = self.segments()
+        size = None  # end of the last segment's intact events; None if it cannot be appended to
+        for segment in segments:
+            last = segment == segments[-1]
+            if not last and self._load_index(segment):
+                continue
+            size, positions = self._scan_segment(segment)
+            self._add(positions)
+            if size is not None and (not last or size >= self.segment_bytes):
+                self._write_index(segment, size, positions)  # sealed before its index was written
+            elif last:
+                self._open = positions
+        if size is None or size >= self.segment_bytes:
+            self._open = {}
+            return self._start_segment(segments[-1] + 1 if segments else 1)
+        return segments[-1], size
+
+    def _load_index(self, segment):
+        try:
+            with open(self._index_path(segment), "rb") as f:
+                loaded = decode_index(f.read())
+        except FileNotFoundError:
+            return False
+        if loaded is None or loaded[0] != os.path.getsize(self._path(segment)):
+            logger.warning("Audit index %s is damaged or stale; rescanning", self._index_path(segment))
+            return False
+        self._add(loaded[1])
+        return True
+
+    def _scan_segment(self, segment):
+        """(end of the intact events or None without a header, ticket -> positions); truncates a torn tail."""
+        with open(self._path(segment), "rb") as f:
+            data = f.read()
+        positions = {}
+        if not data.startswith(MAGIC):
+            logger.error("Audit segment %s has no header; skipped", self._path(segment))
+            return None, positions
+        size = len(MAGIC)
+        base = segment << 32
+        for offset, body in frames(data):
+            ticket = str(body[HEAD.size:HEAD.size + body[HEAD.size - 1]], "utf-8")
+            packed = positions.get(ticket)
+            if packed is None:
+                packed = positions[ticket] = array("Q")
+            packed.append(base | offset)
+            size = offset + FRAME.size + len(body)
+        if size < len(data):
+            logger.warning("Audit segment %s: dropping %d bytes after the last intact event",
+                           self._path(segment), len(data) - size)
+            with open(self._path(segment), "r+b") as f:
+                f.truncate(size)
+        return size, positions
+
+    def _add(self, positions):
+        index = self._index
+        for ticket, packed in positions.items():
+            known = index.get(ticket)
+            if known is None:
+                index[ticket] = packed[:]  # a copy: the open segment keeps appending to its own
+            else:
+                known.extend(packed)
+
+    def _start_segment(self, segment):
+        self._chunks.append([segment, bytearray(MAGIC)])
+        self._pending += len(MAGIC)
+        self._last.clear()  # every ticket starts the new segment with a full row
+        return segment, len(MAGIC)
+
+    def record(self, escrow, action, role):
+        if self._size >= self.segment_bytes:
+            # The full segment's index is written after its last events, see _write.
+            self._seals.append((self._segment, self._size, self._open))
+            self._open = {}
+            self._segment, self._size = self._start_segment(self._segment + 1)
+        ticket = escrow.ticket
+        row = escrow.to_row()
+        body = encode(self.clock(), ticket, action, role, row, self._last.get(ticket))
+        chunk = self._chunks[-1] if self._chunks and self._chunks[-1][0] == self._segment else None
+        if chunk is None:
+            chunk = [self._segment, bytearray()]
+            self._chunks.append(chunk)
+        chunk[1] += FRAME.pack(len(body), zlib.crc32(body))
+        chunk[1] += body
+        positions = self._index.get(ticket)
+        if positions is None:
+            positions = self._index[ticket] = array("Q")
+        positions.append(self._segment << 32 | self._size)
+        packed = self._open.get(ticket)
+        if packed is None:
+            packed = self._open[ticket] = array("Q")
+        packed.append(self._segment << 32 | self._size)
+        size = FRAME.size + len(body)
+        self._size += size
+        self._pending += size
+        if row[4] in CLOSED:
+            self._last.pop(ticket, None)  # nothing follows a closed escrow but a new segment's keyframe
+        else:
+            self._last[ticket] = row
+        self.stats["events"] += 1
+        self.stats["bytes"] += size
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no loop (scripts): the next flush() picks it up
+        if self._pending >= self.batch_bytes:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._chunks:
+                return
+            chunks, self._chunks, self._pending = self._chunks, [], 0
+            seals, self._seals = self._seals, []
+            try:
+                await asyncio.to_thread(self._write, chunks, seals)
+            except OSError:
+                self.stats["failed"] += 1
+                logger.exception("Writing %d audit bytes failed; will retry", sum(len(data) for _, data in chunks))
+                self._chunks[:0] = chunks
+                self._seals[:0] = seals
+                self._pending += sum(len(data) for _, data in chunks)
+                self._schedule()
+
+    def _write(self, chunks, seals=()):
+        # One write and one fsync per segment touched, however many events the batch holds.
+        # Sealed segments' indexes follow: every chunk of a sealed segment was queued before its seal.
+        while chunks:
+            segment, data = chunks[0]
+            if self._file_segment != segment:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(self._path(segment), "ab")
+                self._file_segment = segment
+                if not self._file.tell():
+                    self._sync_directory()
+            start = self._file.tell()
+            try:
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError:
+                self._file.truncate(start)  # the retry rewrites the whole chunk at the offsets already indexed
+                raise
+            self.stats["fsyncs"] += 1
+            chunks.pop(0)
+        while seals:
+            self._write_index(*seals[0])
+            seals.pop(0)
+
+    def _write_index(self, segment, size, positions):
+        path = self._index_path(segment)
+        with open(path + ".tmp", "wb") as f:
+            f.write(encode_index(size, positions))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    async def history(self, ticket):
+        """Every event of ``ticket``, oldest first."""
+        positions = self._index.get(ticket)
+        if not positions:
+            return []
+        await self.flush()
+        return await asyncio.to_thread(self._read, array("Q", positions))
+
+    def _read(self, positions):
+        events = []
+        rows = {}
+        f = None
+        segment = None
+        try:
+            for position in positions:
+                if position >> 32 != segment:
+                    if f is not None:
+                        f.close()
+                    segment = position >> 32
+                    f = open(self._path(segment), "rb")
+                f.seek(position & 0xFFFFFFFF)
+                length, crc = FRAME.unpack(f.read(FRAME.size))
+                events.append(decode(f.read(length), rows))
+        finally:
+            if f is not None:
+                f.close()
+        return events
+
+    def replay(self):
+        """Every event written so far, in order, each with the escrow row as it stood after it."""
+        for segment in self.segments():
+            with open(self._path(segment), "rb") as f:
+                data = f.read()
+            rows = {}
+            for _, body in frames(data):
+                yield decode(body, rows)
+
+    def rebuild(self):
+        """ticket -> Escrow as of its latest event, for every escrow in the log."""
+        rows = {}
+        for event in self.replay():
+            rows[event.ticket] = event.row
+        return {ticket: Escrow.from_row(row) for ticket, row in rows.items()}
+
+    async def close(self):
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_segment = None
+
+
+def main(argv):
+    # python audit.py <directory> [ticket]: one ticket's history, or a summary of the whole log.
+    log = AuditLog(argv[1])
+    if len(argv) > 2:
+        for event in asyncio.run(log.history(argv[2].upper())):
+            escrow = Escrow.from_row(event.row)
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(event.at))}  {event.action:<20} "
+                  f"{event.role:<7} -> {escrow.status.value}")
+        return
+    escrows = log.rebuild()
+    print(f"{len(escrows):,} escrows, {sum(e.status.value not in CLOSED for e in escrows.values()):,} open")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,170 @@
+"""AuditLog append, lookup and replay throughput.
+
+    python benchmarks/bench_audit.py [trades]
+
+Plays trades through the usual lifecycle (create, join, coin, amount,
+payment, release, some cancelled or disputed), many open at once,
+recording every transition as bot.advance does. Appends are timed with the
+default group commit and with an fsync per event. Bytes per event are
+compared with the JSON row SQLiteStore writes. Then times reopening,
+which loads the sealed segments' index files and scans only the open
+segment, against a copy without index files, which scans every segment
+(and writes the missing indexes); both must index the same events. Then
+times /ticket-style history lookups and a full replay. Checks that the
+rebuilt state of every escrow equals the live one.
+"""
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from audit import AuditLog  # noqa: E402
+from escrow import Coin, Escrow, Status  # noqa: E402
+
+OPEN_AT_ONCE = 2_000
+STEPS = (
+    ("both_joined", "system", Status.CRYPTO_SELECTION),
+    ("select_crypto", "buyer", Status.AWAITING_AMOUNT),
+    ("set_amount", "buyer", Status.AWAITING_PAYMENT),
+    ("buyer_paid", "buyer", Status.AWAITING_ADMIN_CONFIRMATION),
+    ("payment_received", "admin", Status.PAYMENT_CONFIRMED),
+    ("seller_sent_goods", "seller", Status.AWAITING_BUYER_ACTION),
+    ("buyer_release_funds", "buyer", Status.AWAITING_SELLER_WALLET),
+    ("set_wallet", "seller", Status.AWAITING_ADMIN_RELEASE),
+    ("admin_sent", "admin", Status.COMPLETED),
+)
+
+
+def transitions(trades, rng):
+    """(escrow, action, role) in an interleaved order, mutating each escrow as its handlers would."""
+    live = {}
+    started = 0
+    while started < trades or live:
+        if started < trades and len(live) < OPEN_AT_ONCE:
+            escrow = Escrow(-started, f"{started:08X}", status_since=time.time(), keyboards=[1])
+            live[escrow.ticket] = [escrow, 0]
+            started += 1
+            yield escrow, "create", "anyone"
+            escrow.buyer_id, escrow.seller_id = 10 * started + 1, 10 * started + 2
+            yield escrow, "join_buyer", "anyone"
+            yield escrow, "join_seller", "anyone"
+            continue
+        ticket = next(iter(live))  # round robin over the open trades
+        escrow, step = entry = live.pop(ticket)
+        action, role, status = STEPS[step]
+        roll = rng.random()
+        if step in (1, 2) and roll < 0.05:
+            action, role, status = "cancel_escrow", "anyone", Status.CANCELLED
+        elif step >= 3 and roll < 0.02:
+            action, role, status = "dispute", "buyer", Status.DISPUTED
+            escrow.disputed = True
+        escrow.status = status
+        escrow.status_since = time.time()
+        escrow.keyboard_version += 1
+        escrow.keyboards = [escrow.keyboards[-1] + 1]
+        if action == "select_crypto":
+            escrow.crypto = rng.choice(list(Coin))
+        elif action == "set_amount":
+            escrow.fiat_amount = Decimal(rng.randint(1_000, 500_000)).scaleb(-2)
+            escrow.crypto_amount = (escrow.fiat_amount / 40_000).quantize(Decimal("1e-8"))
+            escrow.quoted_at = time.time()
+        elif action == "payment_received":
+            escrow.buyer_confirmed = True
+        elif action == "set_wallet":
+            escrow.wallet_address = f"bc1q{rng.getrandbits(160):040x}"
+        entry[1] += 1
+        if status not in (Status.COMPLETED, Status.CANCELLED, Status.DISPUTED):
+            live[ticket] = entry
+        yield escrow, action, role
+
+
+async def append(directory, trades, limit=None, eager=False):
+    """Record a seeded run of transitions; returns the log, seconds spent, and the escrows by ticket."""
+    log = AuditLog(directory)
+    escrows = {}
+    start = time.perf_counter()
+    for escrow, action, role in itertools.islice(transitions(trades, random.Random(7)), limit):
+        log.record(escrow, action, role)
+        escrows[escrow.ticket] = escrow
+        if eager:
+            await log.flush()
+        await asyncio.sleep(0)  # the flush timer and the write thread run as they would between updates
+    await log.close()
+    return log, time.perf_counter() - start, escrows
+
+
+async def generate(trades):
+    # The same run without recording: what append() spends outside the log.
+    start = time.perf_counter()
+    events = 0
+    for _ in transitions(trades, random.Random(7)):
+        events += 1
+        await asyncio.sleep(0)
+    return events, time.perf_counter() - start
+
+
+async def main():
+    trades = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as root:
+        sample = list(itertools.islice(transitions(trades, random.Random(7)), 20_000))
+        rows = sum(len(escrow.dumps()) for escrow, _, _ in sample) / len(sample)
+        events, overhead = await generate(trades)
+
+        log, elapsed, escrows = await append(os.path.join(root, "grouped"), trades)
+        final = {ticket: escrow.dumps() for ticket, escrow in escrows.items()}
+        elapsed -= overhead
+        size = sum(os.path.getsize(os.path.join(log.directory, name)) for name in os.listdir(log.directory)
+                   if name.endswith(".log"))
+        print(f"{events:,} events for {trades:,} trades ({OPEN_AT_ONCE:,} open at a time)")
+        print(f"  append, group commit: {events / elapsed:>9,.0f} events/s, {log.stats['fsyncs']:,} fsyncs, "
+              f"{size / events:.1f} bytes/event (JSON row: {rows:.0f}), {len(log.segments())} segments")
+
+        eager, eager_elapsed, _ = await append(os.path.join(root, "eager"), trades, 2_000, eager=True)
+        print(f"  append, fsync each:   {2_000 / eager_elapsed:>9,.0f} events/s, {eager.stats['fsyncs']:,} fsyncs")
+
+        await log.close()
+        unindexed = shutil.copytree(log.directory, os.path.join(root, "unindexed"),
+                                    ignore=shutil.ignore_patterns("*.idx"))
+        start = time.perf_counter()
+        reopened = AuditLog(log.directory)
+        opened = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = AuditLog(unindexed)
+        rescanned = time.perf_counter() - start
+        assert scanned._index == reopened._index, "segment indexes disagree with a scan"
+        assert len(scanned.segments()) == sum(name.endswith(".idx") for name in os.listdir(unindexed)) + 1
+        print(f"  reopen + index {len(reopened):,} tickets: {opened * 1e3:.0f} ms "
+              f"(scanning every segment instead: {rescanned * 1e3:.0f} ms)")
+
+        rng = random.Random(3)
+        tickets = rng.sample(sorted(final), min(1_000, len(final)))
+        start = time.perf_counter()
+        for ticket in tickets:
+            history = await reopened.history(ticket)
+            assert history[0].action == "create" and Escrow.from_row(history[-1].row).dumps() == final[ticket]
+        looked_up = (time.perf_counter() - start) / len(tickets)
+        print(f"  history lookup: {looked_up * 1e6:.0f} us per ticket")
+
+        start = time.perf_counter()
+        replayed = sum(1 for _ in reopened.replay())
+        elapsed = time.perf_counter() - start
+        print(f"  replay: {replayed / elapsed:,.0f} events/s ({elapsed:.2f} s)")
+        start = time.perf_counter()
+        rebuilt = reopened.rebuild()
+        elapsed = time.perf_counter() - start
+        assert replayed == events and len(rebuilt) == len(final)
+        assert all(escrow.dumps() == final[ticket] for ticket, escrow in rebuilt.items())
+        print(f"  rebuild {len(rebuilt):,} escrows: {elapsed:.2f} s; every escrow matches its live state")
+        await scanned.close()
+        await reopened.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""Memory and access cost of 100k live escrows: dict records vs. the slotted Escrow.
+
+    python benchmarks/bench_escrow.py [escrows]
+
+Reports the heap used by the records, the time to create them, the time
+for a read-modify-write pass like a handler performs, and the size and
+speed of their serialized forms for the store (JSON) and for IPC (pickle).
+"""
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrow import Coin, Escrow, Status  # noqa: E402
+
+FEE_RATE = Decimal("0.05")
+
+
+def make_dict(chat_id, ticket):
+    # The record bot.py built before Escrow existed.
+    return {
+        "group_id": chat_id, "buyer_id": chat_id * 2, "seller_id": chat_id * 2 + 1,
+        "status": "awaiting_payment", "crypto": "BTC", "fiat_amount": 100.0, "crypto_amount": 0.0015,
+        "wallet_address": None, "ticket": ticket, "buyer_confirmed": False, "seller_confirmed": False,
+        "goods_sent": False, "goods_received": False, "disputed": False, "keyboards": [1234], "keyboard_version": 0,
+    }
+
+
+def make_escrow(chat_id, ticket):
+    return Escrow(chat_id, ticket, buyer_id=chat_id * 2, seller_id=chat_id * 2 + 1,
+                  status=Status.AWAITING_PAYMENT, crypto=Coin.BTC, fiat_amount=Decimal("100"),
+                  crypto_amount=Decimal("0.0015"), keyboards=[1234])
+
+
+def touch_dict(e):
+    if e["status"] == "awaiting_payment" and e["buyer_id"]:
+        e["buyer_confirmed"] = True
+        e["keyboards"].append(e["keyboards"][-1] + 1)
+    return e.get("fiat_amount", 0) * 0.05
+
+
+def touch_escrow(e):
+    if e.status is Status.AWAITING_PAYMENT and e.buyer_id:
+        e.buyer_confirmed = True
+        e.keyboards.append(e.keyboards[-1] + 1)
+    return e.fiat_amount * FEE_RATE
+
+
+def measure(label, make, touch, dumps, n):
+    tickets = [str(uuid4())[:8].upper() for _ in range(n)]
+    tracemalloc.start()
+    records = [make(-chat_id, ticket) for chat_id, ticket in enumerate(tickets, 1)]
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+
+    start = time.perf_counter()
+    records = [make(-chat_id, ticket) for chat_id, ticket in enumerate(tickets, 1)]
+    created = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for record in records:
+        touch(record)
+    touched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = [dumps(record) for record in records]
+    serialized = time.perf_counter() - start
+    json_bytes = sum(map(len, encoded)) / n
+    pickle_bytes = sum(len(pickle.dumps(record)) for record in records[:1000]) / min(n, 1000)
+
+    print(f"{label:>8}: {heap / n:6.0f} B/escrow ({heap / 2**20:6.1f} MiB), create {created / n * 1e9:5.0f} ns, "
+          f"read-modify-write {touched / n * 1e9:4.0f} ns, json {serialized / n * 1e9:5.0f} ns / {json_bytes:3.0f} B, "
+          f"pickle {pickle_bytes:3.0f} B")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"{n:,} live escrows")
+    measure("dict", make_dict, touch_dict, json.dumps, n)
+    measure("Escrow", make_escrow, touch_escrow, Escrow.dumps, n)
+
+
+if __name__ == "__main__":
+    main()
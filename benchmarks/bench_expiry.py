@@ -0,0 +1,238 @@
+"""Expiry deadlines at scale on a simulated clock: TimerWheel vs. a lazy-deletion heap.
+
+    python benchmarks/bench_expiry.py [escrows] [simulated-hours]
+
+Every escrow gets a deadline within the simulated window; a third of them
+are rescheduled and a tenth cancelled before they fall due, as trades move
+between statuses. The clock then advances one second at a time, the way
+ExpiryScheduler ticks. Reports the cost of scheduling, rescheduling and
+cancelling, the cost per tick, and checks that every deadline fired once,
+no earlier than due and at most one tick late, and that cancelled ones
+never fired. It then restores ExpiryScheduler from serialized escrows
+to check a restart schedules the same deadlines.
+
+Finally it plays the policies through bot.expire_escrow on the simulated
+clock, with the outbox and Bot faked: reminders then expiry, reminders
+then escalation, expiry in a group the bot was removed from, a restart
+part way through a policy, and a step whose send fails and is retried.
+"""
+import asyncio
+import heapq
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+
+os.environ.update(TOKEN="123456:BENCH", ADMIN_GROUP_ID="-1000000000001", ESCROW_DB="", AUDIT_DIR="",
+                  METRICS_PORT="0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram.error import Forbidden  # noqa: E402
+
+import bot  # noqa: E402
+from escrow import Coin, Escrow, Status  # noqa: E402
+from expiry import POLICIES, ExpiryScheduler, TimerWheel  # noqa: E402
+
+START = 1_700_000_000.0
+
+
+class HeapTimers:
+    # The usual alternative: a heap with stale entries skipped when popped.
+    def __init__(self):
+        self._heap = []
+        self._live = {}  # key -> deadline
+
+    def __len__(self):
+        return len(self._live)
+
+    def schedule(self, key, deadline):
+        self._live[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+
+    def cancel(self, key):
+        self._live.pop(key, None)
+
+    def advance(self, now):
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._live.get(key) == deadline:
+                del self._live[key]
+                expired.append(key)
+        return expired
+
+
+def run(label, timers, n, seconds, seed=3):
+    rng = random.Random(seed)
+    deadlines = {key: START + rng.uniform(0, seconds) for key in range(n)}
+    start = time.perf_counter()
+    for key, deadline in deadlines.items():
+        timers.schedule(key, deadline)
+    scheduled = time.perf_counter() - start
+
+    moved = rng.sample(range(n), n // 3)
+    cancelled = set(rng.sample(range(n), n // 10))
+    start = time.perf_counter()
+    for key in moved:
+        deadlines[key] = START + rng.uniform(0, seconds)
+        timers.schedule(key, deadlines[key])
+    for key in cancelled:
+        timers.cancel(key)
+    changed = time.perf_counter() - start
+    held = len(getattr(timers, "_heap", timers))  # the heap keeps superseded entries until they surface
+
+    fired = {}
+    start = time.perf_counter()
+    for second in range(1, int(seconds) + 2):
+        now = START + second
+        for key in timers.advance(now):
+            fired[key] = now
+    ticking = time.perf_counter() - start
+
+    late = [fired[key] - deadlines[key] for key in fired]
+    assert not cancelled & fired.keys(), "cancelled deadline fired"
+    assert len(fired) == n - len(cancelled), "deadline lost"
+    assert min(late) >= 0 and max(late) <= 1.0 + 1e-6, "fired outside its tick"
+    print(f"{label:>6}: schedule {scheduled / n * 1e9:4.0f} ns, reschedule/cancel {changed / (len(moved) + len(cancelled)) * 1e9:4.0f} ns, "
+          f"tick {ticking / (seconds + 1) * 1e6:5.1f} us ({ticking:5.2f} s for {seconds / 3600:.0f} h), "
+          f"fired {len(fired):,}, max lateness {max(late):.2f} s, entries held {held:,}")
+
+
+def check_restart(n=10_000, seed=5):
+    rng = random.Random(seed)
+    clock = [START]
+    statuses = list(POLICIES)
+    escrows = []
+    for i in range(n):
+        status = rng.choice(statuses)
+        step = rng.randrange(len(POLICIES[status]))
+        escrows.append(Escrow(-i, f"T{i:07d}", status=status, status_since=START - rng.uniform(0, 3600),
+                              expiry_step=step))
+    before = ExpiryScheduler(clock=lambda: clock[0])
+    for escrow in escrows:
+        before.track(escrow)
+    after = ExpiryScheduler(clock=lambda: clock[0])
+    for row in [escrow.dumps() for escrow in escrows]:
+        after.track(Escrow.loads(row))
+    fired_before, fired_after = {}, {}
+    while before or after:
+        clock[0] += 1
+        for ticket in before.due():
+            fired_before[ticket] = clock[0]
+        for ticket in after.due():
+            fired_after[ticket] = clock[0]
+    assert fired_before == fired_after
+    print(f"restart: {n:,} escrows restored from rows fire at the same ticks as before")
+
+
+class FakeBot:
+    def __init__(self):
+        self.removed_from = set()  # group ids that answer Forbidden
+
+    async def get_chat_member(self, chat_id, user_id):
+        if chat_id in self.removed_from:
+            raise Forbidden("Forbidden: bot was kicked from the group chat")
+        return SimpleNamespace(user=SimpleNamespace(username=f"user{user_id}"))
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.sent = []  # (chat_id, text)
+        self.fail = 0  # sends still to fail
+
+    def send(self, chat_id, text, parse_mode=None, priority=None, **kwargs):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("send failed")
+        self.sent.append((chat_id, text))
+
+
+def check_policies():
+    # The real expire_escrow with the scheduler on a simulated clock, ticked the way ExpiryScheduler._run does.
+    clock = [START]
+    outbox = bot.outbox = FakeOutbox()
+    scheduler = bot.expiry = ExpiryScheduler(clock=lambda: clock[0])
+
+    def open_trade(chat_id, status, buyer_username=None, **fields):
+        escrow = bot.escrows.add(Escrow(group_id=chat_id, ticket=f"P{-chat_id:07d}", status=status,
+                                        status_since=clock[0], buyer_id=1, seller_id=2,
+                                        buyer_username=buyer_username, **fields))
+        scheduler.track(escrow)
+        return escrow
+
+    async def tick_until(deadline):
+        failed = 0
+        while clock[0] < deadline:
+            clock[0] += 10
+            for ticket in scheduler.due():
+                try:
+                    await bot.expire_escrow(ticket)
+                except Exception:
+                    failed += 1  # ExpiryScheduler._fire logs these
+        return failed
+
+    def texts(chat_id):
+        return [text for chat, text in outbox.sent if chat == chat_id]
+
+    async def run():
+        expired = open_trade(-1, Status.AWAITING_AMOUNT, buyer_username="alice")
+        escalated = open_trade(-2, Status.AWAITING_BUYER_ACTION, crypto=Coin.BTC, fiat_amount=Decimal("50"),
+                               crypto_amount=Decimal("0.001"))
+        abandoned = open_trade(-3, Status.AWAITING_PAYMENT)
+        outbox.bot.removed_from.add(-3)
+        assert not await tick_until(START + 3600), "a step failed"
+        assert len(texts(-1)) == 2 and bot.escrows.get(-1) is None and expired.status == Status.CANCELLED, \
+            "awaiting_amount: remind at 15 min, expire at 1 h"
+        assert "@alice" in texts(bot.ADMIN_GROUP_ID)[0], "recorded username not used"
+        assert not await tick_until(START + 24 * 3600), "a step failed"
+        assert len(texts(-2)) == 2 and escalated.status == Status.DISPUTED and escalated.disputed, \
+            "awaiting_buyer_action: remind at 30 min, escalate at 24 h"
+        assert len(texts(-3)) == 3 and bot.escrows.get(-3) is None and abandoned.status == Status.CANCELLED, \
+            "awaiting_payment in a group the bot left: two reminders, then expiry"
+
+        # Restart after the first reminder: the restored trade resumes at the second step.
+        start = clock[0]
+        row = open_trade(-4, Status.AWAITING_PAYMENT, expiry_step=1).dumps()
+        bot.escrows.pop(-4)
+        scheduler.untrack("P0000004")
+        restored = Escrow.loads(row)
+        bot.escrows.add(restored)
+        scheduler.track(restored)
+        assert not await tick_until(start + 4 * 3600 - 10), "a step failed"
+        assert not texts(-4), "a reminder already sent before the restart was sent again"
+        await tick_until(start + 4 * 3600)
+        assert len(texts(-4)) == 1 and restored.expiry_step == 2, "second reminder not sent after the restart"
+
+        # A step whose send fails is kept and run again after retry_after.
+        start = clock[0]
+        retried = open_trade(-5, Status.AWAITING_AMOUNT)
+        outbox.fail = 1
+        failed = await tick_until(start + 15 * 60)
+        assert failed == 1 and retried.expiry_step == 0 and retried.ticket in scheduler.wheel, \
+            "failed step consumed"
+        await tick_until(start + 15 * 60 + scheduler.retry_after)
+        assert len(texts(-5)) == 1 and retried.expiry_step == 1, "failed step not retried"
+        await tick_until(start + 3600)
+        assert bot.escrows.get(-5) is None, "trade did not expire after a failed reminder"
+
+    asyncio.run(run())
+    print("policies: remind, expire and escalate through expire_escrow; expiry without access to the group; "
+          "restart part way through a policy; failed step retried")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+    print(f"{n:,} deadlines over {hours:g} simulated hours, 1 s ticks")
+    run("wheel", TimerWheel(1.0, 4096, START), n, hours * 3600)
+    run("heap", HeapTimers(), n, hours * 3600)
+    check_restart()
+    check_policies()
+
+
+if __name__ == "__main__":
+    main()
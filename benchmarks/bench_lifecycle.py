@@ -0,0 +1,275 @@
+"""Full trade lifecycles through the real Application, with Telegram and prices faked in-process.
+
+    python benchmarks/bench_lifecycle.py [--groups 500] [--api-latency 0.02] [--price-latency 0.05]
+
+Builds bot.py's Application with an in-process Bot API (a drop-in for the
+HTTP request layer, so the real Bot serialises every call) and a fake
+price source, both with configurable latency. Every group then plays one
+trade through Application.process_update, from synthetic Update JSON:
+
+    /escrow -> join_buyer -> join_seller -> crypto_* -> /amount -> buyer_paid
+    -> payment_received (admin) -> seller_sent_goods -> buyer_release_funds
+    -> /wallet -> admin_sent (admin)
+
+The asset registry lists GBP and EUR, and every other group quotes with
+"/amount 20 eur". Buttons are pressed with the callback_data the bot
+actually sent, versions included, once the message carrying them has been
+delivered. That goes for
+admin buttons too, which come through the outbox. All groups run at once.
+They meet at a barrier once every trade awaits payment confirmation, where
+memory is sampled with N trades open.
+
+Reports trades/s, p50/p99 latency per transition (one process_update
+each), Bot API calls per trade, and resident memory before, at the
+barrier and after. Checks that every trade completed.
+
+Every trade's admin messages go to the one admin group, which the outbox
+serves one send at a time to keep its order, so past a few hundred groups
+throughput tends to api-latency x admin messages per trade, whatever
+--admin-rate allows.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+ADMIN_GROUP_ID = -1000000000001
+COINS = ("BTC", "ETH", "LTC", "SOL")
+ASSETS_FILE = os.path.join(tempfile.mkdtemp(), "assets.json")
+with open(ASSETS_FILE, "w") as f:
+    json.dump({"fiats": {"GBP": {"symbol": "£"}, "EUR": {"symbol": "€"}},
+               "coins": {coin: {"decimals": decimals, "price_id": coin.lower()}
+                         for coin, decimals in zip(COINS, (8, 18, 8, 9))}}, f)
+os.environ.update(TOKEN="123456:BENCH", ADMIN_GROUP_ID=str(ADMIN_GROUP_ID), ESCROW_DB="", AUDIT_DIR="",
+                  METRICS_PORT="0", ASSETS_FILE=ASSETS_FILE)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram import Update  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+import bot  # noqa: E402
+from keyboards import untag  # noqa: E402
+from metrics import InstrumentedRequest  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+ADMIN_USER = 1
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "K1 Escrow", "username": "k1_escrow_bot"}
+PRICES = {"BTC": Decimal("50000"), "ETH": Decimal("2500"), "LTC": Decimal("80"), "SOL": Decimal("150")}
+
+# name, actor, kind, text or callback action
+STEPS = (
+    ("escrow", "buyer", "text", "/escrow"),
+    ("join_buyer", "buyer", "button", "join_buyer"),
+    ("join_seller", "seller", "button", "join_seller"),
+    ("crypto", "buyer", "button", "crypto_{coin}"),
+    ("amount", "buyer", "text", "/amount {amount}{currency}"),
+    ("buyer_paid", "buyer", "button", "buyer_paid"),
+    ("payment_received", "admin", "button", "payment_received_{ticket}"),
+    ("seller_sent_goods", "seller", "button", "seller_sent_goods"),
+    ("buyer_release_funds", "buyer", "button", "buyer_release_funds"),
+    ("wallet", "seller", "text", "/wallet bc1qbench{group}"),
+    ("admin_sent", "admin", "button", "admin_sent_{ticket}"),
+)
+BARRIER_AFTER = "buyer_paid"
+
+
+class FakeTelegram(HTTPXRequest):
+    """Answers Bot API calls in-process after ``latency`` seconds and remembers the buttons it was sent."""
+
+    def __init__(self, latency=0.02, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls = 0
+        self.buttons = {}  # chat_id -> {untagged callback_data: (callback_data, message_id)}
+        self._message_ids = itertools.count(1)
+        self._waiters = {}  # (chat_id, action) -> asyncio.Event set when that button arrives
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = True
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendMessage":
+            chat_id = int(params["chat_id"])
+            message_id = next(self._message_ids)
+            result = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                      "chat": {"id": chat_id, "type": "group"}, "text": params.get("text", "")}
+            self._remember(chat_id, message_id, params.get("reply_markup"))
+        elif endpoint == "editMessageReplyMarkup":
+            self._remember(int(params["chat_id"]), params["message_id"], params.get("reply_markup"))
+        elif endpoint == "getChatMember":
+            user_id = int(params["user_id"])
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User",
+                                                   "username": f"user{user_id}"}}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _remember(self, chat_id, message_id, markup):
+        if not markup:
+            return
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        buttons = self.buttons.setdefault(chat_id, {})
+        for row in markup.get("inline_keyboard", ()):
+            for button in row:
+                data = button.get("callback_data")
+                if data:
+                    action = untag(data)
+                    buttons[action] = (data, message_id)
+                    waiter = self._waiters.pop((chat_id, action), None)
+                    if waiter is not None:
+                        waiter.set()
+
+    async def button(self, chat_id, action, timeout=60.0):
+        found = self.buttons.get(chat_id, {}).get(action)
+        if found is None:
+            waiter = self._waiters.setdefault((chat_id, action), asyncio.Event())
+            await asyncio.wait_for(waiter.wait(), timeout)
+            found = self.buttons[chat_id][action]
+        return found
+
+
+class InstrumentedFake(InstrumentedRequest, FakeTelegram):
+    pass
+
+
+class FakePrices:
+    def __init__(self, latency):
+        self.latency = latency
+        self.stats = {"fetched": 0}
+
+    async def get_price(self, symbol, fiat):
+        await asyncio.sleep(self.latency)
+        self.stats["fetched"] += 1
+        return PRICES.get(symbol.upper())
+
+    async def close(self):
+        pass
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak, not current, off Linux
+
+
+class Driver:
+    def __init__(self, app, telegram):
+        self.app = app
+        self.telegram = telegram
+        self.update_ids = itertools.count(1)
+        self.latency = {name: [] for name, *_ in STEPS}
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"}
+
+    def text_update(self, chat_id, user_id, text):
+        message = {"message_id": next(self.update_ids), "date": int(time.time()), "text": text,
+                   "chat": {"id": chat_id, "type": "group"}, "from": self.user(user_id)}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+    async def button_update(self, chat_id, user_id, action):
+        data, message_id = await self.telegram.button(chat_id, action)
+        query = {"id": str(next(self.update_ids)), "from": self.user(user_id), "chat_instance": str(chat_id),
+                 "data": data, "message": {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                                           "chat": {"id": chat_id, "type": "group"}, "text": "…"}}
+        return {"update_id": next(self.update_ids), "callback_query": query}
+
+    async def trade(self, group, barrier):
+        chat_id = -(10**6 + group)
+        users = {"buyer": 10 * group + 2, "seller": 10 * group + 3, "admin": ADMIN_USER}
+        fields = {"coin": COINS[group % len(COINS)], "amount": 20 + group % 480, "group": group, "ticket": None,
+                  "currency": " eur" if group % 2 else ""}
+        for name, actor, kind, payload in STEPS:
+            payload = payload.format(**fields)
+            if kind == "text":
+                data = self.text_update(chat_id, users[actor], payload)
+            else:
+                data = await self.button_update(ADMIN_GROUP_ID if actor == "admin" else chat_id, users[actor], payload)
+            update = Update.de_json(data, self.app.bot)
+            start = time.perf_counter()
+            await self.app.process_update(update)
+            self.latency[name].append(time.perf_counter() - start)
+            if name == "escrow":
+                fields["ticket"] = bot.escrows.get(chat_id).ticket
+            if name == BARRIER_AFTER:
+                await barrier()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=500, help="trade groups running at once")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Bot API latency (s)")
+    parser.add_argument("--price-latency", type=float, default=0.05, help="fake price source latency (s)")
+    parser.add_argument("--admin-rate", type=float, default=1000.0,
+                        help="outbox messages/s to one chat; Telegram's real limit is about 0.33")
+    args = parser.parse_args()
+
+    bot.price_oracle = FakePrices(args.price_latency)
+    bot.outbox = Outbox(per_chat_rate=args.admin_rate, per_chat_burst=max(3, int(args.admin_rate)),
+                        global_rate=max(30.0, args.admin_rate), global_burst=max(30, int(args.admin_rate)))
+    telegram = InstrumentedFake(bot.metrics, latency=args.api_latency)
+    app = bot.build_application(request=telegram)
+    await app.initialize()
+    await app.post_init(app)
+    driver = Driver(app, telegram)
+    baseline = rss_mb()
+
+    arrived = 0
+    released = asyncio.Event()
+    at_barrier = {}
+
+    async def barrier():
+        nonlocal arrived
+        arrived += 1
+        if arrived == args.groups:
+            at_barrier.update(rss=rss_mb(), open=len(bot.escrows))
+            released.set()
+        await released.wait()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(driver.trade(group, barrier) for group in range(args.groups)))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.1)
+    completed = bot.trade_stats.today().completed
+    currencies = {fiat for fiat, volume in bot.trade_stats.today().volume.items() if volume}
+    calls = telegram.calls
+    await app.post_shutdown(app)
+    await app.shutdown()
+
+    assert completed == args.groups and not bot.escrows, f"{completed} of {args.groups} trades completed"
+    assert currencies == ({"GBP", "EUR"} if args.groups > 1 else {"GBP"}), f"settled in {currencies}"
+    print(f"{args.groups:,} concurrent groups, api latency {args.api_latency * 1e3:g} ms, "
+          f"price latency {args.price_latency * 1e3:g} ms")
+    print(f"  {args.groups / elapsed:,.1f} trades/s ({elapsed:.2f} s), "
+          f"{args.groups * len(STEPS) / elapsed:,.0f} transitions/s, {calls / args.groups:.1f} Bot API calls/trade")
+    all_steps = [value for values in driver.latency.values() for value in values]
+    print(f"  transition latency: p50 {percentile(all_steps, 0.5) * 1e3:.1f} ms, "
+          f"p99 {percentile(all_steps, 0.99) * 1e3:.1f} ms")
+    for name, values in driver.latency.items():
+        print(f"    {name:<20} p50 {percentile(values, 0.5) * 1e3:7.1f} ms   p99 {percentile(values, 0.99) * 1e3:7.1f} ms")
+    print(f"  memory (RSS): {baseline:.1f} MB at start, {at_barrier['rss']:.1f} MB with "
+          f"{at_barrier['open']:,} trades open ({(at_barrier['rss'] - baseline) * 2**20 / args.groups / 1024:.1f} KB/trade), "
+          f"{rss_mb():.1f} MB at the end")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+"""What the instrumentation in metrics.py costs on the hot path, and what a scrape costs.
+
+    python benchmarks/bench_metrics.py [calls]
+
+Times an async handler called bare and through Metrics.timed, and a Bot
+API call through a stub HTTPXRequest with and without InstrumentedRequest
+(no network, so the difference is all bookkeeping). Checks that errors are
+counted by type and re-raised, that ApplicationHandlerStop is not counted
+as an error, and that histogram quantiles land on the right bucket.
+Then renders and serves a registry the size the bot produces and scrapes
+it over HTTP.
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram.ext import ApplicationHandlerStop  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+from metrics import Histogram, InstrumentedRequest, Metrics  # noqa: E402
+
+
+class StubRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        return 200, b'{"ok":true,"result":true}'
+
+
+class InstrumentedStub(InstrumentedRequest, StubRequest):
+    pass
+
+
+async def handler(update, context):
+    return None
+
+
+async def per_call(fn, calls, *args):
+    start = time.perf_counter()
+    for _ in range(calls):
+        await fn(*args)
+    return (time.perf_counter() - start) / calls
+
+
+async def check_errors(metrics):
+    async def broken(update, context):
+        raise KeyError("boom")
+
+    async def gate(update, context):
+        raise ApplicationHandlerStop
+
+    for callback in (broken, gate):
+        timed = metrics.timed(callback.__name__, callback)
+        for _ in range(3):
+            try:
+                await timed(None, None)
+            except (KeyError, ApplicationHandlerStop):
+                pass
+            else:
+                raise AssertionError("exception swallowed")
+    assert metrics.counters[("handler_errors_total", (("error", "KeyError"), ("handler", "broken")))] == 3
+    assert not any(labels and ("handler", "gate") in labels for _, labels in metrics.counters)
+    assert metrics.histogram("handler_seconds", handler="gate").count == 3
+
+
+def check_quantiles():
+    rng = random.Random(1)
+    histogram = Histogram()
+    samples = sorted(rng.lognormvariate(-3, 1) for _ in range(100_000))  # median ~50 ms
+    for sample in samples:
+        histogram.observe(sample)
+    for q in (0.5, 0.9, 0.99):
+        exact = samples[int(q * len(samples))]
+        bound = histogram.quantile(q)
+        below = max([b for b in histogram.bounds if b < bound], default=0.0)
+        assert below <= exact <= bound, (q, exact, bound)
+        print(f"  p{q * 100:g}: exact {exact * 1e3:6.1f} ms, bucket ({below * 1e3:g}, {bound * 1e3:g}] ms")
+
+
+async def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    metrics = Metrics()
+    timed = metrics.timed("handler", handler)
+    bare = await per_call(handler, calls, None, None)
+    wrapped = await per_call(timed, calls, None, None)
+    print(f"handler: bare {bare * 1e9:5.0f} ns, timed {wrapped * 1e9:5.0f} ns, overhead {(wrapped - bare) * 1e9:4.0f} ns/call")
+
+    url = "https://api.telegram.org/bot123:ABC/sendMessage"
+    plain, instrumented = StubRequest(), InstrumentedStub(metrics)
+    bare = await per_call(plain.do_request, calls, url, "POST")
+    wrapped = await per_call(instrumented.do_request, calls, url, "POST")
+    assert metrics.histogram("bot_api_seconds", method="sendMessage").count == calls
+    print(f"Bot API call: bare {bare * 1e9:5.0f} ns, instrumented {wrapped * 1e9:5.0f} ns, "
+          f"overhead {(wrapped - bare) * 1e9:4.0f} ns/call")
+
+    await check_errors(metrics)
+    print("errors: counted by type and re-raised; ApplicationHandlerStop passes through uncounted")
+    check_quantiles()
+
+    # Roughly what the bot registers: ~15 handlers and jobs, ~20 API methods, component stats and gauges.
+    for i in range(15):
+        metrics.histogram("handler_seconds", handler=f"handler_{i}").observe(0.003)
+    for i in range(20):
+        metrics.histogram("bot_api_seconds", method=f"method_{i}").observe(0.08)
+    for i in range(6):
+        metrics.stats(f"component{i}_total", {"sent": 10, "failed": 1, "retried": 2, "other": 3})
+    for i in range(10):
+        metrics.gauge(f"depth_{i}", lambda: 42)
+    start = time.perf_counter()
+    for _ in range(100):
+        text = metrics.render()
+    rendered = (time.perf_counter() - start) / 100
+    await metrics.start("127.0.0.1", 0)
+    port = metrics._server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    for _ in range(20):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+    scraped = (time.perf_counter() - start) / 20
+    await metrics.stop()
+    assert response.startswith(b"HTTP/1.1 200 OK") and response.endswith(text.encode())
+    print(f"render: {len(text.splitlines()):,} lines, {len(text):,} bytes in {rendered * 1e3:.2f} ms; "
+          f"scrape over HTTP {scraped * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
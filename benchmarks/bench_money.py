@@ -0,0 +1,107 @@
+"""Float vs. exact money: drift in quotes, fees and totals, and what exactness costs.
+
+    python benchmarks/bench_money.py [escrows]
+
+Generates random trades (pence amounts, realistic prices, every coin) and
+runs them through the float arithmetic bot.py used before money.py and
+through money.quote/money.fees. Reports how often the float path shows a
+fee + payout that does not add up to the amount, how far float crypto
+payouts land from the exact base-unit payout, how much a day's summed fees
+drift in float, and the per-escrow and batch (money.settle) throughput.
+"""
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrow import Coin, Escrow  # noqa: E402
+from money import COIN_DECIMALS, FIAT_DECIMALS, fees, parse_fiat, quote, settle, to_minor  # noqa: E402
+
+FEE_RATE = Decimal("0.05")
+PRICES = {"BTC": (20_000, 60_000), "ETH": (1_000, 3_500), "LTC": (40, 120), "SOL": (10, 200)}
+
+
+def trades(n, seed=7):
+    rng = random.Random(seed)
+    coins = list(PRICES)
+    for _ in range(n):
+        coin = rng.choice(coins)
+        low, high = PRICES[coin]
+        yield coin, rng.randint(100, 500_000), f"{rng.uniform(low, high):.2f}"  # pence, price text
+
+
+def float_path(coin, pence, price):
+    # The arithmetic bot.py did with floats.
+    amount = pence / 100
+    crypto = round(amount / float(price), 8)
+    fee = amount * 0.05
+    return crypto, fee, amount - fee, crypto - crypto * 0.05
+
+
+def exact_path(coin, pence, price):
+    amount = Decimal(pence).scaleb(-2)
+    crypto = quote(amount, Decimal(price), coin)
+    fiat = fees(amount, FIAT_DECIMALS["GBP"], FEE_RATE)
+    return crypto, fiat.fee, fiat.payout, fees(crypto, COIN_DECIMALS[coin], FEE_RATE).payout
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    data = list(trades(n))
+    print(f"{n:,} trades")
+
+    start = time.perf_counter()
+    floats = [float_path(*t) for t in data]
+    float_time = time.perf_counter() - start
+    start = time.perf_counter()
+    exact = [exact_path(*t) for t in data]
+    exact_time = time.perf_counter() - start
+
+    split_mismatch = quote_off = payout_off = 0
+    worst_units = 0
+    float_fees = 0.0
+    for (coin, pence, _), (f_crypto, f_fee, f_payout, f_payout_crypto), (crypto, fee, payout, payout_crypto) in zip(
+            data, floats, exact):
+        # What a user sees: amounts shown to the penny must add up.
+        if round(f_fee * 100) + round(f_payout * 100) != pence:
+            split_mismatch += 1
+        if Decimal(repr(f_crypto)) != crypto:
+            quote_off += 1
+        units = COIN_DECIMALS[coin]
+        off = abs(to_minor(Decimal(repr(f_payout_crypto)).quantize(Decimal(1).scaleb(-units)), units)
+                  - to_minor(payout_crypto, units))
+        if off:
+            payout_off += 1
+            worst_units = max(worst_units, off)
+        float_fees += f_fee
+    # Same unrounded fees, summed exactly: isolates accumulation error from per-trade rounding.
+    exact_sum = sum(Decimal(pence) * FEE_RATE for _, pence, _ in data).scaleb(-2)
+
+    print(f"  fee + payout != amount (to the penny):  float {split_mismatch:7,}   exact 0")
+    print(f"  quote differs from exact quote:         float {quote_off:7,}")
+    print(f"  crypto payout off the exact base unit:  float {payout_off:7,}   worst {worst_units:,} base units")
+    print(f"  summed unrounded fees: float {float_fees!r}  exact {exact_sum}  drift {Decimal(repr(float_fees)) - exact_sum}")
+    print(f"  per escrow: float {float_time / n * 1e6:5.2f} us   exact {exact_time / n * 1e6:5.2f} us")
+
+    escrows = [Escrow(i, f"T{i}", crypto=Coin(coin), fiat_amount=Decimal(pence).scaleb(-2), crypto_amount=e[0])
+               for i, ((coin, pence, _), e) in enumerate(zip(data, exact))]
+    start = time.perf_counter()
+    report = settle(escrows, FEE_RATE)
+    batch = time.perf_counter() - start
+    print(f"  settle(): {batch / n * 1e6:5.2f} us/escrow ({n / batch:,.0f} escrows/s), fiat fees {report.fiat_totals['GBP'].fee}")
+
+    # /amount input: a zero amount would reserve a deposit target no payment can match.
+    for text in ("0", "0.00", "-5", "1.001", "nan", "inf"):
+        try:
+            parse_fiat(text, FIAT_DECIMALS["GBP"])
+        except ValueError:
+            continue
+        sys.exit(f"parse_fiat accepted {text!r}")
+    assert parse_fiat("0.01", FIAT_DECIMALS["GBP"]) == Decimal("0.01")
+
+
+if __name__ == "__main__":
+    main()
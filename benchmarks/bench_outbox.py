@@ -0,0 +1,134 @@
+"""Outbox throughput against a fake Bot that enforces Telegram-style limits.
+
+    python benchmarks/bench_outbox.py [messages] [speedup]
+
+Time is compressed by ``speedup`` (default 60, so the 20 msg/min group limit
+becomes 20 msg/s). The fake Bot answers with RetryAfter when a chat goes over
+its limit, the same way Telegram answers with 429. The report shows delivered
+throughput, retries, digests, and queue latency per priority lane, and
+checks that HIGH and NORMAL messages were delivered in the order queued
+despite the retries.
+
+A last run queues the same admin backlog while 50 trade groups each get a
+NORMAL message and a keyboard edit. It reports how long those wait. They
+should not queue behind the admin group's bucket.
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import deque
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram.error import RetryAfter  # noqa: E402
+
+from outbox import HIGH, LOW, NORMAL, Outbox  # noqa: E402
+
+ADMIN_CHAT = -100
+
+
+class FakeBot:
+    def __init__(self, per_chat_per_minute, speedup, rtt):
+        self.window = 60 / speedup
+        self.limit = per_chat_per_minute
+        self.rtt = rtt
+        self.history = {}  # chat_id -> deque of send times
+        self.rejected = 0
+        self.delivered = 0
+        self.texts = []  # in delivery order
+        self.next_id = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.rtt)
+        now = time.monotonic()
+        sent = self.history.setdefault(chat_id, deque())
+        while sent and now - sent[0] > self.window:
+            sent.popleft()
+        if len(sent) >= self.limit:
+            self.rejected += 1
+            raise RetryAfter(self.window - (now - sent[0]))
+        sent.append(now)
+        self.delivered += 1
+        self.texts.append(text)
+        self.next_id += 1
+        return SimpleNamespace(message_id=self.next_id, chat_id=chat_id, text=text)
+
+    async def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None):
+        return await self.send_message(chat_id, None)
+
+
+async def run(n_messages, speedup, naive):
+    bot = FakeBot(per_chat_per_minute=20, speedup=speedup, rtt=0.01)
+    outbox = Outbox(per_chat_rate=17 / 60 * speedup, per_chat_burst=3, global_rate=30 * speedup)
+    if naive:
+        # Same queue without client-side throttling: every 429 is discovered the hard way.
+        outbox = Outbox(per_chat_rate=1e9, per_chat_burst=1e9, global_rate=1e9, global_burst=1e9)
+    outbox.start(bot)
+    latency = {HIGH: [], NORMAL: [], LOW: []}
+    lanes = [HIGH] * 2 + [NORMAL] * 3 + [LOW] * 5
+    rng = random.Random(7)
+    priorities = {}  # text -> priority
+
+    async def one(i):
+        priority = priorities[f"event {i}"] = rng.choice(lanes)
+        start = time.monotonic()
+        await outbox.send(ADMIN_CHAT, f"event {i}", priority=priority, coalesce=priority == LOW)
+        latency[priority].append(time.monotonic() - start)
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(i) for i in range(n_messages)))
+    elapsed = time.monotonic() - start
+    await outbox.stop()
+    for priority in (HIGH, NORMAL):
+        order = [int(text.split()[1]) for text in bot.texts if priorities.get(text) == priority]
+        assert order == sorted(order), "a retried message overtook one queued after it"
+
+    label = "retry only" if naive else "token buckets"
+    print(f"[{label}] {n_messages} events in {elapsed:.2f}s ({n_messages / elapsed:.1f} events/s, "
+          f"{bot.delivered} messages, {bot.rejected} x 429, {outbox.stats['retried']} retries, "
+          f"{outbox.stats['coalesced']} events folded into digests)")
+    for priority, name in ((HIGH, "high"), (NORMAL, "normal"), (LOW, "low")):
+        samples = sorted(latency[priority])
+        if samples:
+            print(f"    {name:>6}: p50 {samples[len(samples) // 2] * speedup:6.1f}s  "
+                  f"p99 {samples[int(len(samples) * 0.99)] * speedup:6.1f}s (Telegram time)")
+
+
+async def mixed(n_messages, speedup, groups=50):
+    bot = FakeBot(per_chat_per_minute=20, speedup=speedup, rtt=0.01)
+    outbox = Outbox(per_chat_rate=17 / 60 * speedup, per_chat_burst=3, global_rate=30 * speedup)
+    outbox.start(bot)
+    backlog = [outbox.send(ADMIN_CHAT, f"event {i}", priority=HIGH) for i in range(n_messages)]
+    await asyncio.sleep(0.05)  # the admin bucket is empty and its backlog queued before the groups speak
+    waits = []
+
+    async def one(future):
+        start = time.monotonic()
+        await future
+        waits.append(time.monotonic() - start)
+
+    await asyncio.gather(*(one(outbox.send(-1000 - g, "status update")) for g in range(groups)),
+                         *(one(outbox.edit_markup(-1000 - g, 1)) for g in range(groups)))
+    left = len(outbox)
+    for future in backlog:
+        future.cancel()
+    await outbox.stop(timeout=0)
+    waits.sort()
+    print(f"[mixed] {2 * groups} group sends/edits behind {n_messages} queued admin messages: "
+          f"p50 {waits[len(waits) // 2] * speedup:.1f}s  max {waits[-1] * speedup:.1f}s (Telegram time), "
+          f"{left} admin messages still queued")
+
+
+def main():
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    speedup = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    asyncio.run(run(n_messages, speedup, naive=False))
+    asyncio.run(run(n_messages, speedup, naive=True))
+    asyncio.run(mixed(n_messages, speedup))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Upstream calls and quote cost of PriceOracle with groups quoting in several currencies.
+
+    python benchmarks/bench_prices.py [quotes] [--latency 0.05]
+
+CoinGecko is answered in-process by an httpx MockTransport after
+``latency`` seconds, with a price for every id and currency it is asked
+for. A simulated clock advances through ten minutes while quotes arrive
+for random (coin, fiat) pairs, 4 coins by 3 currencies, in bursts of
+concurrent requests. The oracle keyed by (coin, fiat) fetches every pair
+in one request. For comparison one oracle per pair fetches the way the
+single-currency, per-symbol cache did, one pair per request. Reports upstream
+requests, quotes answered and time per quote.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from prices import PriceOracle  # noqa: E402
+
+PRICE_IDS = {"BTC": "bitcoin", "ETH": "ethereum", "LTC": "litecoin", "SOL": "solana"}
+FIATS = ("GBP", "EUR", "USD")
+BURST = 200  # quotes in flight at once
+
+
+def upstream(latency, counter):
+    async def handler(request):
+        counter[0] += 1
+        await asyncio.sleep(latency)
+        query = parse_qs(request.url.query.decode())
+        fiats = query["vs_currencies"][0].split(",")
+        body = {coingecko_id: {fiat: 100.5 + i for i, fiat in enumerate(fiats)}
+                for coingecko_id in query["ids"][0].split(",")}
+        return httpx.Response(200, content=json.dumps(body).encode())
+    return httpx.MockTransport(handler)
+
+
+async def run(quotes, latency, shared):
+    now = [0.0]
+    counter = [0]
+    transport = upstream(latency, counter)
+
+    def oracle(price_ids, fiats):
+        oracle = PriceOracle(price_ids, fiats, clock=lambda: now[0])
+        oracle._client = httpx.AsyncClient(transport=transport)
+        return oracle
+
+    if shared:
+        one = oracle(PRICE_IDS, FIATS)
+        oracles = {(coin, fiat): one for coin in PRICE_IDS for fiat in FIATS}
+    else:
+        oracles = {(coin, fiat): oracle({coin: PRICE_IDS[coin]}, (fiat,)) for coin in PRICE_IDS for fiat in FIATS}
+    rng = random.Random(11)
+    pairs = [rng.choice(list(oracles)) for _ in range(quotes)]
+    answered = 0
+    start = time.perf_counter()
+    for batch in range(0, quotes, BURST):
+        now[0] = 600 * batch / quotes  # ten simulated minutes over the run
+        prices = await asyncio.gather(*(oracles[pair].get_price(*pair) for pair in pairs[batch:batch + BURST]))
+        answered += sum(price is not None for price in prices)
+    elapsed = time.perf_counter() - start
+    for oracle in set(oracles.values()):
+        await oracle.close()
+    return counter[0], answered, elapsed
+
+
+async def main():
+    args = sys.argv[1:]
+    latency = 0.05
+    if "--latency" in args:
+        at = args.index("--latency")
+        latency = float(args[at + 1])
+        del args[at:at + 2]
+    quotes = int(args[0]) if args else 100_000
+    print(f"{quotes:,} quotes over 10 simulated minutes, {len(PRICE_IDS)} coins x {len(FIATS)} currencies, "
+          f"upstream latency {latency * 1e3:g} ms")
+    for shared, label in ((False, "one request per pair"), (True, "keyed by (coin, fiat)")):
+        calls, answered, elapsed = await run(quotes, latency, shared)
+        print(f"  {label:<22} {calls:>5,} upstream requests, {answered:,} quotes answered, "
+              f"{elapsed / quotes * 1e6:6.1f} us/quote ({elapsed:.2f} s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
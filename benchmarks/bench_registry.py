@@ -0,0 +1,46 @@
+"""Ticket lookup cost vs. number of open escrows.
+
+    python benchmarks/bench_registry.py
+"""
+import os
+import sys
+import timeit
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrow import Escrow, Status  # noqa: E402
+from registry import EscrowRegistry  # noqa: E402
+
+SIZES = (100, 1_000, 10_000, 100_000)
+LOOKUPS = 2_000
+
+
+def make_escrow(chat_id):
+    return Escrow(chat_id, str(uuid4())[:8].upper(), buyer_id=chat_id * 2, seller_id=chat_id * 2 + 1,
+                  status=Status.AWAITING_PAYMENT)
+
+
+def main():
+    print(f"{'open escrows':>12} {'linear scan (us)':>18} {'ticket index (us)':>18} {'buyer index (us)':>17}")
+    for size in SIZES:
+        registry = EscrowRegistry()
+        plain = {}
+        for chat_id in range(-size, 0):
+            escrow = registry.add(make_escrow(chat_id))
+            plain[chat_id] = escrow
+        # Worst realistic case for the scan: the most recently opened trade.
+        ticket = escrow.ticket
+        buyer = escrow.buyer_id
+
+        scan_runs = max(1, LOOKUPS * 100 // size)
+        scan = timeit.timeit(
+            lambda: next((e for e in plain.values() if e.ticket == ticket), None), number=scan_runs
+        ) / scan_runs
+        indexed = timeit.timeit(lambda: registry.by_ticket(ticket), number=LOOKUPS * 100) / (LOOKUPS * 100)
+        by_buyer = timeit.timeit(lambda: registry.by_buyer(buyer), number=LOOKUPS * 100) / (LOOKUPS * 100)
+        print(f"{size:>12,} {scan * 1e6:>18.2f} {indexed * 1e6:>18.3f} {by_buyer * 1e6:>17.3f}")
+
+
+if __name__ == "__main__":
+    main()
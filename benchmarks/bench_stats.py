@@ -0,0 +1,111 @@
+"""Admin dashboard figures: incremental TradeStats vs. scanning the registry.
+
+    python benchmarks/bench_stats.py [max-open-escrows]
+
+Drives escrows through the usual lifecycle (join, coin, amount, payment,
+release) with some cancelled and disputed on the way, calling
+TradeStats.track at every transition as bot.advance does. Reports the
+cost per transition, then the cost of answering /stats and /open from the
+counters against computing the same figures by scanning every open
+escrow, at growing numbers of open trades. Finally checks that the
+counters equal the scan.
+"""
+import os
+import random
+import sys
+import time
+from collections import Counter
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrow import Coin, Escrow, Status  # noqa: E402
+from money import FIAT_DECIMALS, fees  # noqa: E402
+from stats import TradeStats  # noqa: E402
+
+FEE_RATE = Decimal("0.05")
+START = 1_700_000_000.0
+LIFECYCLE = (Status.CRYPTO_SELECTION, Status.AWAITING_AMOUNT, Status.AWAITING_PAYMENT,
+             Status.AWAITING_ADMIN_CONFIRMATION, Status.PAYMENT_CONFIRMED, Status.AWAITING_BUYER_ACTION,
+             Status.AWAITING_SELLER_WALLET, Status.AWAITING_ADMIN_RELEASE, Status.COMPLETED)
+
+
+def move(stats, escrow, status, rng):
+    escrow.status = status
+    escrow.status_since = START
+    if status is Status.CRYPTO_SELECTION:
+        escrow.crypto = rng.choice(list(Coin))
+    elif status is Status.AWAITING_PAYMENT:
+        escrow.fiat_amount = Decimal(rng.randint(100, 500_000)).scaleb(-2)
+        escrow.crypto_amount = (escrow.fiat_amount / 40_000).quantize(Decimal("1e-8"))
+    stats.track(escrow)
+
+
+def scan(escrows):
+    # What /stats and /open would cost without the counters.
+    by_status, by_coin, volume = Counter(), Counter(), Counter()
+    for escrow in escrows:
+        by_status[escrow.status] += 1
+        if escrow.crypto:
+            by_coin[escrow.crypto] += 1
+        if escrow.fiat_amount is not None:
+            volume[escrow.fiat] += escrow.fiat_amount
+    return by_status, by_coin, volume
+
+
+def query(stats):
+    today = stats.today()
+    return (+stats.by_status, +stats.by_coin, stats.open_volume, today.completed, today.volume, today.fees,
+            stats.recent(7).volume)
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+    rng = random.Random(5)
+    stats = TradeStats(FEE_RATE, clock=lambda: START)
+    open_escrows = {}
+    completed = []
+    transitions = elapsed = 0
+    print(f"{'open':>9} {'track':>9} {'query':>9} {'scan':>11}")
+    for size in sorted({*(10 ** k for k in range(3, 7) if 10 ** k < limit), limit}):
+        start = time.perf_counter()
+        while len(open_escrows) < size:
+            ticket = f"T{transitions:09d}"
+            escrow = Escrow(-transitions, ticket, status_since=START)
+            stats.track(escrow)
+            transitions += 1
+            # Each new escrow gets part of the way; every tenth finishes, a few are cancelled or disputed.
+            for status in LIFECYCLE[:len(LIFECYCLE) if rng.random() < 0.1 else rng.randrange(1, 6)]:
+                move(stats, escrow, status, rng)
+                transitions += 1
+            roll = rng.random()
+            if escrow.status is not Status.COMPLETED and roll < 0.05:
+                move(stats, escrow, Status.CANCELLED, rng)
+            elif escrow.status is not Status.COMPLETED and roll < 0.08:
+                move(stats, escrow, Status.DISPUTED, rng)
+            if escrow.status is Status.COMPLETED:
+                completed.append(escrow)
+            elif escrow.status is not Status.CANCELLED:
+                open_escrows[ticket] = escrow
+        elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(100):
+            query(stats)
+        queried = (time.perf_counter() - start) / 100
+        start = time.perf_counter()
+        by_status, by_coin, volume = scan(open_escrows.values())
+        scanned = time.perf_counter() - start
+        assert +stats.by_status == by_status and +stats.by_coin == by_coin and +stats.open_volume == +volume
+        print(f"{size:>9,} {elapsed / transitions * 1e6:>6.2f} us {queried * 1e6:>6.1f} us {scanned * 1e3:>8.2f} ms")
+
+    today = stats.today()
+    assert today.completed == len(completed)
+    assert today.volume["GBP"] == sum(e.fiat_amount for e in completed)
+    assert today.fees["GBP"] == sum(fees(e.fiat_amount, FIAT_DECIMALS["GBP"], FEE_RATE).fee for e in completed)
+    print(f"{transitions:,} transitions; {today.completed:,} completed, {today.cancelled:,} cancelled, "
+          f"{today.disputed:,} disputed; totals match a scan of every escrow")
+
+
+if __name__ == "__main__":
+    main()
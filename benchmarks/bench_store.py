@@ -0,0 +1,77 @@
+"""Escrow transitions/sec through SQLiteStore under concurrent updates.
+
+    python benchmarks/bench_store.py [escrows] [transitions-per-escrow]
+
+Compares group commit (default settings) with a commit per transition, then
+times recovery of the open escrows from the database.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from decimal import Decimal
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from escrow import Coin, Escrow, Status  # noqa: E402
+from registry import EscrowRegistry  # noqa: E402
+from store import SQLiteStore  # noqa: E402
+
+STATUSES = (Status.CRYPTO_SELECTION, Status.AWAITING_AMOUNT, Status.AWAITING_PAYMENT,
+            Status.AWAITING_ADMIN_CONFIRMATION, Status.PAYMENT_CONFIRMED, Status.AWAITING_BUYER_ACTION,
+            Status.AWAITING_SELLER_WALLET)
+
+
+def make_escrow(chat_id):
+    return Escrow(chat_id, str(uuid4())[:8].upper(), crypto=Coin.BTC, fiat_amount=Decimal("100"), crypto_amount=Decimal("0.0015"))
+
+
+async def run(path, n_escrows, per_escrow, eager):
+    store = SQLiteStore(path)
+    registry = EscrowRegistry(store)
+
+    async def trade(chat_id):
+        escrow = registry.add(make_escrow(chat_id))
+        for i in range(per_escrow):
+            escrow.status = STATUSES[i % len(STATUSES)]
+            registry.save(escrow)
+            if eager:
+                await store.flush()
+            await asyncio.sleep(0)  # yield like a handler awaiting Telegram I/O
+        if chat_id % 2:
+            registry.pop(chat_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(trade(-chat_id) for chat_id in range(1, n_escrows + 1)))
+    await store.flush()
+    elapsed = time.perf_counter() - start
+    commits = store.commits
+    await store.close()
+    return n_escrows * per_escrow / elapsed, commits
+
+
+def main():
+    n_escrows = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    per_escrow = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, eager in (("group commit", False), ("commit per write", True)):
+            path = os.path.join(tmp, f"{label.replace(' ', '_')}.db")
+            rate, commits = asyncio.run(run(path, n_escrows, per_escrow, eager))
+            print(f"{label:>17}: {rate:>10,.0f} transitions/s  ({commits:,} commits)")
+
+        store = SQLiteStore(os.path.join(tmp, "group_commit.db"))
+        start = time.perf_counter()
+        registry = EscrowRegistry(store)
+        restored = registry.restore()
+        print(f"{'recovery':>17}: {restored:,} open escrows in {(time.perf_counter() - start) * 1e3:.1f} ms")
+        plan = store._conn.execute(
+            "EXPLAIN QUERY PLAN SELECT data FROM escrows INDEXED BY escrows_open WHERE is_open = 1"
+        ).fetchall()
+        print(f"{'query plan':>17}: {plan[0][-1]}")
+        asyncio.run(store.close())
+
+
+if __name__ == "__main__":
+    main()
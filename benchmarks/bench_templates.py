@@ -0,0 +1,114 @@
+"""Render throughput of the compiled message catalogue.
+
+    python benchmarks/bench_templates.py [iterations]
+
+Builds the group and admin texts of the release request three ways:
+hand-written f-strings that call fmt_auto/fmt_crypto per variant (what
+bot.py did before templates.py), the same with the user-supplied fields
+escaped, and one snapshot plus Message.render. It then times one render of
+every message in the catalogue, with a sample value for every field.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from templates import MESSAGES, compile_messages, escape_code, escape_markdown  # noqa: E402
+
+FEE_RATE = 0.05
+
+
+def fmt_auto(number):
+    n = float(number)
+    return f"{int(round(n))}" if abs(n - round(n)) < 1e-9 else f"{n:.2f}"
+
+
+def fmt_crypto(number):
+    s = f"{float(number):.8f}".rstrip('0').rstrip('.')
+    if '.' in s and len(s.split('.', 1)[1]) == 1:
+        return f"{s}0"
+    return s
+
+
+ESCROW = dict(ticket="9F3A61C2", coin="BTC", fiat_amount=42.5, crypto_amount=0.00085, wallet="bc1q_seller_wallet")
+BUYER, SELLER = "buyer_one", "seller_two"
+
+
+def by_hand(buyer=BUYER, seller=SELLER, wallet=ESCROW["wallet"]):
+    e = ESCROW
+    fee = e["fiat_amount"] * FEE_RATE
+    payout = e["fiat_amount"] - fee
+    admin = (
+        f"🎟️ Ticket: {e['ticket']}\n📌 Status: Awaiting Admin Release ⏳\n\n"
+        f"💷 Trade Amount: £{fmt_auto(e['fiat_amount'])} (GBP) ({fmt_crypto(e['crypto_amount'])} {e['coin']})\n"
+        f"💸 Escrow Fee (5%): £{fmt_auto(fee)} (GBP)\n"
+        f"🏦 Send To Seller: £{fmt_auto(payout)} (GBP)\n\n"
+        f"👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+        f"👛 Seller Wallet: `{wallet}`\n\n📄 Response: Please confirm funds release"
+    )
+    group = (
+        f"🎟️ Ticket: {e['ticket']}\n📌 Status: Processing Payment...⏳\n\n"
+        f"💷 Trade Amount: £{fmt_auto(e['fiat_amount'])} (GBP) ({fmt_crypto(e['crypto_amount'])} {e['coin']})\n"
+        f"💸 Escrow Fee (5%): £{fmt_auto(fee)} (GBP)\n"
+        f"🏦 Amount Being Released: £{fmt_auto(payout)} (GBP)\n\n"
+        "📄 Response: Funds are being sent to seller, you will receive an update in this chat when payment has been sent."
+    )
+    return admin, group
+
+
+def by_hand_escaped():
+    return by_hand(escape_markdown(BUYER), escape_markdown(SELLER), escape_code(ESCROW["wallet"]))
+
+
+def snapshot():
+    e = ESCROW
+    fee = e["fiat_amount"] * FEE_RATE
+    return {
+        "ticket": e["ticket"], "coin": e["coin"], "buyer": BUYER, "seller": SELLER, "wallet": e["wallet"],
+        "fiat": "£", "fiat_label": "GBP",
+        "amount": fmt_auto(e["fiat_amount"]), "crypto_amount": fmt_crypto(e["crypto_amount"]),
+        "fee": fmt_auto(fee), "payout": fmt_auto(e["fiat_amount"] - fee),
+        "payout_crypto": fmt_crypto(e["crypto_amount"] * (1 - FEE_RATE)),
+    }
+
+
+# Every other field some message uses, as the handlers in bot.py fill them in.
+SAMPLES = dict(
+    username="some_user", role="Buyer", label="Buyer 💷", deposit_wallet="bc1qescrow", deposit="bc1qescrow",
+    waiting="the buyer's payment", idle="2h", txid="4f1c0e5a9b", confirmations=3, status="Awaiting Payment",
+    since="35m", history="12:00 created\n12:05 joined", completed=12, volume="£1,240", fees="£62",
+    crypto_fees="0.0012 BTC", cancelled=2, disputed=1, week_completed=80, week_volume="£9,800 (GBP)",
+    week_fees="£490 (GBP)", open=14, open_volume="£2,100 (GBP)", by_status="Awaiting Payment: 9",
+    by_coin="BTC: 6\nETH: 8",
+)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    start = timeit.default_timer()
+    messages = compile_messages(MESSAGES, fee_percent="5")
+    compiled = timeit.default_timer() - start
+    print(f"compiled {len(messages)} messages in {compiled * 1e3:.2f} ms")
+
+    release = messages["release_requested"]
+    hand = timeit.timeit(by_hand, number=n) / n
+    hand_escaped = timeit.timeit(by_hand_escaped, number=n) / n
+    templ = timeit.timeit(lambda: release.render(snapshot()), number=n) / n
+    print("release_requested, group + admin:")
+    print(f"  f-strings, unescaped:              {hand * 1e6:6.2f} us  ({1 / hand:,.0f} pairs/s)")
+    print(f"  f-strings, escaped by hand:        {hand_escaped * 1e6:6.2f} us  ({1 / hand_escaped:,.0f} pairs/s)")
+    print(f"  snapshot + compiled render:        {templ * 1e6:6.2f} us  ({1 / templ:,.0f} pairs/s)")
+
+    values = {**snapshot(), **SAMPLES}
+    missing = sorted({field for message in messages.values() for field, _ in message.keys.values()} - set(values))
+    if missing:
+        sys.exit(f"no sample value for {', '.join(missing)}; add them to SAMPLES")
+    total = 0.0
+    for message in messages.values():
+        total += timeit.timeit(lambda: message.render(values), number=n // 10) / (n // 10)
+    print(f"  whole catalogue, one render each:  {total * 1e6:6.2f} us  ({len(messages)} messages)")
+
+
+if __name__ == "__main__":
+    main()
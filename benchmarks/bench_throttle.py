@@ -0,0 +1,123 @@
+"""Cost of the flood gate, and what a flood costs the bot with and without it.
+
+    python benchmarks/bench_throttle.py [flood-updates]
+
+First times Throttle.check on its own: for a user's first update, for one
+that passes, one dropped by a user's bucket, and a duplicate button press. With a simulated
+clock it checks that a user acting every two seconds is never dropped
+while one chat's spammer is cut down to the bucket rate. Then one user
+floods a group through the real Application, with the in-process Bot API
+from bench_lifecycle. The flood is /escrow, /amount and repeated presses
+of the join button it was sent. It runs with the throttle and with the
+throttle's limits lifted, and reports time per update and Bot API calls
+(no latency, so the time is all CPU).
+"""
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from bench_lifecycle import BOT_USER, InstrumentedFake, bot  # noqa: E402
+from telegram import Update  # noqa: E402
+
+from throttle import Throttle  # noqa: E402
+
+CHAT = -10**6
+
+
+def message(update_id, chat_id, user_id, text, api=None):
+    data = {"message_id": update_id, "date": 0, "text": text, "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+    return Update.de_json({"update_id": update_id, "message": data}, api)
+
+
+def press(update_id, chat_id, user_id, data, message_id=1, api=None):
+    query = {"id": str(update_id), "chat_instance": "1", "data": data,
+             "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"},
+             "message": {"message_id": message_id, "date": 0, "from": BOT_USER,
+                         "chat": {"id": chat_id, "type": "group"}, "text": "…"}}
+    return Update.de_json({"update_id": update_id, "callback_query": query}, api)
+
+
+def per_check(throttle, updates):
+    for update in updates:  # PTB caches these on first use; every update pays that once, throttled or not
+        update.effective_user, update.effective_chat
+    start = time.perf_counter()
+    for update in updates:
+        throttle.check(update)
+    return (time.perf_counter() - start) / len(updates)
+
+
+def micro():
+    n = 50_000
+    first = [message(i, -i, i, "/escrow") for i in range(n)]  # a new user and chat each time
+    print(f"check: first update {per_check(Throttle(max_tracked=10 * n), first) * 1e9:.0f} ns, ", end="")
+    known = [message(i, -(i % 1000), i % 1000, "/escrow") for i in range(n)]  # 1,000 users within their limits
+    print(f"pass {per_check(Throttle(1e9, 10**9, 1e9, 10**9), known) * 1e9:.0f} ns, ", end="")
+    throttle = Throttle()
+    spam = [message(i, CHAT, 7, "/escrow") for i in range(n)]
+    print(f"user-limited {per_check(throttle, spam) * 1e9:.0f} ns, ", end="")
+    throttle = Throttle()
+    presses = [press(i, CHAT, 7, "join_buyer:0") for i in range(n)]
+    print(f"duplicate {per_check(throttle, presses) * 1e9:.0f} ns")
+    assert throttle.stats["duplicate"] == n - 1
+
+    now = [0.0]
+    throttle = Throttle(clock=lambda: now[0])
+    ids = itertools.count()
+    for step in range(600):  # one minute in 0.1 s steps
+        now[0] = step / 10
+        for _ in range(5):  # spammer: 50 updates a second
+            throttle.check(message(next(ids), CHAT, 7, "/amount 100"))
+        if step % 20 == 0:  # a fellow user in the same chat, every two seconds
+            assert throttle.check(message(next(ids), CHAT, 8, "/wallet bc1q")) is None
+    passed = throttle.stats["passed"] - 30
+    print(f"simulated minute: spammer sent 3,000, {passed} got through (bucket allows "
+          f"{throttle.user_burst + 60 * throttle.user_rate:.0f}); the other user was never dropped")
+
+
+async def flood(updates, limited):
+    bot.throttle = Throttle() if limited else Throttle(1e9, 10**9, 1e9, 10**9, 0)
+    telegram = InstrumentedFake(bot.metrics, latency=0)
+    app = bot.build_application(request=telegram)
+    await app.initialize()
+    await app.post_init(app)
+    ids = itertools.count(1)
+    await app.process_update(message(next(ids), CHAT, 7, "/escrow", app.bot))
+    join = telegram.buttons[CHAT]["join_buyer"]
+    flood = [(
+        message(next(ids), CHAT, 7, "/escrow", app.bot),
+        message(next(ids), CHAT, 7, "/amount 100", app.bot),
+        press(next(ids), CHAT, 7, join[0], join[1], app.bot),
+    )[i % 3] for i in range(updates)]
+    calls, passed = telegram.calls, bot.throttle.stats["passed"]
+    start = time.perf_counter()
+    for batch in range(0, updates, 500):  # 500 in flight at a time, as under concurrent_updates
+        await asyncio.gather(*(app.process_update(update) for update in flood[batch:batch + 500]))
+    elapsed = time.perf_counter() - start
+    stats = dict(bot.throttle.stats, passed=bot.throttle.stats["passed"] - passed)
+    result = (elapsed / updates, telegram.calls - calls, stats)
+    await app.post_shutdown(app)
+    await app.shutdown()
+    bot.escrows.pop(CHAT)
+    return result
+
+
+async def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 30_000
+    micro()
+    print(f"flood of {updates:,} updates from one user in one group:")
+    for limited in (False, True):
+        per_update, calls, stats = await flood(updates, limited)
+        dropped = updates - stats["passed"]
+        print(f"  {'throttled' if limited else 'unlimited'}: {per_update * 1e6:6.1f} us/update, "
+              f"{calls:,} Bot API calls, {dropped:,} dropped "
+              f"({stats['user_limited']:,} by the user bucket, {stats['duplicate']:,} duplicates)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,261 @@
+"""Deposit allocation and ChainWatcher matching against a FakeChain.
+
+    python benchmarks/bench_watcher.py [escrows] [deposits-per-poll]
+
+Opens escrows on every coin with realistic quoted amounts, each given a
+target by DepositAllocator: BTC has a small address pool, the other coins
+share one wallet and rely on dust offsets. Some escrows are planted with
+the same quote, and random quotes also collide on their own once enough
+escrows are open. Polls then run in which a batch of escrows get paid.
+Each poll also carries foreign transfers (no escrow expects that amount)
+and payments still short of MIN_CONFIRMATIONS.
+
+Checks that every payment matched its own ticket exactly once, including
+duplicate quotes, and that under-confirmed payments match once they
+confirm. Then cancels a batch of escrows and requotes the same amounts,
+to check that a cooling target is never handed out again. Reports the
+allocation cost, the offsets used, wallet requests per poll, and the
+matching cost per deposit seen against a per-escrow scan.
+
+Finally runs SHARDS allocators and watchers side by side over the same
+wallets and pool, as shards.py workers do. Every quote is opened once on
+each shard. The bench checks that no two shards hand out the same target
+and that each payment confirms exactly one escrow, on its own shard.
+
+Also checks that a deposit whose handler raises is offered again on the
+next poll rather than marked used, and that the polling task survives a
+poll that raises.
+"""
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chains import MIN_CONFIRMATIONS, ChainWatcher, FakeChain, FakeChainAdapter  # noqa: E402
+from deposits import DepositAllocator, dust_step  # noqa: E402
+from escrow import Coin, Escrow, Status  # noqa: E402
+from money import COIN_DECIMALS, from_minor, quote, to_minor  # noqa: E402
+
+START = 1_700_000_000.0
+PRICES = {"BTC": (20_000, 60_000), "ETH": (1_000, 3_500), "LTC": (40, 120), "SOL": (10, 200)}
+WALLETS = {coin: f"{coin.lower()}-escrow-wallet" for coin in PRICES}
+POOLS = {"BTC": [f"btc-pool-{i:03d}" for i in range(50)]}
+STATUSES = (Status.AWAITING_PAYMENT, Status.AWAITING_ADMIN_CONFIRMATION)
+SHARDS = 4
+
+
+def quotes(n, rng):
+    for _ in range(n):
+        coin = rng.choice(list(PRICES))
+        low, high = PRICES[coin]
+        fiat = Decimal(rng.randint(100, 500_000)).scaleb(-2)
+        yield coin, fiat, quote(fiat, Decimal(f"{rng.uniform(low, high):.2f}"), coin)
+
+
+def open_escrow(allocator, i, coin, fiat, crypto_amount, quoted_at):
+    # What bot.handle_amount does.
+    decimals = COIN_DECIMALS[coin]
+    target = allocator.allocate(f"T{i:07d}", coin, to_minor(crypto_amount, decimals))
+    return Escrow(-i, f"T{i:07d}", status=Status.AWAITING_PAYMENT, crypto=Coin(coin), fiat_amount=fiat,
+                  crypto_amount=from_minor(target.units, decimals), deposit_address=target.address,
+                  quoted_at=quoted_at)
+
+
+def units_of(escrow):
+    return to_minor(escrow.crypto_amount, COIN_DECIMALS[escrow.crypto])
+
+
+def scan(escrows, deposits):
+    # The naive alternative: every open escrow compared with every deposit.
+    return sum(1 for deposit in deposits for escrow in escrows
+               if escrow.crypto == deposit.coin and escrow.deposit_address == deposit.address
+               and units_of(escrow) == deposit.units)
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    per_poll = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = random.Random(11)
+    clock = [START]
+    chain = FakeChain(clock=lambda: clock[0])
+    adapters = {coin: FakeChainAdapter(chain, coin) for coin in PRICES}
+    allocator = DepositAllocator(WALLETS, POOLS, clock=lambda: clock[0])
+    watcher = ChainWatcher(adapters, allocator, STATUSES, interval=0)
+    matched = {}
+
+    async def handler(ticket, deposit):
+        assert ticket not in matched, f"{ticket} matched twice"
+        matched[ticket] = deposit.txid
+        escrow = by_ticket[ticket]
+        escrow.status = Status.PAYMENT_CONFIRMED
+        watcher.track(escrow)
+
+    watcher.handler = handler
+    wanted = list(quotes(n, rng))
+    for i in range(0, 40, 2):  # planted duplicates
+        wanted[i + 1] = wanted[i]
+    start = time.perf_counter()
+    escrows = [open_escrow(allocator, i, *q, START) for i, q in enumerate(wanted)]
+    for escrow in escrows:
+        watcher.track(escrow)
+    allocated = time.perf_counter() - start
+    by_ticket = {escrow.ticket: escrow for escrow in escrows}
+    offsets = [(units_of(e) - to_minor(q[2], COIN_DECIMALS[q[0]])) // dust_step(q[0])
+               for e, q in zip(escrows, wanted)]
+
+    unpaid = list(escrows)
+    rng.shuffle(unpaid)
+    pending = []
+    polls = elapsed = naive = seen = 0
+    while unpaid:
+        batch, unpaid = unpaid[:per_poll], unpaid[per_poll:]
+        for escrow in batch:
+            coin = escrow.crypto
+            if rng.random() < 0.1:
+                # Seen in the mempool first; confirms by the next poll.
+                pending.append(chain.pay(coin, escrow.deposit_address, units_of(escrow)))
+            else:
+                chain.pay(coin, escrow.deposit_address, units_of(escrow), MIN_CONFIRMATIONS[coin] + rng.randrange(5))
+        for _ in range(per_poll // 10):
+            coin = rng.choice(list(PRICES))
+            chain.pay(coin, WALLETS[coin], rng.randrange(10**6, 10**9) * 10 + 7, MIN_CONFIRMATIONS[coin])
+        clock[0] += 30
+        deposits = list(chain.txs.values())
+        requests = sum(adapter.calls for adapter in adapters.values())
+        start = time.perf_counter()
+        await watcher.poll()
+        elapsed += time.perf_counter() - start
+        seen += len(deposits)
+        polls += 1
+        if polls == 1:
+            first_requests = sum(adapter.calls for adapter in adapters.values()) - requests
+            start = time.perf_counter()
+            scan(escrows, deposits)  # all still open when the first poll sees them
+            naive = (time.perf_counter() - start) / len(deposits)
+        for txid in pending:
+            chain.confirm(txid, MIN_CONFIRMATIONS[chain.txs[txid].coin])
+        pending = []
+    await watcher.poll()
+    polls += 1
+
+    assert matched.keys() == by_ticket.keys(), "a payment was missed"
+    for ticket, txid in matched.items():
+        deposit, escrow = chain.txs[txid], by_ticket[ticket]
+        assert (deposit.coin, deposit.address, deposit.units) == (escrow.crypto, escrow.deposit_address, units_of(escrow))
+    assert len(set(matched.values())) == len(matched), "a deposit paid two escrows"
+    assert not allocator, "confirmed escrows kept their targets"
+
+    # Requoting what was just released must not reuse a target within the cooldown.
+    released = {(e.crypto, e.deposit_address, units_of(e)) for e in escrows[:1000]}
+    again = [open_escrow(allocator, n + i, *q, clock[0]) for i, q in enumerate(wanted[:1000])]
+    assert not released & {(e.crypto, e.deposit_address, units_of(e)) for e in again}, "cooling target reused"
+
+    print(f"{n:,} open escrows, {per_poll:,} payments per poll, {len(chain.txs):,} deposits on chain")
+    print(f"  allocate + index: {allocated / n * 1e6:.2f} us/escrow, "
+          f"{sum(1 for o in offsets if o):,} given a dust offset (largest {max(offsets)} steps)")
+    print(f"  {polls} polls, {first_requests} wallet requests on the first (one per address with escrows waiting)")
+    print(f"  matching: {elapsed / seen * 1e6:.2f} us per deposit seen; per-escrow scan: {naive * 1e6:,.0f} us")
+    print(f"  stats: {watcher.stats}")
+    print(f"  matched {len(matched):,} of {n:,} paid escrows; 1,000 requotes after release got fresh targets")
+    await sharded(min(n, 20_000), rng)
+    await failures(rng)
+
+
+async def failures(rng):
+    clock = [START]
+    chain = FakeChain(clock=lambda: clock[0])
+    allocator = DepositAllocator(WALLETS, POOLS, clock=lambda: clock[0])
+    watcher = ChainWatcher({coin: FakeChainAdapter(chain, coin) for coin in PRICES}, allocator, STATUSES, interval=0)
+    escrows = [open_escrow(allocator, i, *q, START) for i, q in enumerate(quotes(20, rng))]
+    for escrow in escrows:
+        watcher.track(escrow)
+        chain.pay(escrow.crypto, escrow.deposit_address, units_of(escrow), MIN_CONFIRMATIONS[escrow.crypto])
+    by_ticket = {escrow.ticket: escrow for escrow in escrows}
+    attempts, matched = {}, set()
+
+    async def handler(ticket, deposit):
+        attempts[ticket] = attempts.get(ticket, 0) + 1
+        if attempts[ticket] == 1 and len(attempts) % 2:
+            raise RuntimeError("Telegram is down")  # what a failed send in payment_detected looks like
+        matched.add(ticket)
+        by_ticket[ticket].status = Status.PAYMENT_CONFIRMED
+        watcher.track(by_ticket[ticket])
+
+    logging.getLogger("chains").setLevel(logging.CRITICAL)  # the failures below are logged on purpose
+    clock[0] += 30
+    watcher.handler = handler
+    await watcher.poll()
+    failed = watcher.stats["errors"]
+    assert failed and len(matched) == len(escrows) - failed, "a failed handler was not counted"
+    await watcher.poll()
+    assert matched == by_ticket.keys(), "a deposit whose handler failed was not offered again"
+
+    polls = watcher.poll
+    broken = [True]
+
+    async def poll():
+        if broken.pop() if broken else False:
+            raise RuntimeError("poll failed")
+        await polls()
+
+    watcher.poll = poll
+    watcher.start(handler)
+    for _ in range(5):
+        await asyncio.sleep(0)
+    alive = not watcher._worker.done()
+    await watcher.stop()
+    assert alive, "a failing poll stopped the watcher"
+    print(f"  handler failures: {failed} of {len(escrows)} deposits retried and matched on the next poll; "
+          f"polling survived a failed poll")
+
+
+
+async def sharded(n, rng):
+    clock = [START]
+    chain = FakeChain(clock=lambda: clock[0])
+    allocators = [DepositAllocator(WALLETS, POOLS, clock=lambda: clock[0], shard=shard, shards=SHARDS)
+                  for shard in range(SHARDS)]
+    matched = {}  # ticket -> (shard, txid)
+    escrows = {}  # ticket -> (shard, escrow)
+    watchers = []
+    for shard, allocator in enumerate(allocators):
+        watcher = ChainWatcher({coin: FakeChainAdapter(chain, coin) for coin in PRICES}, allocator, STATUSES, interval=0)
+
+        async def handler(ticket, deposit, shard=shard, watcher=watcher):
+            assert ticket not in matched, f"{ticket} matched twice"
+            matched[ticket] = (shard, deposit.txid)
+            escrows[ticket][1].status = Status.PAYMENT_CONFIRMED
+            watcher.track(escrows[ticket][1])
+
+        watcher.handler = handler
+        watchers.append(watcher)
+    i = 0
+    for q in quotes(n // SHARDS, rng):  # the same quote on every shard: the worst case for collisions
+        for shard, allocator in enumerate(allocators):
+            escrow = open_escrow(allocator, i, *q, START)
+            watchers[shard].track(escrow)
+            escrows[escrow.ticket] = (shard, escrow)
+            i += 1
+    targets = {(e.crypto, e.deposit_address, units_of(e)) for _, e in escrows.values()}
+    assert len(targets) == len(escrows), "two shards handed out the same target"
+    for _, escrow in escrows.values():
+        chain.pay(escrow.crypto, escrow.deposit_address, units_of(escrow), MIN_CONFIRMATIONS[escrow.crypto])
+    clock[0] += 30
+    for watcher in watchers:
+        await watcher.poll()
+    assert matched.keys() == escrows.keys(), "a payment was missed"
+    assert all(escrows[ticket][0] == shard for ticket, (shard, _) in matched.items()), "matched on the wrong shard"
+    assert len({txid for _, txid in matched.values()}) == len(matched), "a deposit paid two escrows"
+    unmatched = sum(watcher.stats["unmatched"] for watcher in watchers)
+    print(f"  {SHARDS} shards, {len(escrows):,} escrows ({n // SHARDS:,} quotes opened on every shard): "
+          f"all targets distinct, each payment matched once on its own shard "
+          f"({unmatched:,} sightings of other shards' deposits ignored)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
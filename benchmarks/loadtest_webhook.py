@@ -0,0 +1,277 @@
+"""Replay synthetic Updates against bot.py in webhook or polling mode, fully offline.
+
+    python benchmarks/loadtest_webhook.py --mode webhook --groups 200 --concurrency 50
+    python benchmarks/loadtest_webhook.py --mode polling --groups 200
+    python benchmarks/loadtest_webhook.py --mode webhook --groups 200 --shards 4
+
+The script starts a fake Bot API server, then launches bot.py pointed at it
+with TELEGRAM_API_URL. It then delivers four updates per trade group:
+/escrow, join_buyer, join_seller and crypto_BTC. In webhook mode it POSTs
+them to the bot's listener with the secret token. In polling mode it serves
+them from getUpdates. With --shards the script launches shards.py instead,
+which routes the same updates across worker processes. Groups run concurrently and each group's updates are
+sent in order, the next one after the previous is handled. An update counts
+as handled when the bot acknowledges it: answerCallbackQuery for a button
+press, or the reply to a /escrow message. With --metrics the bot also
+serves METRICS_PORT, which is scraped before shutdown for the per-handler,
+per-API-method and per-fanout-send latencies it recorded.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+ADMIN_GROUP_ID = -1000000000001
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegram:
+    def __init__(self, latency):
+        self.latency = latency
+        self.pending = []  # updates waiting for getUpdates
+        self.available = asyncio.Event()
+        self.sent_at = {}  # ack key -> time the update was handed to the bot
+        self.done_at = {}  # ack key -> time the bot acknowledged it
+        self.waiters = {}  # ack key -> future resolved on acknowledgement
+        self.calls = 0
+        self.update_seq = 0
+        self.closing = False
+        self.next_message_id = 10_000_000
+
+    def ack(self, key):
+        if key in self.sent_at and key not in self.done_at:
+            self.done_at[key] = time.monotonic()
+            waiter = self.waiters.pop(key, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+    def expect(self, key):
+        self.waiters[key] = asyncio.get_running_loop().create_future()
+        return self.waiters[key]
+
+    async def call(self, method, params):
+        self.calls += 1
+        if method == "getUpdates":
+            return await self.get_updates(params)
+        await asyncio.sleep(self.latency)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_escrow_bot"}
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "U", "username": f"u{user_id}"}}
+        if method == "answerCallbackQuery":
+            self.ack(("cb", params["callback_query_id"]))
+            return True
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            if "reply_to_message_id" in params:
+                self.ack(("msg", chat_id, int(params["reply_to_message_id"])))
+            self.next_message_id += 1
+            return {"message_id": self.next_message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "g"}, "text": params.get("text", "")}
+        return True
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending and not self.closing:
+            self.available.clear()
+            try:
+                await asyncio.wait_for(self.available.wait(), timeout=float(params.get("timeout", 0)) or 0.01)
+            except asyncio.TimeoutError:
+                return []
+        batch = self.pending[:int(params.get("limit", 100))]
+        now = time.monotonic()
+        for update in batch:
+            self.sent_at.setdefault(ack_key(update), now)
+        return batch
+
+
+def ack_key(update):
+    if "callback_query" in update:
+        return ("cb", update["callback_query"]["id"])
+    message = update["message"]
+    return ("msg", message["chat"]["id"], message["message_id"])
+
+
+class BotApiHandler(RequestHandler):
+    def initialize(self, fake):
+        self.fake = fake
+
+    async def post(self, token, method):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            params = {k: v[0].decode() for k, v in self.request.body_arguments.items()}
+            params = {k: _maybe_json(v) for k, v in params.items()}
+        result = await self.fake.call(method, params)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+
+def _maybe_json(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def synthetic_updates(groups):
+    updates = []
+    update_id = 1
+    now = int(time.time())
+    for g in range(groups):
+        chat = {"id": -(2_000_000 + g), "type": "supergroup", "title": f"trade {g}"}
+        buyer = {"id": 10_000 + 2 * g, "is_bot": False, "first_name": "B", "username": f"buyer{g}"}
+        seller = {"id": 10_001 + 2 * g, "is_bot": False, "first_name": "S", "username": f"seller{g}"}
+        updates.append({"update_id": update_id, "message": {
+            "message_id": 1, "date": now, "chat": chat, "from": buyer, "text": "/escrow",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 7}]}})
+        update_id += 1
+        # Keyboard versions as the bot assigns them: 1 for the /escrow join keyboard, 2 for the crypto picker.
+        for user, data in ((buyer, "join_buyer:1"), (seller, "join_seller:1"), (buyer, "crypto_BTC:2")):
+            updates.append({"update_id": update_id, "callback_query": {
+                "id": f"{g}-{data}", "from": user, "chat_instance": str(g), "data": data,
+                "message": {"message_id": 2, "date": now, "chat": chat, "text": "x"}}})
+            update_id += 1
+    return updates
+
+
+async def wait_until_listening(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"bot did not start listening on {port}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="trade groups in flight")
+    parser.add_argument("--concurrent-updates", type=int, default=64, help="bot CONCURRENT_UPDATES")
+    parser.add_argument("--shards", type=int, default=0, help="run shards.py with this many workers")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Bot API latency (s)")
+    parser.add_argument("--metrics", action="store_true", help="scrape the bot's /metrics endpoint at the end")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.api_latency)
+    api_port, hook_port = free_port(), free_port()
+    server = HTTPServer(Application([(r"/bot([^/]+)/(\w+)", BotApiHandler, {"fake": fake})]))
+    server.listen(api_port, "127.0.0.1")
+
+    secret = "loadtest-secret"
+    env = dict(os.environ, TOKEN="123456:LOADTEST", ADMIN_GROUP_ID=str(ADMIN_GROUP_ID), ESCROW_DB="", AUDIT_DIR="",
+               TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}/bot", BOT_MODE=args.mode,
+               CONCURRENT_UPDATES=str(args.concurrent_updates), WEBHOOK_LISTEN="127.0.0.1",
+               WEBHOOK_PORT=str(hook_port), WEBHOOK_SECRET=secret, WEBHOOK_URL=f"http://127.0.0.1:{hook_port}")
+    metrics_port = free_port() if args.metrics else 0
+    env["METRICS_PORT"] = str(metrics_port)
+    entry = "bot.py"
+    if args.shards:
+        env["SHARDS"] = str(args.shards)
+        entry = "shards.py"
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, entry)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=None if os.environ.get("LOADTEST_DEBUG") else subprocess.DEVNULL)
+    try:
+        updates = synthetic_updates(args.groups)
+        per_group = [updates[i * 4:(i + 1) * 4] for i in range(args.groups)]
+        ingest = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+        url = f"http://127.0.0.1:{hook_port}/telegram"
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency), timeout=30) as client:
+            if args.mode == "webhook":
+                await wait_until_listening(hook_port)
+                rejected = await client.post(url, json=updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                print(f"wrong secret -> HTTP {rejected.status_code}")
+            else:
+                while fake.calls == 0:
+                    await asyncio.sleep(0.1)
+
+            async def deliver(update):
+                key = ack_key(update)
+                handled = fake.expect(key)
+                if args.mode == "webhook":
+                    fake.sent_at[key] = start = time.monotonic()
+                    response = await client.post(url, json=update, headers=headers)
+                    response.raise_for_status()
+                    ingest.append(time.monotonic() - start)
+                else:
+                    # getUpdates confirms by offset, so ids must grow in delivery order.
+                    fake.update_seq += 1
+                    fake.pending.append(dict(update, update_id=fake.update_seq))
+                    fake.available.set()
+                await asyncio.wait_for(handled, timeout=30)
+
+            async def trade(group):
+                async with semaphore:
+                    for update in group:
+                        await deliver(update)
+
+            started = time.monotonic()
+            await asyncio.gather(*(trade(group) for group in per_group))
+            elapsed = time.monotonic() - started
+            scraped = (await client.get(f"http://127.0.0.1:{metrics_port}/metrics")).text if metrics_port else ""
+    finally:
+        fake.closing = True
+        fake.available.set()  # release a parked long poll so the bot can stop promptly
+        proc.send_signal(signal.SIGINT)
+        try:
+            # Keep serving the fake API while the bot drains its in-flight sends.
+            await asyncio.to_thread(proc.wait, 15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        server.stop()
+
+    latencies = sorted(fake.done_at[key] - fake.sent_at[key] for key in fake.done_at)
+    print(f"mode={args.mode} shards={args.shards or 1} updates={len(updates)} concurrent_updates={args.concurrent_updates} "
+          f"api_latency={args.api_latency * 1e3:.0f}ms")
+    print(f"  throughput: {len(updates) / elapsed:,.0f} updates/s")
+    print(f"  update -> ack: p50 {latencies[len(latencies) // 2] * 1e3:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.1f} ms")
+    if ingest:
+        ingest.sort()
+        print(f"  webhook POST: p50 {ingest[len(ingest) // 2] * 1e3:.1f} ms, p99 {ingest[int(len(ingest) * 0.99)] * 1e3:.1f} ms")
+    if scraped:
+        print_metrics(scraped)
+
+
+def print_metrics(text):
+    series = {}  # (metric, label) -> {"count": n, "sum": s}
+    for line in text.splitlines():
+        name, _, value = line.rpartition(" ")
+        for metric in ("handler_seconds", "bot_api_seconds", "send_seconds", "job_seconds"):
+            for part in ("count", "sum"):
+                prefix = f"k1_{metric}_{part}{{"
+                if name.startswith(prefix):
+                    series.setdefault((metric, name[len(prefix):-1]), {})[part] = float(value)
+    print("  recorded by the bot (mean per call):")
+    for (metric, label), values in sorted(series.items()):
+        if values.get("count"):
+            print(f"    {metric:<16} {label:<40} {values['count']:>7,.0f} x {values['sum'] / values['count'] * 1e3:7.2f} ms")
+    errors = [line for line in text.splitlines() if "_errors_total" in line]
+    print("  errors: " + (", ".join(errors) if errors else "none"))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,45 @@
+import asyncio
 import os
 import logging
+import time
+from contextlib import asynccontextmanager
 from uuid import uuid4
-import requests
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    CallbackContext,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters
 )
+from decimal import Decimal
+from assets import ASSETS
+from audit import AuditLog, NoAuditLog
+from chains import ChainWatcher, EsploraAdapter, EtherscanAdapter, SolanaAdapter
+from deposits import DepositAllocator
+from escrow import Coin, Escrow, Status
+from expiry import ExpiryScheduler, fmt_duration
+from keyboards import TAGGED, KeyboardSweeper, tag, untag, version_of
+from metrics import InstrumentedRequest, Metrics
+from money import COIN_DECIMALS, fees, fmt_crypto, fmt_fiat, from_minor, parse_fiat, quote, to_minor
+from prices import PriceOracle
+from notify import Notifier, chain
+from outbox import HIGH, LOW, NORMAL, Outbox
+from registry import EscrowRegistry
+from stats import TradeStats
+from states import (
+    AWAITING_ADMIN_CONFIRMATION, AWAITING_ADMIN_RELEASE, AWAITING_AMOUNT, AWAITING_BUYER_ACTION, AWAITING_PAYMENT,
+    AWAITING_SELLER_WALLET, ANYONE, NEW, SYSTEM, callback_action, resolve, roles_of
+)
+from store import MemoryStore, SQLiteStore
+from templates import MESSAGES, compile_messages
+from throttle import Throttle
+from usernames import UsernameCache
 
 # ---------------- CONFIG ----------------
 TOKEN = os.environ.get("TOKEN")
@@ -20,110 +49,150 @@ if ADMIN_GROUP_ID is None:
     exit(1)
 ADMIN_GROUP_ID = int(ADMIN_GROUP_ID)
 
-ESCROW_WALLETS = {
-    "BTC": os.environ.get("BTC_WALLET"),
-    "ETH": os.environ.get("ETH_WALLET"),
-    "LTC": os.environ.get("LTC_WALLET"),
-    "SOL": os.environ.get("SOL_WALLET")
-}
-
-FIAT_CURRENCY = "gbp"
-FEE_RATE = 0.05  # 5% fee
-FIAT_SYMBOL = "£"
-FIAT_LABEL = "GBP"  # will display as "£amount (GBP)"
+# Coins and fiat currencies come from the asset registry: ASSETS_FILE, or assets.DEFAULT_ASSETS (GBP; BTC, ETH, LTC, SOL).
+# Wallets are BTC_WALLET etc. Optional pools of pre-derived deposit addresses, comma separated, e.g.
+# BTC_ADDRESS_POOL=bc1q...,bc1q... Without one, trades on a coin share its wallet and are told apart by a dust
+# offset on the amount.
+ESCROW_WALLETS = ASSETS.wallets
+DEPOSIT_POOLS = ASSETS.pools
+# "index/count", set by shards.py so its workers share wallets and pools without sharing a deposit target.
+DEPOSIT_SHARD, DEPOSIT_SHARDS = (int(n) for n in os.environ.get("SHARD", "0/1").split("/"))
+
+FEE_RATE = Decimal("0.05")  # 5% fee
+PRICE_CACHE_TTL = float(os.environ.get("PRICE_CACHE_TTL", 30))  # seconds a quote price stays fresh
+ESCROW_DB = os.environ.get("ESCROW_DB", "escrows.db")  # empty string = keep escrows in memory only
+AUDIT_DIR = os.environ.get("AUDIT_DIR", "audit")  # append-only log of every escrow event; empty string = off
+
+CHAIN_WATCH = os.environ.get("CHAIN_WATCH", "0") == "1"  # confirm payments from on-chain deposits to ESCROW_WALLETS
+CHAIN_POLL_INTERVAL = float(os.environ.get("CHAIN_POLL_INTERVAL", 30))  # seconds between polls of each wallet
+BTC_ESPLORA_URL = os.environ.get("BTC_ESPLORA_URL", "https://blockstream.info/api")
+LTC_ESPLORA_URL = os.environ.get("LTC_ESPLORA_URL", "https://litecoinspace.org/api")
+ETHERSCAN_URL = os.environ.get("ETHERSCAN_URL", "https://api.etherscan.io/api")
+ETHERSCAN_API_KEY = os.environ.get("ETHERSCAN_API_KEY")
+SOLANA_RPC_URL = os.environ.get("SOLANA_RPC_URL", "https://api.mainnet-beta.solana.com")
+
+# Incoming update limits; excess updates are dropped before any handler runs. The admin group is exempt.
+USER_RATE_LIMIT = float(os.environ.get("USER_RATE_LIMIT", 1))  # updates/second per user, in bursts of USER_BURST
+USER_BURST = int(os.environ.get("USER_BURST", 8))
+CHAT_RATE_LIMIT = float(os.environ.get("CHAT_RATE_LIMIT", 3))  # updates/second per chat, in bursts of CHAT_BURST
+CHAT_BURST = int(os.environ.get("CHAT_BURST", 20))
+DEDUPE_WINDOW = float(os.environ.get("DEDUPE_WINDOW", 1))  # seconds a repeated identical button press is ignored
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # serve Prometheus metrics on /metrics; 0 = off
+
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" or "webhook"
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 1))  # updates processed at once
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # e.g. http://127.0.0.1:8081/bot for a local Bot API server
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL Telegram posts updates to
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", 8443)))  # PORT as set by PaaS hosts
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    print("WEBHOOK_SECRET not set! Refusing to accept unauthenticated webhook updates.")
+    exit(1)
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    print("WEBHOOK_URL not set! Telegram would have nowhere to send updates.")
+    exit(1)
 
 # ---------------- DATA ----------------
-escrows = {}  # key: chat_id -> escrow dict
+escrows = EscrowRegistry(SQLiteStore(ESCROW_DB) if ESCROW_DB else MemoryStore())  # chat_id -> Escrow, indexed by ticket/buyer/seller
+audit_log = AuditLog(AUDIT_DIR) if AUDIT_DIR else NoAuditLog()  # every transition, kept after the escrow closes
+price_oracle = PriceOracle(ASSETS.price_ids, ASSETS.fiats, ttl=PRICE_CACHE_TTL)  # (coin, fiat) -> price
+usernames = UsernameCache()  # (chat_id, user_id) -> username
+outbox = Outbox()  # rate-limited queue for ADMIN_GROUP_ID notices and keyboard clean-up
+sweeper = KeyboardSweeper()  # strips superseded group keyboards through the outbox
+expiry = ExpiryScheduler()  # per-status deadlines for stalled trades, see expiry.POLICIES
+chain_adapters = {
+    "BTC": EsploraAdapter("BTC", BTC_ESPLORA_URL),
+    "LTC": EsploraAdapter("LTC", LTC_ESPLORA_URL),
+    "ETH": EtherscanAdapter(ETHERSCAN_URL, ETHERSCAN_API_KEY),
+    "SOL": SolanaAdapter(SOLANA_RPC_URL),
+} if CHAIN_WATCH else {}
+chain_adapters = {coin: adapter for coin, adapter in chain_adapters.items() if coin in ASSETS.coins}
+allocator = DepositAllocator(  # one distinct address/amount per open trade
+    ESCROW_WALLETS, DEPOSIT_POOLS, shard=DEPOSIT_SHARD, shards=DEPOSIT_SHARDS, store=escrows.store
+)
+watcher = ChainWatcher(  # matches deposits to the target allocated to each escrow awaiting payment
+    {coin: adapter for coin, adapter in chain_adapters.items() if ESCROW_WALLETS.get(coin) or DEPOSIT_POOLS[coin]},
+    allocator, (AWAITING_PAYMENT, AWAITING_ADMIN_CONFIRMATION), interval=CHAIN_POLL_INTERVAL, store=escrows.store
+)
+metrics = Metrics()  # handler/Bot API latency histograms, error counts and queue depths
+notifier = Notifier(metrics)  # concurrent sends of one transition, timed per label
+trade_stats = TradeStats(FEE_RATE)  # open/closed aggregates for the admin commands
+throttle = Throttle(USER_RATE_LIMIT, USER_BURST, CHAT_RATE_LIMIT, CHAT_BURST, DEDUPE_WINDOW, exempt_chats=(ADMIN_GROUP_ID,))
+messages = compile_messages(MESSAGES, fee_percent=f"{(FEE_RATE * 100).normalize():f}")
 
 # ---------------- HELPERS ----------------
 def create_new_escrow(chat_id):
-    ticket = str(uuid4())[:8].upper()
-    escrow = {
-        "group_id": chat_id,
-        "buyer_id": None,
-        "seller_id": None,
-        "status": None,
-        "crypto": None,
-        "fiat_amount": None,
-        "crypto_amount": None,
-        "wallet_address": None,
-        "ticket": ticket,
-        "buyer_confirmed": False,
-        "seller_confirmed": False,
-        "goods_sent": False,
-        "goods_received": False,
-        "disputed": False,
-        "latest_message_id": None
-    }
-    escrows[chat_id] = escrow
+    escrow = escrows.add(Escrow(group_id=chat_id, ticket=str(uuid4())[:8].upper(), status_since=expiry.clock()))
+    trade_stats.track(escrow)
+    audit_log.record(escrow, "create", ANYONE)
     return escrow
 
 def create_escrow_buttons(escrow):
+    version = escrow.keyboard_version
     buttons = []
-    if not escrow["buyer_id"]:
-        buttons.append([InlineKeyboardButton("Join as Buyer 💷", callback_data="join_buyer")])
-    if not escrow["seller_id"]:
-        buttons.append([InlineKeyboardButton("Join as Seller 📦", callback_data="join_seller")])
-    if escrow["status"] is None:
-        buttons.append([InlineKeyboardButton("Cancel ❌", callback_data="cancel_escrow")])
+    if not escrow.buyer_id:
+        buttons.append([InlineKeyboardButton("Join as Buyer 💷", callback_data=tag("join_buyer", version))])
+    if not escrow.seller_id:
+        buttons.append([InlineKeyboardButton("Join as Seller 📦", callback_data=tag("join_seller", version))])
+    if escrow.status is NEW:
+        buttons.append([InlineKeyboardButton("Cancel ❌", callback_data=tag("cancel_escrow", version))])
     return InlineKeyboardMarkup(buttons)
 
 def create_buttons(items):
     return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=cb)] for text, cb in items])
 
-def get_crypto_price(symbol):
-    symbol_mapping = {
-        "BTC": "bitcoin",
-        "ETH": "ethereum",
-        "LTC": "litecoin",
-        "SOL": "solana"
-    }
-    coingecko_symbol = symbol_mapping.get(symbol.upper())
-    if not coingecko_symbol:
-        return None
+def escrow_buttons(escrow, items):
+    # Group keyboards carry the escrow's keyboard version so superseded ones can be told apart.
+    return create_buttons([(text, tag(cb, escrow.keyboard_version)) for text, cb in items])
+
+def snapshot(escrow: Escrow, buyer=None, seller=None, **extra):
+    # One set of formatted fields feeds every variant of a message.
+    currency = ASSETS.fiat(escrow.fiat)
+    values = {"ticket": escrow.ticket, "coin": escrow.crypto, "buyer": buyer, "seller": seller,
+              "wallet": escrow.wallet_address, "fiat": currency.symbol, "fiat_label": currency.code, **extra}
+    if escrow.fiat_amount is not None:
+        fiat = fees(escrow.fiat_amount, currency.decimals, FEE_RATE)
+        crypto = fees(escrow.crypto_amount, COIN_DECIMALS[escrow.crypto], FEE_RATE)
+        values.update(
+            amount=fmt_fiat(escrow.fiat_amount, currency.decimals),
+            crypto_amount=fmt_crypto(escrow.crypto_amount),
+            fee=fmt_fiat(fiat.fee, currency.decimals),
+            payout=fmt_fiat(fiat.payout, currency.decimals),
+            payout_crypto=fmt_crypto(crypto.payout)
+        )
+    return values
+
+async def party_usernames(context: ContextTypes.DEFAULT_TYPE, escrow: Escrow):
+    return await usernames.get_many(context.bot, escrow.group_id, (escrow.buyer_id, escrow.seller_id))
+
+async def known_username(bot, chat_id, user_id, recorded=None):
+    # Best effort for admin views and expiry: the party may not have joined, or may have left the group, or the bot
+    # may have been removed from it. Names recorded at join time come first, so no lookup is needed for them.
+    if recorded or user_id is None:
+        return recorded
     try:
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={coingecko_symbol}&vs_currencies={FIAT_CURRENCY}"
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        price = data.get(coingecko_symbol, {}).get(FIAT_CURRENCY)
-        return price
-    except:
+        return await usernames.get(bot, chat_id, user_id)
+    except TelegramError:
         return None
 
-def fmt_auto(number):
-    try:
-        n = float(number)
-    except Exception:
-        return str(number)
-    if abs(n - round(n)) < 1e-9:
-        return f"{int(round(n))}"
-    else:
-        return f"{n:.2f}"
+def retire_keyboards(escrow: Escrow):
+    # New version first: every button already posted goes stale at once, the sweeper removes them later.
+    escrow.keyboard_version += 1
+    sweeper.retire(escrow.group_id, escrow.keyboards)
+    escrow.keyboards = []
 
-def fmt_crypto(number):
-    try:
-        n = float(number)
-    except Exception:
-        return str(number)
-    s = f"{n:.8f}".rstrip('0').rstrip('.')
-    if '.' not in s:
-        return s
-    dec_part = s.split('.', 1)[1]
-    if len(dec_part) == 1:
-        return f"{s}0"
-    return s
-
-async def clear_previous_buttons(context: ContextTypes.DEFAULT_TYPE, escrow: dict):
-    if escrow.get("latest_message_id"):
-        try:
-            await context.bot.edit_message_reply_markup(
-                chat_id=escrow["group_id"],
-                message_id=escrow["latest_message_id"],
-                reply_markup=None
-            )
-        except:
-            pass
+def track_keyboard(escrow: Escrow, message):
+    escrow.keyboards.append(message.message_id)
+    escrows.save(escrow)
+
+def forget_keyboard(escrow: Escrow, message):
+    # For keyboards a handler empties itself in the same step.
+    if message.message_id in escrow.keyboards:
+        escrow.keyboards.remove(message.message_id)
 
 # ---------------- COMMANDS ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -135,204 +204,212 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def escrow_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    if chat_id not in escrows:
-        create_new_escrow(chat_id)
-    escrow = escrows[chat_id]
-    await update.message.reply_text(
+    escrow = escrows.get(chat_id) or create_new_escrow(chat_id)
+    joining = escrow.status is NEW
+    if joining:
+        retire_keyboards(escrow)  # an earlier join keyboard in this chat
+    sent = await update.message.reply_text(
         "Both select your role to start escrow 👇",
         reply_markup=create_escrow_buttons(escrow)
     )
+    if joining:
+        track_keyboard(escrow, sent)
+
+# ---------------- TRANSITIONS ----------------
+@asynccontextmanager
+async def locked_transition(escrow: Escrow, action: str, roles):
+    # Cheap pre-check so double taps and stale buttons are rejected without queueing on the lock.
+    if resolve(escrow, action, roles) is None:
+        yield None
+        return
+    async with escrows.lock(escrow):
+        yield resolve(escrow, action, roles)
+
+def advance(escrow: Escrow, transition):
+    escrow.status = transition.target
+    escrow.status_since = expiry.clock()
+    escrow.expiry_step = 0
+    expiry.track(escrow)
+    watcher.track(escrow)
+    trade_stats.track(escrow)
+    audit_log.record(escrow, transition.action, transition.role)
+    escrows.save(escrow)
 
 # ---------------- CALLBACK HANDLERS ----------------
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before everything, the stale-button check included. Dropped updates get no reply: no network I/O for a flood.
+    if throttle.check(update) is not None:
+        raise ApplicationHandlerStop
+
+async def reject_stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler: a button from a superseded keyboard costs one dict lookup.
+    query = update.callback_query
+    chat_id = query.message.chat.id
+    escrow = escrows.get(chat_id)
+    if escrow is not None and version_of(query.data) == escrow.keyboard_version:
+        return
+    sweeper.stats["stale"] += 1
+    sweeper.retire(chat_id, (query.message.message_id,))
+    await query.answer("This button has expired.")
+    raise ApplicationHandlerStop
+
 async def handle_admin_payment_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
-    await query.answer()
-    parts = data.split("_")
-    if len(parts) < 3:
-        return
-    action = parts[1]
-    ticket = "_".join(parts[2:])
-    payment_ok = action == "received"
-    escrow = next((e for e in escrows.values() if e["ticket"] == ticket), None)
+    parts = data.split("_", 2)
+    escrow = escrows.by_ticket(parts[2]) if len(parts) == 3 else None
     if not escrow:
+        await query.answer()
         return
-    chat_id = escrow["group_id"]
-    buyer_id = escrow["buyer_id"]
-    seller_id = escrow["seller_id"]
-    buyer_username = (await context.bot.get_chat_member(chat_id, buyer_id)).user.username
-    seller_username = (await context.bot.get_chat_member(chat_id, seller_id)).user.username
-    await clear_previous_buttons(context, escrow)
-
-    if payment_ok:
-        escrow["status"] = "payment_confirmed"
-        escrow["buyer_confirmed"] = True
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Payment Confirmed ✅\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {escrow['crypto']}\n"
-            f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n📄 Action: Payment confirmed by admin",
-            parse_mode="Markdown"
-        )
-        msg = await context.bot.send_message(
-            chat_id,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Payment Confirmed ✅\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {escrow['crypto']}\n"
-            "📄 Action: Seller can now send goods/services to buyer\n"
-            "👇 Response: Confirm below when done",
-            reply_markup=create_buttons([
-                ("I've sent the goods/services ✅", "seller_sent_goods")
-            ])
-        )
-        escrow["latest_message_id"] = msg.message_id
+    roles = roles_of(escrow, query.from_user.id, query.message.chat.id == ADMIN_GROUP_ID)
+    async with locked_transition(escrow, callback_action(data), roles) as transition:
+        await query.answer()
+        if transition is None:
+            return
+        await confirm_payment(context, escrow, transition)
+
+async def confirm_payment(context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition, name=None, **extra):
+    chat_id = escrow.group_id
+    buyer_username, seller_username = await party_usernames(context, escrow)
+
+    if transition.action == "payment_received":
+        escrow.buyer_confirmed = True
+        retire_keyboards(escrow)
+        buttons = escrow_buttons(escrow, [
+            ("I've sent the goods/services ✅", "seller_sent_goods")
+        ])
     else:
-        escrow["status"] = "awaiting_payment"
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Payment ❌\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {escrow['crypto']}\n"
-            f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n📄 Action: Payment not received",
-            parse_mode="Markdown"
-        )
-        msg = await context.bot.send_message(
-            chat_id,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Payment ❌\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n"
-            "📄 Response: Payment has not yet been received. You will receive a message once it has confirmed on our system."
-        )
-        escrow["latest_message_id"] = msg.message_id
+        # The buyer's "I've Paid" keyboard stays live so they can mark the payment again.
+        buttons = None
+    advance(escrow, transition)
+    msg = messages[name or transition.action].render(snapshot(escrow, buyer_username, seller_username, **extra))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"], priority=HIGH)
+    sent = await context.bot.send_message(chat_id, **msg["group"], reply_markup=buttons)
+    if buttons is not None:
+        track_keyboard(escrow, sent)
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     chat_id = query.message.chat.id
-    user_id = query.from_user.id
-    username = query.from_user.username or query.from_user.first_name
-    data = query.data
     escrow = escrows.get(chat_id)
     if not escrow:
         escrow = create_new_escrow(chat_id)
-
-    # Cancel Escrow
-    if data == "cancel_escrow":
-        if escrow["status"] not in [None, "crypto_selection", "awaiting_amount"]:
-            await query.message.reply_text("⛔ Cannot cancel escrow at this stage.")
+    action = callback_action(untag(query.data))
+    handler = CALLBACK_ACTIONS.get(action)
+    async with locked_transition(escrow, action, roles_of(escrow, query.from_user.id)) as transition:
+        await query.answer()
+        if transition is None or handler is None:
+            if action == "cancel_escrow":
+                await query.message.reply_text("⛔ Cannot cancel escrow at this stage.")
             return
-        escrows.pop(chat_id, None)
-        await query.message.reply_text("Escrow cancelled. Use /escrow to start again.")
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"❌ Escrow {escrow['ticket']} was cancelled."
-        )
-        await clear_previous_buttons(context, escrow)
-        return
+        await handler(query, context, escrow, transition)
+
+async def cancel_escrow(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    retire_keyboards(escrow)
+    advance(escrow, transition)
+    escrows.pop(escrow.group_id, None)
+    msg = messages["cancelled"].render(snapshot(escrow))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"])
+    await query.message.reply_text(**msg["group"])
+
+async def join_escrow(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    chat_id = escrow.group_id
+    username = query.from_user.username or query.from_user.first_name
+    if transition.action == "join_buyer":
+        escrows.set_buyer(escrow, query.from_user.id)
+        escrow.buyer_username = query.from_user.username
+        role, label = "Buyer", "Buyer 💷"
+    else:
+        escrows.set_seller(escrow, query.from_user.id)
+        escrow.seller_username = query.from_user.username
+        role, label = "Seller", "Seller 📦"
+    audit_log.record(escrow, transition.action, transition.role)  # NEW -> NEW, so not through advance()
+    usernames.remember(chat_id, query.from_user)
+    both_joined = resolve(escrow, "both_joined", (SYSTEM,))
+    if both_joined is not None:
+        advance(escrow, both_joined)
+    msg = messages["joined"].render(snapshot(escrow, username=username, role=role, label=label))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"], priority=LOW, coalesce=True)
+    if both_joined is not None:
+        forget_keyboard(escrow, query.message)  # emptied by the edit below
+    # The join notice must land in the group before the crypto picker, so those two are chained.
+    await notifier.fanout(
+        group=chain(
+            query.message.reply_text(**msg["group"]),
+            *([start_crypto_selection(context, escrow)] if both_joined else [])
+        ),
+        edit=query.message.edit_reply_markup(create_escrow_buttons(escrow))
+    )
 
-    # Join Buyer
-    if data == "join_buyer" and not escrow["buyer_id"]:
-        escrow["buyer_id"] = user_id
-        await query.message.reply_text(f"🤝 Status: New Trade\n📄 Action: @{username} joined as Buyer 💷\n🎟️ Ticket: {escrow['ticket']}")
-        await query.message.edit_reply_markup(create_escrow_buttons(escrow))
-        await context.bot.send_message(ADMIN_GROUP_ID, f"🤝 Status: Buyer Joined\n🎟️ Ticket: {escrow['ticket']}\n👤 Buyer: @{username}")
-
-    # Join Seller
-    if data == "join_seller" and not escrow["seller_id"]:
-        escrow["seller_id"] = user_id
-        await query.message.reply_text(f"🤝 Status: New Trade\n📄 Action: @{username} joined as Seller 📦\n🎟️ Ticket: {escrow['ticket']}")
-        await query.message.edit_reply_markup(create_escrow_buttons(escrow))
-        await context.bot.send_message(ADMIN_GROUP_ID, f"🤝 Status: Seller Joined\n🎟️ Ticket: {escrow['ticket']}\n👤 Seller: @{username}")
-
-    # Both Joined → Crypto Selection
-    if escrow["buyer_id"] and escrow["seller_id"] and escrow["status"] is None:
-        escrow["status"] = "crypto_selection"
-        msg = await context.bot.send_message(
-            chat_id,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Both Parties Joined ✅\n"
-            f"👤 Buyer: @{(await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username}\n"
-            f"👤 Seller: @{(await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username}\n"
-            "📄 Action: Buyer select payment method 👇",
-            reply_markup=create_buttons([
-                ("BTC", "crypto_BTC"),
-                ("ETH", "crypto_ETH"),
-                ("LTC", "crypto_LTC"),
-                ("SOL", "crypto_SOL")
-            ])
-        )
-        escrow["latest_message_id"] = msg.message_id
-
-    # Crypto Selection
-    if data.startswith("crypto_") and user_id == escrow["buyer_id"]:
-        crypto = data.split("_")[1]
-        escrow["crypto"] = crypto
-        escrow["status"] = "awaiting_amount"
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Amount 💷\n"
-            f"🪙 Crypto: {crypto}\n👤 Buyer: @{username}\n📄 Action: Buyer selected payment method"
-        )
-        await query.message.reply_text(f"📄 Action: You selected {crypto} 🪙\n✍️ Response: Type the amount in GBP using: `/amount 100`", parse_mode="Markdown")
-        await query.message.edit_reply_markup(create_escrow_buttons(escrow))
-
-    # Buyer Paid
-    if data == "buyer_paid" and user_id == escrow["buyer_id"]:
-        escrow["status"] = "awaiting_admin_confirmation"
-        await clear_previous_buttons(context, escrow)
-        msg = await context.bot.send_message(
-            chat_id,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Payment ⏳\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {escrow['crypto']}\n"
-            "📄 Response: Please wait whilst we confirm this transaction..."
-        )
-        escrow["latest_message_id"] = msg.message_id
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Payment ⏳\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {escrow['crypto']}\n"
-            f"👤 Buyer: @{(await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username}\n"
-            f"👤 Seller: @{(await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username}\n"
-            "📄 Action: Payment awaiting admin confirmation",
-            reply_markup=create_buttons([("Yes ✅", f"payment_received_{escrow['ticket']}"), ("No ❌", f"payment_notreceived_{escrow['ticket']}")])
-        )
+async def start_crypto_selection(context: ContextTypes.DEFAULT_TYPE, escrow: Escrow):
+    buyer_username, seller_username = await party_usernames(context, escrow)
+    msg = messages["both_joined"].render(snapshot(escrow, buyer_username, seller_username))
+    retire_keyboards(escrow)
+    sent = await context.bot.send_message(
+        escrow.group_id,
+        **msg["group"],
+        reply_markup=escrow_buttons(escrow, ASSETS.coin_buttons)
+    )
+    track_keyboard(escrow, sent)
 
-    # Seller Sent Goods
-    if data == "seller_sent_goods" and user_id == escrow["seller_id"]:
-        escrow["goods_sent"] = True
-        escrow["status"] = "awaiting_buyer_action"
-        buyer_username = (await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Goods Sent 📦\n"
-            f"👤 Seller: @{username}\n👤 Buyer: @{buyer_username}\n📄 Action: Seller marked goods as sent"
-        )
-        msg_text = (
-            f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Seller marked goods as sent 📦\n"
-            f"👤 Buyer: @{buyer_username}\n👤 Seller: @{username}\n"
-            "📄 Action: Buyer confirm and press **Release Funds**\nNOTE Only open dispute if:\n - You can not resolve it between you!\n- No response from buyer within 30 minutes.\n- You believe you are getting scammed. "
-        )
-        buttons = create_buttons([("Release Funds ✅", "buyer_release_funds"), ("Dispute ⚠️", "dispute")])
-        msg = await context.bot.send_message(chat_id, msg_text, parse_mode="Markdown", reply_markup=buttons)
-        escrow["latest_message_id"] = msg.message_id
-
-    # Buyer confirms receipt / Release Funds
-    if data == "buyer_release_funds" and user_id == escrow["buyer_id"]:
-        escrow["status"] = "awaiting_seller_wallet"
-        ticket = escrow["ticket"]
-        coin = escrow["crypto"]
-        buyer_username = (await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username
-        seller_username = (await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username
-        await context.bot.send_message(
-            ADMIN_GROUP_ID,
-            f"🎟️ Ticket: {ticket}\n📌 Status: Awaiting Seller Wallet ⏳\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {coin}\n"
-            f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n"
-            "📄 Action: Buyer confirmed goods received. Waiting for sellers wallet."
-        )
-        await context.bot.send_message(
-            chat_id,
-            f"🎟️ Ticket: {ticket}\n📌 Status: Awaiting Seller Wallet ⏳\n"
-            f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(escrow['fiat_amount'])} ({FIAT_LABEL})\n🪙 Crypto: {fmt_crypto(escrow['crypto_amount'])} {coin}\n"
-            f"📄 Action: Buyer confirmed goods were received.\n💬 Response: Seller type /wallet and then paste your {coin} wallet address\n (E.G /wallet 0x1284k18493btc)",
-            parse_mode="Markdown"
-        )
+async def select_crypto(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    username = query.from_user.username or query.from_user.first_name
+    crypto = Coin(untag(query.data).split("_")[1])
+    escrow.crypto = crypto
+    forget_keyboard(escrow, query.message)  # emptied by the edit below
+    advance(escrow, transition)
+    msg = messages["crypto_selected"].render(snapshot(escrow, username=username))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"])
+    await notifier.fanout(
+        group=query.message.reply_text(**msg["group"]),
+        edit=query.message.edit_reply_markup(create_escrow_buttons(escrow))
+    )
+
+async def buyer_paid(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    chat_id = escrow.group_id
+    advance(escrow, transition)
+    buyer_username, seller_username = await party_usernames(context, escrow)
+    msg = messages["buyer_paid"].render(snapshot(escrow, buyer_username, seller_username))
+    outbox.send(
+        ADMIN_GROUP_ID,
+        **msg["admin"],
+        reply_markup=create_buttons([("Yes ✅", f"payment_received_{escrow.ticket}"), ("No ❌", f"payment_notreceived_{escrow.ticket}")]),
+        priority=HIGH
+    )
+    await context.bot.send_message(chat_id, **msg["group"])
+
+async def seller_sent_goods(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    chat_id = escrow.group_id
+    username = query.from_user.username or query.from_user.first_name
+    escrow.goods_sent = True
+    retire_keyboards(escrow)
+    advance(escrow, transition)
+    buyer_username = await usernames.get(context.bot, chat_id, escrow.buyer_id)
+    msg = messages["goods_sent"].render(snapshot(escrow, buyer_username, username))
+    # Stays live after "Release Funds": the dispute button is valid until the admin releases.
+    buttons = escrow_buttons(escrow, [("Release Funds ✅", "buyer_release_funds"), ("Dispute ⚠️", "dispute")])
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"])
+    sent = await context.bot.send_message(chat_id, **msg["group"], reply_markup=buttons)
+    track_keyboard(escrow, sent)
+
+async def buyer_release_funds(query, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    chat_id = escrow.group_id
+    advance(escrow, transition)
+    buyer_username, seller_username = await party_usernames(context, escrow)
+    msg = messages["awaiting_wallet"].render(snapshot(escrow, buyer_username, seller_username))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"])
+    await context.bot.send_message(chat_id, **msg["group"])
+
+# callback action -> handler; dispatched by button_callback once the transition table allows it.
+CALLBACK_ACTIONS = {
+    "cancel_escrow": cancel_escrow,
+    "join_buyer": join_escrow,
+    "join_seller": join_escrow,
+    "select_crypto": select_crypto,
+    "buyer_paid": buyer_paid,
+    "seller_sent_goods": seller_sent_goods,
+    "buyer_release_funds": buyer_release_funds,
+}
 
 # ---------------- AMOUNT HANDLER ----------------
 async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -343,221 +420,394 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not escrow:
         await update.message.reply_text("No active escrow. Use /escrow.")
         return
-    if escrow["buyer_id"] != user_id or escrow["status"] != "awaiting_amount":
-        await update.message.reply_text("You cannot set the amount now.")
-        return
-    try:
-        amount = float(text.split()[1])
-    except (ValueError, IndexError):
-        await update.message.reply_text("Invalid amount. Example: /amount 50")
-        return
-    crypto = escrow["crypto"]
-    price = get_crypto_price(crypto)
-    if price is None:
-        await update.message.reply_text("Unable to fetch the price. Try later.")
-        return
-    crypto_amount = round(amount / price, 8)
-    escrow["fiat_amount"] = amount
-    escrow["crypto_amount"] = crypto_amount
-    escrow["status"] = "awaiting_payment"
-    wallet = ESCROW_WALLETS.get(crypto)
-    await clear_previous_buttons(context, escrow)
-    await update.message.reply_text(
-        f"🎟️ Ticket: {escrow['ticket']}\n📌 Status: Awaiting Payment ⏳\n"
-        f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(amount)} ({FIAT_LABEL})\n🪙 {fmt_crypto(crypto_amount)} {crypto}\n\n"
-        f"📄 Send exact amount to wallet:\n\n`{wallet}`\n\n"
-        "👇Mark as paid once done",
-        parse_mode="Markdown",
-        reply_markup=create_buttons([
-            ("I've Paid ✅", "buyer_paid"),
-            ("Cancel ❌", "cancel_escrow"),
-        ])
-    )
+    async with locked_transition(escrow, "set_amount", roles_of(escrow, user_id)) as transition:
+        if transition is None:
+            await update.message.reply_text("You cannot set the amount now.")
+            return
+        args = text.split()
+        try:
+            # "/amount 50 EUR" quotes in another listed currency; the group's own by default.
+            fiat = ASSETS.fiat(args[2] if len(args) > 2 else escrow.fiat)
+        except KeyError:
+            await update.message.reply_text(f"Unknown currency. Use one of: {', '.join(ASSETS.fiats)}")
+            return
+        try:
+            amount = parse_fiat(args[1], fiat.decimals)
+        except (ValueError, IndexError):
+            await update.message.reply_text("Invalid amount. Example: /amount 50")
+            return
+        crypto = escrow.crypto
+        price = await price_oracle.get_price(crypto, fiat.code)
+        if price is None:
+            await update.message.reply_text("Unable to fetch the price. Try later.")
+            return
+        decimals = COIN_DECIMALS[crypto]
+        try:
+            target = allocator.allocate(escrow.ticket, crypto, to_minor(quote(amount, price, crypto), decimals))
+        except ValueError:
+            await update.message.reply_text("Too many open trades for this amount. Try a slightly different amount.")
+            return
+        escrow.fiat = fiat.code
+        escrow.fiat_amount = amount
+        escrow.crypto_amount = from_minor(target.units, decimals)
+        escrow.deposit_address = target.address
+        escrow.quoted_at = expiry.clock()
+        retire_keyboards(escrow)
+        advance(escrow, transition)
+        msg = messages["amount_set"].render(snapshot(escrow, deposit_wallet=escrow.deposit_address))
+        sent = await update.message.reply_text(
+            **msg["group"],
+            reply_markup=escrow_buttons(escrow, [
+                ("I've Paid ✅", "buyer_paid"),
+                ("Cancel ❌", "cancel_escrow"),
+            ])
+        )
+        track_keyboard(escrow, sent)
 
 # ---------------- WALLET HANDLER ----------------
 async def wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
     user_id = update.message.from_user.id
     text = update.message.text.strip()
-    escrow = escrows.get(chat_id)
+    escrow = escrows.get(update.message.chat_id)
     if not escrow:
         await update.message.reply_text("No active escrow in this group.")
         return
-    if escrow.get("status") != "awaiting_seller_wallet":
-        await update.message.reply_text("Cannot set wallet now.")
-        return
-    if user_id != escrow.get("seller_id"):
-        await update.message.reply_text("Only the seller can send the wallet address.")
-        return
-    try:
-        wallet_address = text.split(maxsplit=1)[1]
-    except IndexError:
-        await update.message.reply_text("Please provide your wallet: /wallet <your-wallet>")
-        return
-    escrow["wallet_address"] = wallet_address
-    ticket = escrow["ticket"]
-    buyer_username = (await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username
-    seller_username = (await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username
-    coin = escrow['crypto']
-    amount_fiat = escrow['fiat_amount'] or 0
-    amount_crypto = escrow['crypto_amount'] or 0
-
-    # Fee calculations
-    fee_fiat = amount_fiat * FEE_RATE
-    payout_fiat = amount_fiat - fee_fiat
-
-    # Notify admin with release button using new compact format:
-    await context.bot.send_message(
+    async with locked_transition(escrow, "set_wallet", roles_of(escrow, user_id)) as transition:
+        if transition is None:
+            if escrow.status not in (AWAITING_SELLER_WALLET, AWAITING_ADMIN_RELEASE):
+                await update.message.reply_text("Cannot set wallet now.")
+            else:
+                await update.message.reply_text("Only the seller can send the wallet address.")
+            return
+        try:
+            wallet_address = text.split(maxsplit=1)[1]
+        except IndexError:
+            await update.message.reply_text("Please provide your wallet: /wallet <your-wallet>")
+            return
+        escrow.wallet_address = wallet_address
+        advance(escrow, transition)
+        await send_release_request(update, context, escrow)
+
+async def send_release_request(update: Update, context: ContextTypes.DEFAULT_TYPE, escrow: Escrow):
+    buyer_username, seller_username = await party_usernames(context, escrow)
+    msg = messages["release_requested"].render(snapshot(escrow, buyer_username, seller_username))
+    # Admin gets the release button and the seller's wallet; the group gets the same figures without it.
+    outbox.send(
         ADMIN_GROUP_ID,
-        f"🎟️ Ticket: {ticket}\n📌 Status: Awaiting Admin Release ⏳\n\n"
-        f"💷 Trade Amount: {FIAT_SYMBOL}{fmt_auto(amount_fiat)} ({FIAT_LABEL}) ({fmt_crypto(amount_crypto)} {coin})\n"
-        f"💸 Escrow Fee (5%): {FIAT_SYMBOL}{fmt_auto(fee_fiat)} ({FIAT_LABEL})\n"
-        f"🏦 Send To Seller: {FIAT_SYMBOL}{fmt_auto(payout_fiat)} ({FIAT_LABEL})\n\n"
-        f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n"
-        f"👛 Seller Wallet: `{wallet_address}`\n\n📄 Response: Please confirm funds release",
-        parse_mode="Markdown",
-        reply_markup=create_buttons([("Mark as Sent ✅", f"admin_sent_{ticket}")])
-    )
-
-    # Notify escrow group (buyer/seller) with the same compact info (no wallet)
-    await update.message.reply_text(
-        f"🎟️ Ticket: {ticket}\n📌 Status: Processing Payment...⏳\n\n"
-        f"💷 Trade Amount: {FIAT_SYMBOL}{fmt_auto(amount_fiat)} ({FIAT_LABEL}) ({fmt_crypto(amount_crypto)} {coin})\n"
-        f"💸 Escrow Fee (5%): {FIAT_SYMBOL}{fmt_auto(fee_fiat)} ({FIAT_LABEL})\n"
-        f"🏦 Amount Being Released: {FIAT_SYMBOL}{fmt_auto(payout_fiat)} ({FIAT_LABEL})\n\n"
-        "📄 Response: Funds are being sent to seller, you will receive an update in this chat when payment has been sent.",
-        parse_mode="Markdown"
+        **msg["admin"],
+        reply_markup=create_buttons([("Mark as Sent ✅", f"admin_sent_{escrow.ticket}")]),
+        priority=HIGH
     )
+    await update.message.reply_text(**msg["group"])
 
 # ---------------- ADMIN RELEASE FUNDS ----------------
 async def admin_sent_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
 
-    if query.message.chat.id != ADMIN_GROUP_ID:
-        return
-
-    if not data.startswith("admin_sent_"):
+    if query.message.chat.id != ADMIN_GROUP_ID or not data.startswith("admin_sent_"):
+        await query.answer()
         return
     ticket = data.split("_", 2)[2]
-    escrow = next((e for e in escrows.values() if e["ticket"] == ticket), None)
+    escrow = escrows.by_ticket(ticket)
     if not escrow:
+        await query.answer()
         await query.message.reply_text("Escrow not found.")
         return
-    chat_id = escrow["group_id"]
-    buyer_username = (await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username
-    seller_username = (await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username
-    amount_fiat = escrow.get('fiat_amount', 0)
-    amount_crypto = escrow.get('crypto_amount', 0)
-    wallet = escrow.get('wallet_address', 'Not provided')
-    coin = escrow.get('crypto', 'N/A')
-
-    fee_fiat = amount_fiat * FEE_RATE
-    payout_fiat = amount_fiat - fee_fiat
-
-    await clear_previous_buttons(context, escrow)
-    escrow["status"] = "completed"
-
-    # Notify admin final
-    await context.bot.send_message(
-        ADMIN_GROUP_ID,
-        f"🎟️ Ticket: {ticket}\n📌 Status: Trade Completed ✅\n\n"
-        f"💷 Amount Sent: {FIAT_SYMBOL}{fmt_auto(amount_fiat)} ({FIAT_LABEL}) ({fmt_crypto(amount_crypto)} {coin})\n"
-        f"💸 Escrow Fee (5%): {FIAT_SYMBOL}{fmt_auto(fee_fiat)} ({FIAT_LABEL})\n"
-        f"🏦 Amount After Fee: {FIAT_SYMBOL}{fmt_auto(payout_fiat)} ({FIAT_LABEL})\n\n"
-        "📄 Action: Funds have been released to sellers wallet.",
-        parse_mode="Markdown"
-    )
+    async with locked_transition(escrow, "admin_sent", roles_of(escrow, query.from_user.id, True)) as transition:
+        await query.answer()
+        if transition is None:
+            return
+        await release_funds(context, escrow, transition)
 
-    # Notify escrow group final (seller/buyer)
-    await context.bot.send_message(
-        chat_id,
-        f"🎉 Trade Completed!\n\n"
-        f"🎟️ Ticket: {ticket}\n"
-        f"💷 Amount Released: {FIAT_SYMBOL}{fmt_auto(payout_fiat)} ({FIAT_LABEL})\n"
-        f"🪙 Crypto Amount: ({fmt_crypto(amount_crypto - (amount_crypto * FEE_RATE))} {coin})\n"
-        f"💸 Escrow Fee Taken: {FIAT_SYMBOL}{fmt_auto(fee_fiat)} ({FIAT_LABEL})\n\n"
-        "📄 Response: Funds have successfully been sent to seller.\n\n"
-        "🫡 Thank you for using K1 Escrow Bot, see you soon! \n\nYou can now close this group.",
-        parse_mode="Markdown"
-    )
+async def release_funds(context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, transition):
+    chat_id = escrow.group_id
+    retire_keyboards(escrow)
+    advance(escrow, transition)
+    msg = messages["completed"].render(snapshot(escrow))
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"])
+    await context.bot.send_message(chat_id, **msg["group"])
 
     escrows.pop(chat_id, None)
 
 # ---------------- DISPUTE HANDLER ----------------
 async def dispute_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     chat_id = query.message.chat.id
     user_id = query.from_user.id
     username = query.from_user.username or query.from_user.first_name
     escrow = escrows.get(chat_id)
 
     if not escrow:
+        await query.answer()
         await query.message.reply_text("No active escrow in this group.")
         return
 
-    # Remove all previous buttons immediately to pause escrow
-    await clear_previous_buttons(context, escrow)
+    async with locked_transition(escrow, "dispute", roles_of(escrow, user_id)) as transition:
+        await query.answer()
+        if transition is None:
+            # Only participants can open a dispute
+            if user_id not in (escrow.buyer_id, escrow.seller_id):
+                await query.message.reply_text("Only participants can open a dispute.")
+            elif escrow.disputed:
+                await query.message.reply_text("Dispute already open. Please wait for admin.")
+            else:
+                await query.message.reply_text("⛔ Cannot open a dispute at this stage.")
+            return
 
-    # Only participants can open a dispute
-    if user_id not in [escrow.get("buyer_id"), escrow.get("seller_id")]:
-        await query.message.reply_text("Only participants can open a dispute.")
-        return
+        escrow.disputed = True
+        advance(escrow, transition)
+        await open_dispute(context, escrow, username)
+
+async def open_dispute(context: ContextTypes.DEFAULT_TYPE, escrow: Escrow, username: str):
+    buyer_username, seller_username = await party_usernames(context, escrow)
+    msg = messages["disputed"].render(snapshot(escrow, buyer_username, seller_username, username=username))
+    # Admin gets instructions for manual review
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"], priority=HIGH)
+    # Every group button goes stale right away to pause the escrow; the sweeper removes them
+    retire_keyboards(escrow)
+    escrows.save(escrow)
+    # Notify group that a dispute has been raised
+    await context.bot.send_message(escrow.group_id, **msg["group"])
 
-    if escrow.get("disputed"):
-        await query.message.reply_text("Dispute already open. Please wait for admin.")
+# ---------------- CHAIN WATCHER ----------------
+async def payment_detected(context: ContextTypes.DEFAULT_TYPE, ticket, deposit):
+    escrow = escrows.by_ticket(ticket)
+    if not escrow:
         return
+    async with locked_transition(escrow, "payment_received", (SYSTEM,)) as transition:
+        if transition is None:
+            return
+        await confirm_payment(context, escrow, transition, "payment_detected",
+                              txid=deposit.txid, confirmations=deposit.confirmations)
+
+# ---------------- EXPIRY ----------------
+# What a reminder asks for in each status that has a "remind" step in expiry.POLICIES.
+WAITING_ON = {
+    AWAITING_AMOUNT: "Buyer, please set the trade amount using /amount 100",
+    AWAITING_PAYMENT: "Buyer, please send the payment and press I've Paid ✅ once done",
+    AWAITING_BUYER_ACTION: "Buyer, please confirm the goods/services with Release Funds ✅ or open a dispute",
+}
 
-    escrow["disputed"] = True
-    escrow["status"] = "disputed"
-    ticket = escrow["ticket"]
-    buyer_username = (await context.bot.get_chat_member(chat_id, escrow['buyer_id'])).user.username
-    seller_username = (await context.bot.get_chat_member(chat_id, escrow['seller_id'])).user.username
-    amount = escrow.get("fiat_amount", "N/A")
-    crypto_amount = escrow.get("crypto_amount", 0)
-    coin = escrow.get("crypto", "N/A")
-
-    # Notify group that a dispute has been raised
-    await context.bot.send_message(
-        chat_id,
-        f"🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
-        f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(amount) if isinstance(amount, (int, float)) else amount} ({FIAT_LABEL}) ({fmt_crypto(crypto_amount)} {coin})\n"
-        f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n"
-        f"📄 Action: Trade disputed by @{username}. Escrow is now paused. Please wait for admin to review.",
-        parse_mode="Markdown"
+async def expire_escrow(ticket):
+    escrow = escrows.by_ticket(ticket)
+    if not escrow:
+        return
+    async with escrows.lock(escrow):
+        step = expiry.due_step(escrow)
+        if step is None:
+            return
+        try:
+            await run_expiry_step(escrow, step)
+        except Exception:
+            expiry.retry(escrow)  # the step has not run; the wheel entry is gone, so schedule it again
+            raise
+
+async def run_expiry_step(escrow: Escrow, step):
+    # expiry_step only moves on once the step has run, so a failure leaves it to be retried.
+    if step.action == "remind":
+        msg = messages["reminder"].render(snapshot(escrow, waiting=WAITING_ON[escrow.status]))
+        outbox.send(escrow.group_id, **msg["group"])
+        escrow.expiry_step += 1
+        expiry.track(escrow)
+        escrows.save(escrow)
+        return
+    transition = resolve(escrow, step.action, (SYSTEM,))
+    if transition is None:
+        escrow.expiry_step += 1  # not allowed from here; move on to the next step
+        expiry.track(escrow)
+        escrows.save(escrow)
+        return
+    # Abandoned trades are often in groups the bot was removed from, so names are best effort.
+    buyer_username, seller_username = await asyncio.gather(
+        known_username(outbox.bot, escrow.group_id, escrow.buyer_id, escrow.buyer_username),
+        known_username(outbox.bot, escrow.group_id, escrow.seller_id, escrow.seller_username)
+    )
+    retire_keyboards(escrow)
+    if step.action == "escalate":
+        escrow.disputed = True
+    advance(escrow, transition)
+    if step.action == "expire":
+        escrows.pop(escrow.group_id, None)
+    msg = messages["escalated" if step.action == "escalate" else "expired"].render(
+        snapshot(escrow, buyer_username or "-", seller_username or "-", idle=fmt_duration(step.after))
+    )
+    outbox.send(ADMIN_GROUP_ID, **msg["admin"], priority=HIGH if step.action == "escalate" else NORMAL)
+    outbox.send(escrow.group_id, **msg["group"])
+
+# ---------------- ADMIN COMMANDS ----------------
+# Served from trade_stats counters and the ticket index: constant time however many trades there are.
+def status_label(status):
+    return status.value.replace("_", " ").capitalize()
+
+def fmt_event(event):
+    status = status_label(Escrow.from_row(event.row).status)
+    return f"{time.strftime('%d %b %H:%M', time.gmtime(event.at))} {event.action} ({event.role}) → {status}"
+
+def fmt_fiat_amounts(amounts, label=True):
+    # One "£12 (GBP)" per currency with any amount; the default currency's zero when there are none.
+    currencies = [(ASSETS.fiat(code), amount) for code, amount in sorted(amounts.items()) if amount]
+    return " + ".join(
+        f"{fiat.symbol}{fmt_fiat(amount, fiat.decimals)}" + (f" ({fiat.code})" if label else "")
+        for fiat, amount in currencies or [(ASSETS.default_fiat, 0)]
     )
 
-    # Notify admin with instructions for manual review
-    await context.bot.send_message(
-        ADMIN_GROUP_ID,
-        f"🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
-        f"💷 Amount: {FIAT_SYMBOL}{fmt_auto(amount) if isinstance(amount, (int, float)) else amount} ({FIAT_LABEL}) ({fmt_crypto(crypto_amount)} {coin})\n"
-        f"👤 Buyer: @{buyer_username}\n👤 Seller: @{seller_username}\n"
-        f"📄 Action: Dispute opened by @{username}. "
-        "Bot cannot generate an invite link. Please ask a participant to provide a manual invite link or add you to the group to review.",
-        parse_mode="Markdown"
+def fmt_coin_amounts(amounts):
+    return ", ".join(f"{fmt_crypto(amount)} {coin}" for coin, amount in sorted(amounts.items()) if amount) or "no crypto"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    today, week = trade_stats.today(), trade_stats.recent(7)
+    msg = messages["stats"].render(dict(
+        completed=today.completed, volume=fmt_fiat_amounts(today.volume), fees=fmt_fiat_amounts(today.fees),
+        crypto_fees=fmt_coin_amounts(today.crypto_fees), cancelled=today.cancelled, disputed=today.disputed,
+        week_completed=week.completed, week_volume=fmt_fiat_amounts(week.volume, False),
+        week_fees=fmt_fiat_amounts(week.fees, False), open=len(trade_stats),
+        open_volume=fmt_fiat_amounts(trade_stats.open_volume, False)
+    ))
+    await update.message.reply_text(**msg["admin"])
+
+async def open_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    by_status = [f"{status_label(status)}: {trade_stats.by_status[status]}"
+                 for status in Status if trade_stats.by_status[status]]
+    by_coin = [f"{coin}: {count}" for coin, count in sorted(trade_stats.by_coin.items()) if count]
+    msg = messages["open_trades"].render(dict(
+        open=len(trade_stats), by_status="\n".join(by_status) or "none", by_coin="\n".join(by_coin) or "none"
+    ))
+    await update.message.reply_text(**msg["admin"])
+
+async def ticket_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Usage: /ticket <ticket>")
+        return
+    ticket = context.args[0].upper()
+    history = await audit_log.history(ticket)
+    escrow = escrows.by_ticket(ticket) or (Escrow.from_row(history[-1].row) if history else None)
+    if not escrow:
+        await update.message.reply_text("Escrow not found.")
+        return
+    buyer_username, seller_username = await asyncio.gather(
+        known_username(context.bot, escrow.group_id, escrow.buyer_id, escrow.buyer_username),
+        known_username(context.bot, escrow.group_id, escrow.seller_id, escrow.seller_username)
     )
+    values = {"amount": "-", "crypto_amount": "-", **snapshot(
+        escrow, buyer_username or "-", seller_username or "-", status=status_label(escrow.status),
+        since=fmt_duration(expiry.clock() - (escrow.status_since or expiry.clock())), coin=escrow.crypto or "",
+        deposit=escrow.deposit_address or "-", wallet=escrow.wallet_address or "-",
+        history="\n".join(fmt_event(event) for event in history) or "not recorded"
+    )}
+    msg = messages["ticket_info"].render(values)
+    await update.message.reply_text(**msg["admin"])
 
 # ---------------- MAIN ----------------
-def main():
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    app = ApplicationBuilder().token(TOKEN).build()
+async def on_startup(app):
+    outbox.start(app.bot)
+    sweeper.start(outbox)
+    restored = escrows.restore()
+    # Before any target is handed out: a late payment must not confirm a trade quoted since the restart.
+    allocator.restore(escrows.store.load_cooling(allocator.clock()))
+    watcher.restore(escrows.store.load_used(watcher.clock() - watcher.slack))
+    for escrow in escrows:
+        expiry.track(escrow)
+        watcher.track(escrow)
+        trade_stats.track(escrow)
+    for escrow in escrows.store.load_closed(trade_stats.since(trade_stats.keep_days)):
+        trade_stats.record(escrow)
+    expiry.start(metrics.timed("expire_escrow", expire_escrow, kind="job"))
+    if watcher.adapters:
+        context = CallbackContext(app)
+        detected = metrics.timed("payment_detected", payment_detected, kind="job")
+        watcher.start(lambda ticket, deposit: detected(context, ticket, deposit))
+    if METRICS_PORT:
+        await metrics.start(METRICS_HOST, METRICS_PORT)
+    logging.getLogger(__name__).info("Restored %d open escrows, %d with deadlines", restored, len(expiry))
+
+async def on_shutdown(app):
+    await metrics.stop()
+    await watcher.stop()
+    await expiry.stop()
+    await sweeper.stop()
+    await outbox.stop()
+    await price_oracle.close()
+    await escrows.store.close()
+    await audit_log.close()
+
+def build_application(request=None):
+    # ``request`` replaces the HTTP layer to Telegram, e.g. with an in-process fake for benchmarks.
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .request(request or InstrumentedRequest(metrics, connection_pool_size=256))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, throttle_update), group=-2)
+    # Versioned group buttons are checked before any handler runs; admin buttons carry the ticket instead.
+    app.add_handler(CallbackQueryHandler(reject_stale_callback, pattern=TAGGED), group=-1)
 
     # Order matters — specific handlers before generic.
     app.add_handler(CallbackQueryHandler(admin_sent_callback, pattern=r"^admin_sent_.*$"))
     app.add_handler(CallbackQueryHandler(handle_admin_payment_confirmation, pattern=r"^payment_(received|notreceived)_.*$"))
-    app.add_handler(CallbackQueryHandler(dispute_callback, pattern=r"^dispute$"))
+    app.add_handler(CallbackQueryHandler(dispute_callback, pattern=r"^dispute(:\d+)?$"))
     app.add_handler(CallbackQueryHandler(button_callback))
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("escrow", escrow_command))
     app.add_handler(CommandHandler("wallet", wallet_command))
+    admin_only = filters.Chat(ADMIN_GROUP_ID)
+    app.add_handler(CommandHandler("stats", stats_command, filters=admin_only))
+    app.add_handler(CommandHandler("open", open_command, filters=admin_only))
+    app.add_handler(CommandHandler("ticket", ticket_command, filters=admin_only))
+
+    app.add_handler(MessageHandler(filters.Regex(r'^/amount \d+(\.\d+)?( [A-Za-z]{3})?$'), handle_amount))
+
+    metrics.instrument(app)
+    register_metrics(app)
+    return app
+
+def register_metrics(app):
+    metrics.stats("outbox_total", outbox.stats)
+    metrics.stats("keyboards_total", sweeper.stats)
+    metrics.stats("expiry_total", expiry.stats)
+    metrics.stats("chain_total", watcher.stats)
+    metrics.stats("prices_total", price_oracle.stats)
+    metrics.stats("audit_total", audit_log.stats)
+    metrics.stats("throttle_total", throttle.stats, label="outcome")
+    # Sampled on scrape only.
+    metrics.gauge("update_queue_depth", app.update_queue.qsize)
+    metrics.gauge("outbox_queue_depth", lambda: {
+        ("high", "normal", "low")[priority]: depth for priority, depth in outbox.depth().items()
+    }, label="priority")
+    metrics.gauge("keyboards_pending", lambda: len(sweeper))
+    metrics.gauge("expiry_scheduled", lambda: len(expiry))
+    metrics.gauge("deposit_targets", lambda: len(allocator))
+    metrics.gauge("open_escrows", lambda: len(escrows))
+    metrics.gauge("open_trades", lambda: {status.value: count for status, count in trade_stats.by_status.items()},
+                  label="status")
+    metrics.gauge("usernames_cached", lambda: len(usernames))
+    metrics.gauge("throttle_buckets", lambda: len(throttle))
+
+def webhook_settings():
+    # Telegram sends WEBHOOK_SECRET in X-Telegram-Bot-Api-Secret-Token; other requests get 403.
+    return dict(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+    )
 
-    app.add_handler(MessageHandler(filters.Regex(r'^/amount \d+(\.\d+)?$'), handle_amount))
-
-    app.run_polling()
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    app = build_application()
+    if BOT_MODE == "webhook":
+        app.run_webhook(**webhook_settings())
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
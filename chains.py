@@ -0,0 +1,364 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, namedtuple
+
+import httpx
+
+from deposits import Target
+from money import COIN_DECIMALS, to_minor
+
+logger = logging.getLogger(__name__)
+
+# units are the coin's base unit (satoshi, wei, lamport); time is the block time, None while unconfirmed.
+Deposit = namedtuple("Deposit", "coin txid address units confirmations time")
+
+# Confirmations before a deposit counts as paid. Solana reports 32 once finalized.
+MIN_CONFIRMATIONS = {"BTC": 2, "LTC": 6, "ETH": 12, "SOL": 32}
+
+
+class ChainUnavailable(Exception):
+    pass
+
+
+# ---------------- ADAPTERS ----------------
+class HTTPAdapter:
+    """Shared httpx client handling for the adapters below.
+
+    Each adapter answers ``deposits(address, since)`` with the incoming
+    transfers to one address, as Deposit tuples, however many escrows are
+    waiting on that address. It reads the newest page, then follows older
+    pages until they reach back before block time ``since`` (the oldest any
+    of those escrows accepts), or for at most ``max_pages`` pages; with
+    ``since`` None only the newest page is read.
+    """
+
+    def __init__(self, coin, url, timeout=10.0, max_pages=50):
+        self.coin = coin
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.max_pages = max_pages
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(self.timeout), headers={"Accept": "application/json"})
+        return self._client
+
+    def _older(self, page, size, oldest, since):
+        """Whether a page of ``size`` items whose oldest is at ``oldest`` may have older ones still wanted."""
+        return since is not None and len(page) >= size and oldest is not None and oldest >= since
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class EsploraAdapter(HTTPAdapter):
+    """Bitcoin-style chains through an Esplora API (blockstream.info, litecoinspace.org)."""
+
+    PAGE = 25  # confirmed transactions per page, newest first
+
+    async def deposits(self, address, since=None):
+        client = self._get_client()
+        response = await client.get(f"{self.url}/address/{address}/txs")
+        response.raise_for_status()
+        txs = page = response.json()  # mempool, then the first page of confirmed
+        for _ in range(self.max_pages - 1):
+            confirmed = [tx for tx in page if tx["status"]["confirmed"]]
+            if not self._older(confirmed, self.PAGE, confirmed[-1]["status"].get("block_time") if confirmed else None, since):
+                break
+            response = await client.get(f"{self.url}/address/{address}/txs/chain/{confirmed[-1]['txid']}")
+            response.raise_for_status()
+            page = response.json()
+            txs = txs + page
+        tip = None
+        if any(tx["status"]["confirmed"] for tx in txs):
+            response = await client.get(f"{self.url}/blocks/tip/height")
+            response.raise_for_status()
+            tip = int(response.text)
+        deposits = []
+        for tx in txs:
+            units = sum(out["value"] for out in tx["vout"] if out.get("scriptpubkey_address") == address)
+            if not units:
+                continue
+            status = tx["status"]
+            confirmations = tip - status["block_height"] + 1 if status["confirmed"] else 0
+            deposits.append(Deposit(self.coin, tx["txid"], address, units, confirmations, status.get("block_time")))
+        return deposits
+
+
+class EtherscanAdapter(HTTPAdapter):
+    """Ether transfers through an Etherscan-compatible ``account/txlist`` API."""
+
+    PAGE = 100
+
+    def __init__(self, url, api_key=None, timeout=10.0, coin="ETH", max_pages=50):
+        super().__init__(coin, url, timeout, max_pages)
+        self.api_key = api_key
+
+    async def deposits(self, address, since=None):
+        # Older pages end at the last page's oldest block rather than counting pages, so
+        # transfers arriving in between do not shift them; that block is read again.
+        params = {"module": "account", "action": "txlist", "address": address,
+                  "startblock": 0, "endblock": 99999999, "page": 1, "offset": self.PAGE, "sort": "desc"}
+        if self.api_key:
+            params["apikey"] = self.api_key
+        txs = {}
+        for _ in range(self.max_pages):
+            response = await self._get_client().get(self.url, params=params)
+            response.raise_for_status()
+            body = response.json()
+            if body.get("status") != "1":
+                if body.get("message") == "No transactions found":
+                    break
+                # Rate-limit notices come back as HTTP 200 with status "0" too.
+                raise ChainUnavailable(f"Etherscan: {body.get('message')}: {body.get('result')}")
+            page = body["result"]
+            for tx in page:
+                txs.setdefault(tx["hash"], tx)
+            if not self._older(page, self.PAGE, int(page[-1]["timeStamp"]), since):
+                break
+            last = int(page[-1]["blockNumber"])
+            params["endblock"] = last if last < params["endblock"] else last - 1  # a block fuller than a page
+        wanted = address.lower()
+        return [
+            Deposit(self.coin, tx["hash"], address, int(tx["value"]), int(tx["confirmations"]), int(tx["timeStamp"]))
+            for tx in txs.values()
+            if tx["to"].lower() == wanted and tx.get("isError") == "0" and int(tx["value"])
+        ]
+
+
+class SolanaAdapter(HTTPAdapter):
+    """Native SOL transfers through JSON-RPC; transaction details come in batched calls.
+
+    A finalized transaction never changes, so what it paid to an address is
+    kept (up to ``cache`` of them) and not fetched again on later polls.
+    """
+
+    COMMITMENT = {"processed": 0, "confirmed": 1, "finalized": 32}
+
+    def __init__(self, url, timeout=10.0, coin="SOL", limit=50, max_pages=50, cache=100_000):
+        super().__init__(coin, url, timeout, max_pages)
+        self.limit = limit
+        self.cache = cache
+        self._ids = itertools.count(1)
+        self._finalized = OrderedDict()  # (signature, address) -> lamports received, oldest first
+
+    async def _rpc(self, calls):
+        body = [{"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params} for method, params in calls]
+        response = await self._get_client().post(self.url, json=body)
+        response.raise_for_status()
+        replies = {reply["id"]: reply for reply in response.json()}
+        return [replies.get(request["id"], {}).get("result") for request in body]
+
+    async def deposits(self, address, since=None):
+        signatures = []
+        options = {"limit": self.limit}
+        for _ in range(self.max_pages):
+            (page,) = await self._rpc([("getSignaturesForAddress", [address, options])])
+            page = page or []
+            signatures += page
+            if not self._older(page, self.limit, page[-1].get("blockTime") if page else None, since):
+                break
+            options = {"limit": self.limit, "before": page[-1]["signature"]}
+        signatures = [s for s in signatures if s.get("err") is None]
+        received = {}  # signature -> lamports received, for those not cached
+        fetch = [s for s in signatures if (s["signature"], address) not in self._finalized]
+        for start in range(0, len(fetch), self.limit):
+            batch = fetch[start:start + self.limit]
+            txs = await self._rpc([
+                ("getTransaction", [s["signature"], {"encoding": "jsonParsed", "maxSupportedTransactionVersion": 0}])
+                for s in batch
+            ])
+            for signature, tx in zip(batch, txs):
+                received[signature["signature"]] = units = self._received(tx, address)
+                if tx and signature.get("confirmationStatus") == "finalized":
+                    self._finalized[signature["signature"], address] = units
+                    if len(self._finalized) > self.cache:
+                        self._finalized.popitem(last=False)
+        deposits = []
+        for signature in signatures:
+            units = received.get(signature["signature"]) or self._finalized.get((signature["signature"], address))
+            if units:
+                confirmations = self.COMMITMENT.get(signature.get("confirmationStatus"), 0)
+                deposits.append(Deposit(self.coin, signature["signature"], address, units, confirmations,
+                                        signature.get("blockTime")))
+        return deposits
+
+    @staticmethod
+    def _received(tx, address):
+        if not tx:
+            return None
+        keys = [key["pubkey"] if isinstance(key, dict) else key for key in tx["transaction"]["message"]["accountKeys"]]
+        if address not in keys:
+            return 0
+        i = keys.index(address)
+        return max(tx["meta"]["postBalances"][i] - tx["meta"]["preBalances"][i], 0)
+
+
+class FakeChain:
+    """In-memory ledger for running the watcher offline."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.txs = {}  # txid -> Deposit
+        self.received = {}  # (coin, address) -> txids
+        self._ids = itertools.count(1)
+
+    def pay(self, coin, address, units, confirmations=0):
+        txid = f"fake{next(self._ids):08d}"
+        self.txs[txid] = Deposit(coin, txid, address, units, confirmations, self.clock() if confirmations else None)
+        self.received.setdefault((coin, address), []).append(txid)
+        return txid
+
+    def confirm(self, txid, confirmations):
+        deposit = self.txs[txid]
+        self.txs[txid] = deposit._replace(confirmations=confirmations, time=deposit.time or self.clock())
+
+
+class FakeChainAdapter:
+    def __init__(self, chain, coin):
+        self.chain = chain
+        self.coin = coin
+        self.calls = 0
+
+    async def deposits(self, address, since=None):
+        self.calls += 1
+        return [self.chain.txs[txid] for txid in self.chain.received.get((self.coin, address), ())]
+
+    async def close(self):
+        pass
+
+
+# ---------------- MATCHING ----------------
+class ChainWatcher:
+    """Confirms escrow payments by watching the escrows' deposit targets on-chain.
+
+    ``track`` is called whenever an escrow changes status: escrows in one of
+    ``statuses`` hold their deposit target in ``allocator`` (see
+    deposits.DepositAllocator), everything else gives it back. Every
+    ``interval`` each address with someone waiting is polled once, all
+    concurrently. A deposit with enough confirmations that hits a target
+    is handed to the handler given to ``start``, together with its ticket.
+    Its block time must not be more than ``slack`` seconds before the
+    escrow's quote, since block timestamps run behind the wall clock.
+    Transaction ids already used are never matched again: they are kept,
+    and written to ``store``, for ``slack`` seconds, after which their block
+    time is too early for any escrow still to be quoted on that target.
+    A txid is only used once the handler returns; if it raises, the failure
+    is logged and counted in ``errors`` and the deposit comes up again.
+    """
+
+    def __init__(self, adapters, allocator, statuses, confirmations=MIN_CONFIRMATIONS, interval=30.0, slack=7200.0,
+                 store=None, clock=time.time):
+        self.adapters = adapters  # coin -> adapter
+        self.allocator = allocator
+        self.statuses = frozenset(statuses)
+        self.confirmations = confirmations
+        self.interval = interval
+        self.slack = slack
+        self.store = store  # persists used txids, see store.SQLiteStore
+        self.clock = clock
+        self.handler = None  # async (ticket, deposit) -> None, see start()
+        self.stats = {"polls": 0, "matched": 0, "unmatched": 0, "early": 0, "errors": 0}
+        self._since = {}  # ticket -> earliest block time accepted
+        self._used = {}  # txid -> matched at, oldest first
+        self._reported = {}  # txid -> first counted as unmatched or early, oldest first
+        self._worker = None
+
+    def track(self, escrow):
+        ticket, coin = escrow.ticket, escrow.crypto
+        if escrow.status in self.statuses and coin and escrow.crypto_amount is not None:
+            address = escrow.deposit_address or self.allocator.wallets.get(coin)
+            target = Target(coin, address, to_minor(escrow.crypto_amount, COIN_DECIMALS[coin]))
+            if self.allocator.claim(ticket, target):
+                self._since[ticket] = escrow.quoted_at - self.slack if escrow.quoted_at is not None else None
+                return
+            # Only escrows quoted before targets were allocated can collide.
+            logger.warning("Escrow %s shares its deposit target with %s; leaving it to the admin",
+                           ticket, self.allocator.lookup(*target))
+        self.allocator.release(ticket)
+        self._since.pop(ticket, None)
+
+    def restore(self, used):
+        """Txids matched before a restart, as (txid, matched at) oldest first."""
+        for txid, at in used:
+            self._used[txid] = at
+
+    def _prune(self):
+        cutoff = self.clock() - self.slack
+        for seen in (self._used, self._reported):
+            while seen:
+                txid = next(iter(seen))
+                if seen[txid] >= cutoff:
+                    break
+                del seen[txid]
+
+    def start(self, handler):
+        self.handler = handler
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for adapter in self.adapters.values():
+            await adapter.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("Chain poll failed")
+
+    async def poll(self):
+        watched = [(coin, address) for coin, address in self.allocator.addresses()
+                   if address and coin in self.adapters]
+        oldest = {}  # (coin, address) -> earliest block time any escrow waiting there accepts
+        for ticket, since in self._since.items():
+            target = self.allocator.target(ticket)
+            if since is not None and target is not None:
+                key = target.coin, target.address
+                oldest[key] = min(since, oldest.get(key, since))
+        results = await asyncio.gather(
+            *(self.adapters[coin].deposits(address, oldest.get((coin, address))) for coin, address in watched),
+            return_exceptions=True,
+        )
+        self.stats["polls"] += 1
+        self._prune()
+        for (coin, address), deposits in zip(watched, results):
+            if isinstance(deposits, BaseException):
+                self.stats["errors"] += 1
+                logger.warning("Polling %s deposits to %s failed: %r", coin, address, deposits)
+                continue
+            for deposit in deposits:
+                await self._consider(deposit)
+
+    async def _consider(self, deposit):
+        if deposit.txid in self._used or deposit.confirmations < self.confirmations.get(deposit.coin, 1):
+            return
+        ticket = self.allocator.lookup(deposit.coin, deposit.address, deposit.units)
+        since = self._since.get(ticket)
+        if ticket is None or deposit.time is not None and since is not None and deposit.time < since:
+            if deposit.txid not in self._reported:
+                self._reported[deposit.txid] = self.clock()
+                self.stats["unmatched" if ticket is None else "early"] += 1
+            return
+        try:
+            await self.handler(ticket, deposit)
+        except Exception:
+            # Left unused, so the next poll offers the deposit again.
+            self.stats["errors"] += 1
+            logger.exception("Handling deposit %s for escrow %s failed", deposit.txid, ticket)
+            return
+        self._used[deposit.txid] = now = self.clock()
+        if self.store is not None:
+            self.store.mark_used(deposit.txid, now)
+        self.stats["matched"] += 1
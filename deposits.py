@@ -0,0 +1,132 @@
+import time
+from collections import deque, namedtuple
+
+from money import COIN_DECIMALS, QUOTE_DECIMALS
+
+# Where and exactly how much one escrow's buyer pays; units are the coin's base unit.
+Target = namedtuple("Target", "coin address units")
+
+
+def dust_step(coin):
+    """Smallest amount a quote can show, in base units: offsets move in these steps."""
+    decimals = COIN_DECIMALS[coin]
+    return 10 ** (decimals - min(QUOTE_DECIMALS, decimals))
+
+
+class DepositAllocator:
+    """Gives every open escrow a payment target no other open escrow shares.
+
+    An escrow first gets an address from the coin's pool, if one is free,
+    and otherwise the coin's shared wallet. At that address it pays the
+    quoted amount or, when another open escrow already expects exactly
+    that, the smallest free amount above it in ``dust_step`` increments.
+    A deposit then identifies its ticket through one dict lookup.
+
+    Pool addresses are pre-derived by the wallet (for instance from an
+    xpub) and handed over as plain lists. Released pool addresses go to
+    the back of the queue, so reuse comes as late as possible. A released
+    target is not handed out again for ``cooldown`` seconds, so a late
+    payment to a cancelled trade cannot confirm the next one. Cooldowns are
+    written to ``store`` and come back through ``restore`` after a restart.
+
+    Sharded workers (see shards.py) each run their own allocator over the
+    same wallets. Shard ``shard`` of ``shards`` takes every ``shards``-th pool
+    address starting at its own index and only offsets congruent to ``shard``
+    modulo ``shards``, so no two workers can hand out the same target.
+    """
+
+    def __init__(self, wallets, pools=None, max_offset=1000, cooldown=7200.0, clock=time.time, shard=0, shards=1,
+                 store=None):
+        self.wallets = wallets  # coin -> shared address
+        self.max_offset = max_offset
+        self.shard = shard
+        self.shards = shards
+        self.cooldown = cooldown
+        self.clock = clock
+        self.store = store  # persists cooldowns, see store.SQLiteStore
+        self._cooling = {}  # Target -> time it may be reused, in release order
+        self._free = {coin: deque(addresses[shard::shards]) for coin, addresses in (pools or {}).items()}
+        self._pooled = {address for addresses in self._free.values() for address in addresses}
+        self._by_target = {}  # Target -> ticket
+        self._by_ticket = {}  # ticket -> Target
+        self._addresses = {}  # (coin, address) -> targets held there
+
+    def __len__(self):
+        return len(self._by_ticket)
+
+    def __contains__(self, ticket):
+        return ticket in self._by_ticket
+
+    def __iter__(self):
+        return iter(self._by_ticket.items())
+
+    def addresses(self):
+        """(coin, address) pairs at least one open escrow pays to."""
+        return list(self._addresses)
+
+    def restore(self, cooling):
+        """Targets still cooling before a restart, as (Target, until) soonest first."""
+        for target, until in cooling:
+            if target not in self._by_target:
+                self._cooling[target] = until
+
+    def lookup(self, coin, address, units):
+        return self._by_target.get(Target(coin, address, units))
+
+    def target(self, ticket):
+        return self._by_ticket.get(ticket)
+
+    def allocate(self, ticket, coin, units):
+        """Reserve a target for ``ticket`` paying at least ``units``; ValueError if none is free."""
+        self.release(ticket)
+        now = self.clock()
+        cooling = self._cooling
+        while cooling:
+            oldest = next(iter(cooling))
+            if cooling[oldest] > now:
+                break
+            del cooling[oldest]
+        free = self._free.get(coin)
+        address = free.popleft() if free else self.wallets.get(coin)
+        step = dust_step(coin)
+        for offset in range(self.shard, self.max_offset * self.shards, self.shards):
+            target = Target(coin, address, units + offset * step)
+            if target not in self._by_target and target not in cooling:
+                self._take(ticket, target)
+                return target
+        if address in self._pooled:
+            free.appendleft(address)
+        raise ValueError(f"no free {coin} deposit target near {units}")
+
+    def claim(self, ticket, target):
+        """Re-reserve a target an escrow already holds, e.g. after a restart. False if another ticket has it."""
+        owner = self._by_target.get(target)
+        if owner is not None:
+            return owner == ticket
+        self.release(ticket)
+        if target.address in self._pooled and target.address in self._free[target.coin]:
+            self._free[target.coin].remove(target.address)
+        self._take(ticket, target)
+        return True
+
+    def release(self, ticket):
+        target = self._by_ticket.pop(ticket, None)
+        if target is None:
+            return
+        del self._by_target[target]
+        self._cooling.pop(target, None)
+        until = self._cooling[target] = self.clock() + self.cooldown
+        if self.store is not None:
+            self.store.mark_cooling(target, until)
+        key = target.coin, target.address
+        self._addresses[key] -= 1
+        if not self._addresses[key]:
+            del self._addresses[key]
+        if target.address in self._pooled:  # pool addresses serve one escrow at a time
+            self._free[target.coin].append(target.address)
+
+    def _take(self, ticket, target):
+        self._by_target[target] = ticket
+        self._by_ticket[ticket] = target
+        key = target.coin, target.address
+        self._addresses[key] = self._addresses.get(key, 0) + 1
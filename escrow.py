@@ -0,0 +1,101 @@
+import json
+from dataclasses import dataclass, field
+from decimal import Decimal
+from enum import StrEnum
+
+from assets import ASSETS
+
+
+class Status(StrEnum):
+    NEW = "new"  # waiting for both parties to join
+    CRYPTO_SELECTION = "crypto_selection"
+    AWAITING_AMOUNT = "awaiting_amount"
+    AWAITING_PAYMENT = "awaiting_payment"
+    AWAITING_ADMIN_CONFIRMATION = "awaiting_admin_confirmation"
+    PAYMENT_CONFIRMED = "payment_confirmed"
+    AWAITING_BUYER_ACTION = "awaiting_buyer_action"
+    AWAITING_SELLER_WALLET = "awaiting_seller_wallet"
+    AWAITING_ADMIN_RELEASE = "awaiting_admin_release"
+    DISPUTED = "disputed"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+
+
+# One member per coin in the asset registry, e.g. Coin.BTC == "BTC".
+Coin = StrEnum("Coin", {symbol: symbol for symbol in ASSETS.coins})
+
+
+def _text(amount):
+    return None if amount is None else str(amount)
+
+
+def _decimal(text):
+    return None if text is None else Decimal(text)
+
+
+@dataclass(slots=True, eq=False)
+class Escrow:
+    """One trade in one group chat.
+
+    Serialized as a flat JSON array (``dumps``/``loads``) for the store and
+    pickled as the same row for IPC. Amounts are exact Decimals and travel
+    as strings.
+    """
+
+    group_id: int
+    ticket: str
+    buyer_id: int | None = None
+    seller_id: int | None = None
+    status: Status = Status.NEW
+    crypto: Coin | None = None
+    fiat_amount: Decimal | None = None
+    crypto_amount: Decimal | None = None
+    wallet_address: str | None = None
+    buyer_confirmed: bool = False
+    seller_confirmed: bool = False
+    goods_sent: bool = False
+    goods_received: bool = False
+    disputed: bool = False
+    keyboards: list[int] = field(default_factory=list)  # group messages whose buttons are still live
+    keyboard_version: int = 0  # carried in callback_data; older buttons are stale
+    status_since: float | None = None  # wall-clock time the current status was entered
+    expiry_step: int = 0  # expiry policy steps already run in the current status
+    quoted_at: float | None = None  # wall-clock time crypto_amount was quoted
+    deposit_address: str | None = None  # where the buyer pays; None for the coin's shared wallet
+    fiat: str = ASSETS.default_fiat.code  # currency fiat_amount is in
+    buyer_username: str | None = None  # as of joining, for when the group can no longer be asked
+    seller_username: str | None = None
+
+    def to_row(self):
+        # The five booleans travel as one bit field.
+        flags = (self.buyer_confirmed | self.seller_confirmed << 1 | self.goods_sent << 2
+                 | self.goods_received << 3 | self.disputed << 4)
+        return (
+            self.group_id, self.ticket, self.buyer_id, self.seller_id, self.status.value,
+            self.crypto.value if self.crypto else None, _text(self.fiat_amount), _text(self.crypto_amount),
+            self.wallet_address, flags, self.keyboards, self.keyboard_version, self.status_since,
+            self.expiry_step, self.quoted_at, self.deposit_address, self.fiat, self.buyer_username,
+            self.seller_username,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        (group_id, ticket, buyer_id, seller_id, status, crypto, fiat_amount, crypto_amount, wallet_address, flags,
+         keyboards, keyboard_version, status_since, expiry_step, quoted_at, deposit_address, fiat, buyer_username,
+         seller_username) = row
+        return cls(
+            group_id, ticket, buyer_id, seller_id, Status(status), Coin(crypto) if crypto else None,
+            _decimal(fiat_amount), _decimal(crypto_amount), wallet_address, bool(flags & 1), bool(flags & 2),
+            bool(flags & 4), bool(flags & 8), bool(flags & 16), list(keyboards), keyboard_version,
+            status_since, expiry_step, quoted_at, deposit_address, fiat, buyer_username, seller_username,
+        )
+
+    def dumps(self):
+        return json.dumps(self.to_row(), separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, data):
+        return cls.from_row(json.loads(data))
+
+    def __reduce__(self):
+        return Escrow.from_row, (self.to_row(),)
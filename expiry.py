@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+from escrow import Status
+
+logger = logging.getLogger(__name__)
+
+Step = namedtuple("Step", "after action")  # seconds since entering the status; "remind", "expire" or "escalate"
+
+# status -> steps in order. "expire" and "escalate" are SYSTEM transitions in states.RULES.
+POLICIES = {
+    Status.AWAITING_AMOUNT: (Step(15 * 60, "remind"), Step(60 * 60, "expire")),
+    Status.AWAITING_PAYMENT: (Step(30 * 60, "remind"), Step(4 * 3600, "remind"), Step(24 * 3600, "expire")),
+    Status.AWAITING_BUYER_ACTION: (Step(30 * 60, "remind"), Step(24 * 3600, "escalate")),
+}
+
+
+def fmt_duration(seconds):
+    if seconds >= 3600 and seconds % 3600 == 0:
+        hours = int(seconds // 3600)
+        return f"{hours} hour" if hours == 1 else f"{hours} hours"
+    minutes = max(1, round(seconds / 60))
+    return f"{minutes} minute" if minutes == 1 else f"{minutes} minutes"
+
+
+class TimerWheel:
+    """Hashed timing wheel: O(1) schedule and cancel, one slot visited per tick.
+
+    A deadline lands in slot ``ceil(deadline / tick) % slots``. Deadlines more
+    than one revolution away share a slot with nearer ones and are passed
+    over until their own turn comes round.
+    """
+
+    def __init__(self, tick=1.0, slots=4096, now=0.0):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]  # key -> deadline
+        self._where = {}  # key -> slot index
+        self._current = int(now // tick)  # last tick advanced past
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline):
+        """(Re)schedule ``key``; a deadline already past fires on the next tick."""
+        slots = self._slots
+        index = self._where.get(key)
+        if index is not None:
+            del slots[index][key]
+        tick = int(-(-deadline // self.tick))  # ceil
+        if tick <= self._current:
+            tick = self._current + 1
+        index = self._where[key] = tick % len(slots)
+        slots[index][key] = deadline
+
+    def cancel(self, key):
+        index = self._where.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline is at or before ``now``."""
+        target = int(now // self.tick)
+        slots = len(self._slots)
+        expired = []
+        # After a stall longer than one revolution every slot is still visited exactly once.
+        for tick in range(max(self._current + 1, target - slots + 1), target + 1):
+            slot = self._slots[tick % slots]
+            if slot:
+                due = [key for key, deadline in slot.items() if deadline <= now]
+                for key in due:
+                    del slot[key]
+                    del self._where[key]
+                expired.extend(due)
+        self._current = max(self._current, target)
+        return expired
+
+
+class ExpiryScheduler:
+    """Runs the per-status policy steps of open escrows when they fall due.
+
+    ``track`` is called whenever an escrow enters a status. Deadlines count
+    from ``escrow.status_since`` (wall clock) and ``escrow.expiry_step``
+    records how many steps of the current policy have run; both are
+    persisted, so tracking the restored escrows after a restart schedules
+    exactly what was still pending. Due tickets are handed to the handler
+    given to ``start`` as separate tasks. The handler must re-check with
+    ``due_step`` under the escrow's lock, since the escrow may have moved on
+    in the meantime. A step whose handler fails is ``retry``-ed after
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, policies=POLICIES, clock=time.time, tick=1.0, slots=4096, retry_after=60.0):
+        self.handler = None  # async (ticket) -> None, see start()
+        self.policies = policies
+        self.clock = clock
+        self.retry_after = retry_after
+        self.wheel = TimerWheel(tick, slots, clock())
+        self.stats = {"fired": 0, "failed": 0}
+        self._worker = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def step(self, escrow):
+        steps = self.policies.get(escrow.status, ())
+        return steps[escrow.expiry_step] if escrow.expiry_step < len(steps) else None
+
+    def track(self, escrow):
+        step = self.step(escrow)
+        if step is None or escrow.status_since is None:
+            self.wheel.cancel(escrow.ticket)
+        else:
+            self.wheel.schedule(escrow.ticket, escrow.status_since + step.after)
+
+    def retry(self, escrow):
+        """Schedule the current step again, ``retry_after`` seconds from now at the earliest."""
+        step = self.step(escrow)
+        if step is None or escrow.status_since is None:
+            self.wheel.cancel(escrow.ticket)
+        else:
+            self.wheel.schedule(escrow.ticket, max(escrow.status_since + step.after, self.clock() + self.retry_after))
+
+    def untrack(self, ticket):
+        self.wheel.cancel(ticket)
+
+    def due_step(self, escrow):
+        """The step to run now, or None (rescheduling) if it is not due any more."""
+        step = self.step(escrow)
+        if step is not None and escrow.status_since is not None and escrow.status_since + step.after <= self.clock():
+            return step
+        self.track(escrow)
+        return None
+
+    def due(self):
+        return self.wheel.advance(self.clock())
+
+    def start(self, handler):
+        self.handler = handler
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        if self._running:
+            await asyncio.wait(self._running, timeout=5.0)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for ticket in self.due():
+                self.stats["fired"] += 1
+                task = asyncio.get_running_loop().create_task(self._fire(ticket))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _fire(self, ticket):
+        try:
+            await self.handler(ticket)
+        except Exception:
+            self.stats["failed"] += 1
+            logger.exception("Expiry handler failed for %s", ticket)
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+
+from telegram.error import BadRequest
+
+from outbox import LOW
+
+logger = logging.getLogger(__name__)
+
+SEP = ":"
+TAGGED = r"^.+:\d+$"  # CallbackQueryHandler pattern for versioned callback_data
+
+
+def tag(data, version):
+    """Append an escrow's keyboard version to callback_data."""
+    return f"{data}{SEP}{version}"
+
+
+def untag(data):
+    """callback_data without its version token; untagged data is returned as is."""
+    action, sep, token = data.rpartition(SEP)
+    return action if sep and token.isdigit() else data
+
+
+def version_of(data):
+    action, sep, token = data.rpartition(SEP)
+    return int(token) if sep and token.isdigit() else None
+
+
+class KeyboardSweeper:
+    """Strips superseded inline keyboards off old messages in the background.
+
+    Stale buttons are already inert: their callback_data carries an old
+    keyboard version and is rejected on arrival. Removing them is cosmetic,
+    so handlers only ``retire`` message ids and move on. Every ``interval``
+    up to ``batch`` pending edits are handed to the outbox as LOW priority
+    items, where they queue behind real notifications and share the chat's
+    rate limit. Repeated ids collapse, and Telegram answering "not modified"
+    or "not found" counts as done.
+    """
+
+    def __init__(self, interval=1.0, batch=50):
+        self.interval = interval
+        self.batch = batch
+        self.outbox = None
+        self.stats = {"retired": 0, "cleared": 0, "gone": 0, "failed": 0, "stale": 0}
+        self._pending = {}  # (chat_id, message_id) -> None, insertion ordered
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def retire(self, chat_id, message_ids):
+        for message_id in message_ids:
+            self._pending[(chat_id, message_id)] = None
+            self.stats["retired"] += 1
+        if self._pending:
+            self._wakeup.set()
+
+    def start(self, outbox):
+        self.outbox = outbox
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        # Hand everything left to the outbox, which gets its own chance to drain on shutdown.
+        while self._pending:
+            self._flush()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Let the retirements of one burst of transitions collect into one batch.
+            await asyncio.sleep(self.interval)
+            self._flush()
+            if not self._pending:
+                self._wakeup.clear()
+
+    def _flush(self):
+        for _ in range(min(self.batch, len(self._pending))):
+            chat_id, message_id = key = next(iter(self._pending))
+            del self._pending[key]
+            self.outbox.edit_markup(chat_id, message_id, priority=LOW).add_done_callback(self._done)
+
+    def _done(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            self.stats["cleared"] += 1
+        elif isinstance(exc, BadRequest) and ("not modified" in exc.message or "not found" in exc.message):
+            self.stats["gone"] += 1
+        else:
+            self.stats["failed"] += 1
+            logger.warning("Could not remove keyboard: %r", exc)
@@ -0,0 +1,197 @@
+import asyncio
+import bisect
+import logging
+import time
+from functools import wraps
+
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Histogram upper bounds in seconds: handler bodies sit below a few ms, Telegram round-trips in 50 ms - 1 s.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; ``observe`` is one bisect and two adds."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (inf past the last bound)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Latency histograms, counters and sampled gauges in Prometheus text format.
+
+    Hot paths pay for a dict lookup and a histogram observe: ``timed`` wraps
+    a coroutine function with its histogram resolved once, ``instrument``
+    does that for every handler of an Application, and InstrumentedRequest
+    times each Bot API call. The ``stats`` dicts the outbox, sweeper,
+    expiry scheduler and others already keep are exported as counters, and
+    gauges such as queue depths are only sampled when scraped. ``start``
+    serves ``render()`` on a local HTTP endpoint.
+    """
+
+    def __init__(self, prefix="k1"):
+        self.prefix = prefix
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> number
+        self._stats = []  # (name, label, dict) exported as counters
+        self._gauges = []  # (name, label, callable -> number or {label value: number})
+        self._server = None
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def stats(self, name, source, label="event"):
+        self._stats.append((name, label, source))
+
+    def gauge(self, name, sample, label=None):
+        self._gauges.append((name, label, sample))
+
+    def timed(self, name, callback, kind="handler"):
+        """Wrap an async callback: latency per call, errors by exception type (re-raised)."""
+        histogram = self.histogram(f"{kind}_seconds", **{kind: name})
+        clock = time.perf_counter
+
+        @wraps(callback)
+        async def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return await callback(*args, **kwargs)
+            except ApplicationHandlerStop:
+                raise  # a gate doing its job, not a failure
+            except Exception as exc:
+                self.inc(f"{kind}_errors_total", **{kind: name, "error": type(exc).__name__})
+                raise
+            finally:
+                histogram.observe(clock() - start)
+
+        return wrapper
+
+    def instrument(self, app):
+        """Time every handler registered on ``app`` so far, labelled by callback name."""
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = self.timed(handler.callback.__name__, handler.callback)
+
+    def render(self):
+        prefix = self.prefix
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = f"{prefix}_{name}"
+            seen = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                seen += count
+                lines.append(f"{metric}_bucket{_labels(labels + (('le', bound),))} {seen}")
+            seen += histogram.counts[-1]
+            lines.append(f"{metric}_bucket{_labels(labels + (('le', '+Inf'),))} {seen}")
+            lines.append(f"{metric}_sum{_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{metric}_count{_labels(labels)} {seen}")
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{prefix}_{name}{_labels(labels)} {value}")
+        for name, label, source in self._stats:
+            for key, value in source.items():
+                lines.append(f"{prefix}_{name}{_labels(((label, key),))} {value}")
+        for name, label, sample in self._gauges:
+            try:
+                value = sample()
+            except Exception:
+                logger.exception("Sampling gauge %s failed", name)
+                continue
+            if isinstance(value, dict):
+                for key, number in value.items():
+                    lines.append(f"{prefix}_{name}{_labels(((label, key),))} {number}")
+            else:
+                lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def start(self, host="127.0.0.1", port=9100):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest timing every Bot API call by method, with failures by exception type or HTTP status."""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+        self._histograms = {}  # API method -> Histogram
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit("/", 1)[-1]
+        histogram = self._histograms.get(endpoint)
+        if histogram is None:
+            histogram = self._histograms[endpoint] = self.metrics.histogram("bot_api_seconds", method=endpoint)
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+        except Exception as exc:
+            self.metrics.inc("bot_api_errors_total", method=endpoint, error=type(exc).__name__)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start)
+        if code >= 400:
+            self.metrics.inc("bot_api_errors_total", method=endpoint, error=str(code))
+        return code, payload
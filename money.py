@@ -0,0 +1,119 @@
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from assets import ASSETS
+
+FIAT_DECIMALS = ASSETS.fiat_decimals  # fiat code -> minor unit places, e.g. 2 for pence
+COIN_DECIMALS = ASSETS.coin_decimals  # coin -> smallest on-chain unit places, e.g. 8 for satoshi
+QUOTE_DECIMALS = 8  # places a buyer is asked to send; never finer than the coin allows
+
+Fees = namedtuple("Fees", "fee payout")
+SettlementRow = namedtuple("SettlementRow", "ticket coin fiat fiat_amount fiat_fee fiat_payout crypto_amount crypto_fee crypto_payout")
+Settlement = namedtuple("Settlement", "rows fiat_totals crypto_totals")
+
+
+def quantum(decimals):
+    return Decimal(1).scaleb(-decimals)
+
+
+def to_minor(amount, decimals):
+    """Decimal amount -> integer minor units; raises ValueError if it is not a whole number of them."""
+    units = Decimal(amount).scaleb(decimals)
+    if units != units.to_integral_value():
+        raise ValueError(f"{amount} has more than {decimals} decimal places")
+    return int(units)
+
+
+def from_minor(units, decimals):
+    return Decimal(units).scaleb(-decimals)
+
+
+def parse_fiat(text, decimals):
+    """Parse a user-typed positive fiat amount exactly; at most ``decimals`` places."""
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"not an amount: {text!r}") from None
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError(f"not an amount: {text!r}")
+    to_minor(amount, decimals)
+    return amount
+
+
+def quote(fiat_amount, price, coin):
+    """Crypto the buyer must send for ``fiat_amount`` at ``price`` (fiat per coin)."""
+    places = min(QUOTE_DECIMALS, COIN_DECIMALS[coin])
+    return (Decimal(fiat_amount) / Decimal(price)).quantize(quantum(places), rounding=ROUND_HALF_UP)
+
+
+def fee_ratio(rate):
+    """Fee rate as an exact integer fraction, e.g. Decimal("0.05") -> (1, 20)."""
+    return Decimal(str(rate)).as_integer_ratio()
+
+
+def _fee_units(units, numerator, denominator):
+    # Round half up to the minor unit; payout is the remainder so fee + payout == amount exactly.
+    return (2 * units * numerator + denominator) // (2 * denominator)
+
+
+def fees(amount, decimals, rate):
+    """Split ``amount`` into fee and payout, both exact at ``decimals`` places."""
+    numerator, denominator = fee_ratio(rate)
+    units = to_minor(amount, decimals)
+    fee = _fee_units(units, numerator, denominator)
+    return Fees(from_minor(fee, decimals), from_minor(units - fee, decimals))
+
+
+def settle(escrows, rate):
+    """Fees and payouts for many escrows at once, with per-currency totals.
+
+    Works on integer minor units throughout: amounts are converted once,
+    every fee is one integer multiply-divide, and totals are plain integer
+    sums, so a day's report adds up to the penny/satoshi.
+    """
+    numerator, denominator = fee_ratio(rate)
+    rows = []
+    fiat_totals = {}  # fiat -> [fee, payout] in minor units
+    crypto_totals = {}  # coin -> [fee, payout] in minor units
+    for escrow in escrows:
+        coin = escrow.crypto
+        coin_q = COIN_DECIMALS[coin]
+        fiat_q = FIAT_DECIMALS[escrow.fiat]
+        fiat = to_minor(escrow.fiat_amount, fiat_q)
+        crypto = to_minor(escrow.crypto_amount, coin_q)
+        fiat_fee = _fee_units(fiat, numerator, denominator)
+        crypto_fee = _fee_units(crypto, numerator, denominator)
+        rows.append(SettlementRow(
+            escrow.ticket, coin, escrow.fiat,
+            escrow.fiat_amount, from_minor(fiat_fee, fiat_q), from_minor(fiat - fiat_fee, fiat_q),
+            escrow.crypto_amount, from_minor(crypto_fee, coin_q), from_minor(crypto - crypto_fee, coin_q),
+        ))
+        totals = fiat_totals.setdefault(escrow.fiat, [0, 0])
+        totals[0] += fiat_fee
+        totals[1] += fiat - fiat_fee
+        totals = crypto_totals.setdefault(coin, [0, 0])
+        totals[0] += crypto_fee
+        totals[1] += crypto - crypto_fee
+    return Settlement(
+        rows,
+        {fiat: Fees(from_minor(fee, FIAT_DECIMALS[fiat]), from_minor(payout, FIAT_DECIMALS[fiat]))
+         for fiat, (fee, payout) in fiat_totals.items()},
+        {coin: Fees(from_minor(fee, COIN_DECIMALS[coin]), from_minor(payout, COIN_DECIMALS[coin]))
+         for coin, (fee, payout) in crypto_totals.items()},
+    )
+
+
+def fmt_fiat(amount, decimals=2):
+    """Whole amounts without decimals, otherwise the currency's places."""
+    amount = Decimal(amount)
+    if amount == amount.to_integral_value():
+        return f"{amount:.0f}"
+    return f"{amount:.{decimals}f}"
+
+
+def fmt_crypto(amount):
+    """Up to eight places, trailing zeros dropped but at least two decimals once fractional."""
+    s = f"{Decimal(amount):.8f}".rstrip("0").rstrip(".")
+    if "." in s and len(s.split(".", 1)[1]) == 1:
+        return f"{s}0"
+    return s
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+async def chain(*coros):
+    """Run sends strictly in order; use inside ``fanout`` where order matters."""
+    result = None
+    for i, coro in enumerate(coros):
+        try:
+            result = await coro
+        except BaseException:
+            for pending in coros[i + 1:]:
+                pending.close()
+            raise
+    return result
+
+
+class Notifier:
+    """Issues the independent sends of one transition concurrently.
+
+    ``fanout(group=..., admin=...)`` starts every send at once and returns
+    their results by label, so a transition costs roughly one Telegram
+    round-trip instead of the sum of them. Sends that must stay ordered are
+    wrapped in ``chain``. A single send needs no fanout; await it directly.
+    Wall time per label goes to the ``send_seconds`` histogram of ``metrics``.
+    """
+
+    def __init__(self, metrics=None, clock=time.perf_counter):
+        self.metrics = metrics
+        self.clock = clock
+
+    async def _timed(self, label, coro):
+        start = self.clock()
+        try:
+            return await coro
+        finally:
+            elapsed = self.clock() - start
+            if self.metrics is not None:
+                self.metrics.histogram("send_seconds", send=label).observe(elapsed)
+            logger.debug("send %s took %.1f ms", label, elapsed * 1e3)
+
+    async def fanout(self, **sends):
+        labels = list(sends)
+        results = await asyncio.gather(
+            *(self._timed(label, sends[label]) for label in labels), return_exceptions=True
+        )
+        failed = None
+        for label, result in zip(labels, results):
+            if isinstance(result, BaseException):
+                logger.error("send %s failed: %r", label, result)
+                failed = failed or result
+        # Every send has finished (or failed) by now, so raising cannot orphan the others.
+        if failed is not None:
+            raise failed
+        return dict(zip(labels, results))
@@ -0,0 +1,283 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0  # payment confirmations, releases, disputes
+NORMAL = 1
+LOW = 2  # "buyer joined" style noise; may be folded into digests
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "clock", "tokens", "updated")
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, tokens=1):
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+    def block_for(self, seconds):
+        """Empty the bucket so nothing is sent for ``seconds`` (Telegram retry_after)."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class _Item:
+    __slots__ = ("chat_id", "text", "kwargs", "priority", "coalesce", "futures", "attempts", "seq")
+
+    def __init__(self, chat_id, text, kwargs, priority, coalesce, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.coalesce = coalesce
+        self.futures = [future]
+        self.attempts = 0
+        self.seq = None  # queue order, kept across retries
+
+
+class Outbox:
+    """Rate-limited outbound message queue with priority lanes.
+
+    Every send takes a token from its chat's bucket and from the global
+    bucket; the per-chat defaults keep burst plus one minute of refill within
+    Telegram's 20 messages/minute group limit. Telegram's ``RetryAfter`` drains the chat bucket for the
+    requested time and the message is retried ahead of everything queued after it, so a burst that
+    failed together goes out again in its original order.
+    When a backlog of coalescable LOW messages builds up for one chat they
+    are sent as a single digest. Reply-markup edits (``edit_markup``) travel
+    through the same lanes and buckets.
+
+    Each lane keeps one queue per chat. The worker sends for the first chat,
+    by priority and then in turn, whose bucket has a token, so a backlog in
+    one chat (typically the admin group) never holds up messages to others.
+    Within a chat, messages of one priority go out in the order queued.
+    """
+
+    def __init__(self, per_chat_rate=17 / 60, per_chat_burst=3, global_rate=30, global_burst=30,
+                 max_inflight=8, max_attempts=5, digest_max=10, clock=time.monotonic):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_attempts = max_attempts
+        self.digest_max = digest_max
+        self.clock = clock
+        self.bot = None
+        self.stats = {"sent": 0, "retried": 0, "coalesced": 0, "failed": 0}
+        self._global = TokenBucket(global_rate, global_burst, clock)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._chat_locks = {}  # chat_id -> asyncio.Lock keeping per-chat order
+        self._lanes = {HIGH: OrderedDict(), NORMAL: OrderedDict(), LOW: OrderedDict()}  # chat_id -> deque of items
+        self._depth = {HIGH: 0, NORMAL: 0, LOW: 0}
+        self._seq = itertools.count()
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._sending = set()
+
+    def __len__(self):
+        return sum(self._depth.values())
+
+    def depth(self):
+        return dict(self._depth)
+
+    def start(self, bot):
+        self.bot = bot
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout=5.0):
+        deadline = self.clock() + timeout
+        while (len(self) or self._sending) and self.clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for lane in self._lanes.values():
+            for queue in lane.values():
+                for item in queue:
+                    for future in item.futures:
+                        future.cancel()
+            lane.clear()
+        self._depth = dict.fromkeys(self._depth, 0)
+
+    def send(self, chat_id, text, priority=NORMAL, coalesce=False, **kwargs):
+        """Queue a message; returns a future for the sent Message.
+
+        Callers that only notify may ignore the future; failures are logged.
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._queue(_Item(chat_id, text, kwargs, priority, coalesce, future))
+        return future
+
+    def edit_markup(self, chat_id, message_id, reply_markup=None, priority=LOW):
+        """Queue a reply-markup edit under the same rate limits as sends.
+
+        Unlike ``send``, failures are left on the returned future for the caller.
+        """
+        future = asyncio.get_running_loop().create_future()
+        kwargs = {"message_id": message_id, "reply_markup": reply_markup}
+        self._queue(_Item(chat_id, None, kwargs, priority, False, future))
+        return future
+
+    def _queue(self, item, first=False):
+        lane = self._lanes[item.priority]
+        queue = lane.get(item.chat_id)
+        if queue is None:
+            queue = lane[item.chat_id] = deque()
+        if first:  # a retry goes back in queue order, and its chat to the head of the lane
+            at = 0
+            while at < len(queue) and queue[at].seq < item.seq:
+                at += 1
+            queue.insert(at, item)
+            lane.move_to_end(item.chat_id, last=False)
+        else:
+            item.seq = next(self._seq)
+            queue.append(item)
+        self._depth[item.priority] += 1
+        self._wakeup.set()
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, self.clock)
+        return bucket
+
+    def _next_ready(self):
+        """(priority, chat_id, 0) for the first chat with a token; else (None, None, shortest wait or None if empty)."""
+        wait = None
+        for priority in (HIGH, NORMAL, LOW):
+            for chat_id in self._lanes[priority]:
+                chat_wait = self._bucket(chat_id).wait_time()
+                if not chat_wait:
+                    return priority, chat_id, 0.0
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, None, wait
+
+    async def _run(self):
+        while True:
+            priority, chat_id, wait = self._next_ready()
+            if wait is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = max(wait, self._global.wait_time())
+            if wait > 0:
+                # Anything queued meanwhile, for a chat with a token or at a higher priority, is picked up next pass.
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            lane = self._lanes[priority]
+            queue = lane[chat_id]
+            item = queue.popleft()
+            self._depth[priority] -= 1
+            if item.coalesce and item.priority == LOW and not item.kwargs:
+                item = self._coalesce(item, queue)
+            if queue:
+                lane.move_to_end(chat_id)  # chats with a backlog take turns
+            else:
+                del lane[chat_id]
+            self._bucket(item.chat_id).take()
+            self._global.take()
+            await self._inflight.acquire()
+            task = asyncio.get_running_loop().create_task(self._deliver(item, self._chat_lock(item.chat_id)))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _chat_lock(self, chat_id):
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        return lock
+
+    def _coalesce(self, item, queue):
+        batch = [item]
+        keep = deque()
+        while queue and len(batch) < self.digest_max:
+            other = queue.popleft()
+            if other.coalesce and not other.kwargs:
+                batch.append(other)
+            else:
+                keep.append(other)
+        queue.extendleft(reversed(keep))
+        self._depth[LOW] -= len(batch) - 1
+        if len(batch) == 1:
+            return item
+        self.stats["coalesced"] += len(batch)
+        digest = _Item(item.chat_id, f"🧾 Digest ({len(batch)} updates)\n\n" + "\n\n".join(i.text for i in batch),
+                       {}, LOW, False, None)
+        digest.seq = item.seq
+        digest.futures = [future for i in batch for future in i.futures]
+        return digest
+
+    async def _deliver(self, item, chat_lock):
+        try:
+            async with chat_lock:
+                item.attempts += 1
+                try:
+                    if item.text is None:
+                        message = await self.bot.edit_message_reply_markup(item.chat_id, **item.kwargs)
+                    else:
+                        message = await self.bot.send_message(item.chat_id, item.text, **item.kwargs)
+                except RetryAfter as exc:
+                    self._retry(item, float(exc.retry_after), exc)
+                    return
+                except BadRequest as exc:
+                    self._fail(item, exc)
+                    return
+                except NetworkError as exc:
+                    self._retry(item, min(2 ** item.attempts, 30), exc)
+                    return
+                except Exception as exc:
+                    self._fail(item, exc)
+                    return
+            self.stats["sent"] += 1
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            self._inflight.release()
+
+    def _retry(self, item, delay, exc):
+        if item.attempts >= self.max_attempts:
+            self._fail(item, exc)
+            return
+        self.stats["retried"] += 1
+        self._bucket(item.chat_id).block_for(delay)
+        self._queue(item, first=True)
+
+    def _fail(self, item, exc):
+        self.stats["failed"] += 1
+        for future in item.futures:
+            if not future.done():
+                future.set_exception(exc)
+
+
+def _consume_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Outbound message failed: %r", future.exception())
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from decimal import Decimal
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+COINGECKO_URL = "https://api.coingecko.com/api/v3/simple/price"
+
+
+class PriceUnavailable(Exception):
+    pass
+
+
+class PriceOracle:
+    """Async CoinGecko price source shared by every chat.
+
+    Prices are cached per (coin, fiat) pair. A fetch asks for every coin in
+    ``price_ids`` in every currency in ``fiats`` in one request, so quotes in
+    any group's currency share it. Inside ``ttl`` the cached value is served
+    as-is; inside ``stale_while_revalidate`` it is served while a refresh runs
+    in the background; on upstream errors anything younger than
+    ``stale_if_error`` is served instead of failing the quote. Concurrent
+    misses share a single in-flight request.
+    """
+
+    def __init__(self, price_ids, fiats, ttl=30.0, stale_while_revalidate=60.0, stale_if_error=600.0,
+                 timeout=5.0, max_connections=10, clock=time.monotonic):
+        self.price_ids = dict(price_ids)  # coin -> CoinGecko id
+        self.fiats = tuple(fiat.lower() for fiat in fiats)
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.clock = clock
+        self._client = None
+        self._params = {"ids": ",".join(self.price_ids.values()), "vs_currencies": ",".join(self.fiats)}
+        self._cache = {}  # (coin, fiat) -> (price, fetched_at)
+        self._inflight = None  # asyncio.Task refreshing every pair
+        self._backoff_until = 0.0
+        self.stats = {"fresh": 0, "stale": 0, "fetched": 0, "failed": 0, "fallback": 0, "unavailable": 0}
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                ),
+                headers={"Accept": "application/json"}
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _fetch(self):
+        if self.clock() < self._backoff_until:
+            raise PriceUnavailable("rate limited by upstream")
+        response = await self._get_client().get(COINGECKO_URL, params=self._params)
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "60")
+            self._backoff_until = self.clock() + (float(retry_after) if retry_after.isdigit() else 60.0)
+            raise PriceUnavailable("rate limited by upstream")
+        response.raise_for_status()
+        # Decimal straight from the JSON text, so quotes carry no binary rounding.
+        data = response.json(parse_float=Decimal)
+        now = self.clock()
+        prices = {}
+        for symbol, coingecko_id in self.price_ids.items():
+            quoted = data.get(coingecko_id, {})
+            for fiat in self.fiats:
+                if quoted.get(fiat) is not None:
+                    prices[symbol, fiat] = price = Decimal(quoted[fiat])
+                    self._cache[symbol, fiat] = (price, now)
+        self.stats["fetched"] += 1
+        return prices
+
+    def _refresh(self):
+        if self._inflight is None:
+            self._inflight = asyncio.get_running_loop().create_task(self._fetch())
+            self._inflight.add_done_callback(self._refresh_done)
+        return self._inflight
+
+    def _refresh_done(self, task):
+        self._inflight = None
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["failed"] += 1
+            logger.warning("Price refresh failed: %r", task.exception())
+
+    async def get_price(self, symbol, fiat):
+        key = (symbol.upper(), fiat.lower())
+        if key[0] not in self.price_ids or key[1] not in self.fiats:
+            return None
+        cached = self._cache.get(key)
+        age = self.clock() - cached[1] if cached else None
+        if cached and age < self.ttl:
+            self.stats["fresh"] += 1
+            return cached[0]
+        if cached and age < self.ttl + self.stale_while_revalidate:
+            self.stats["stale"] += 1
+            self._refresh()
+            return cached[0]
+        try:
+            # Shielded so one caller timing out does not cancel the shared fetch.
+            price = (await asyncio.shield(self._refresh())).get(key)
+            if price is None:
+                raise PriceUnavailable(f"no {key[1]} price for {key[0]}")
+            return price
+        except (httpx.HTTPError, PriceUnavailable, ValueError):
+            if cached and self.clock() - cached[1] < self.stale_if_error:
+                self.stats["fallback"] += 1
+                return cached[0]
+            self.stats["unavailable"] += 1
+            return None
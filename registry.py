@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+from store import MemoryStore
+
+logger = logging.getLogger(__name__)
+
+
+class EscrowRegistry:
+    """Open escrows keyed by group chat, with secondary indexes.
+
+    Every mutation of ``group_id``, ``ticket``, ``buyer_id`` or ``seller_id``
+    must go through the registry so the ticket and party indexes stay in sync.
+    Other field changes are persisted by calling ``save`` once the handler has
+    finished mutating the escrow.
+
+    When the bot runs sharded, ``publish`` attaches a shared ticket -> shard
+    directory that the router uses to deliver admin callbacks, which carry
+    only a ticket, to the process owning the escrow. Writing to it is IPC,
+    so changes are collected and written in batches from a thread, off the
+    event loop.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or MemoryStore()
+        self._by_chat = {}  # chat_id -> escrow
+        self._by_ticket = {}  # ticket -> escrow
+        self._by_buyer = {}  # user_id -> {chat_id}
+        self._by_seller = {}  # user_id -> {chat_id}
+        self._locks = {}  # ticket -> asyncio.Lock serialising that escrow's transitions
+        self._directory = None  # shared ticket -> shard mapping, see publish()
+        self._shard = None
+        self._unpublished = {}  # ticket -> shard, or None once closed, not yet in the directory
+        self._publisher = None
+
+    def __len__(self):
+        return len(self._by_chat)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._by_chat
+
+    def __iter__(self):
+        return iter(self._by_chat.values())
+
+    def get(self, chat_id):
+        return self._by_chat.get(chat_id)
+
+    def by_ticket(self, ticket):
+        return self._by_ticket.get(ticket)
+
+    def by_buyer(self, user_id):
+        return [self._by_chat[c] for c in self._by_buyer.get(user_id, ())]
+
+    def by_seller(self, user_id):
+        return [self._by_chat[c] for c in self._by_seller.get(user_id, ())]
+
+    def add(self, escrow):
+        self.pop(escrow.group_id)
+        self._index(escrow)
+        self.store.mark_dirty(escrow)
+        return escrow
+
+    def _index(self, escrow):
+        self._by_chat[escrow.group_id] = escrow
+        self._by_ticket[escrow.ticket] = escrow
+        self._index_party(self._by_buyer, escrow.buyer_id, escrow.group_id)
+        self._index_party(self._by_seller, escrow.seller_id, escrow.group_id)
+        if self._directory is not None:
+            self._republish(escrow.ticket, self._shard)
+
+    def publish(self, directory, shard):
+        self._directory = directory
+        self._shard = shard
+        directory.update({ticket: shard for ticket in self._by_ticket})
+
+    def _republish(self, ticket, shard):
+        self._unpublished[ticket] = shard
+        if self._publisher is None:
+            self._publisher = asyncio.get_running_loop().create_task(self._write_directory())
+
+    async def _write_directory(self):
+        try:
+            while self._unpublished:
+                changes, self._unpublished = self._unpublished, {}
+                await asyncio.to_thread(_apply, self._directory, changes)
+        except Exception:
+            logger.exception("Updating the ticket directory failed")
+        finally:
+            self._publisher = None
+
+    def lock(self, escrow):
+        lock = self._locks.get(escrow.ticket)
+        if lock is None:
+            lock = self._locks[escrow.ticket] = asyncio.Lock()
+        return lock
+
+    def save(self, escrow):
+        if self._by_chat.get(escrow.group_id) is escrow:
+            self.store.mark_dirty(escrow)
+
+    def restore(self):
+        for escrow in self.store.load_open():
+            self._index(escrow)
+        return len(self._by_chat)
+
+    def pop(self, chat_id, default=None):
+        escrow = self._by_chat.pop(chat_id, None)
+        if escrow is None:
+            return default
+        self._by_ticket.pop(escrow.ticket, None)
+        self._locks.pop(escrow.ticket, None)
+        if self._directory is not None:
+            self._republish(escrow.ticket, None)
+        self._unindex_party(self._by_buyer, escrow.buyer_id, chat_id)
+        self._unindex_party(self._by_seller, escrow.seller_id, chat_id)
+        self.store.mark_closed(escrow)
+        return escrow
+
+    def set_buyer(self, escrow, user_id):
+        self._unindex_party(self._by_buyer, escrow.buyer_id, escrow.group_id)
+        escrow.buyer_id = user_id
+        self._index_party(self._by_buyer, user_id, escrow.group_id)
+        self.save(escrow)
+
+    def set_seller(self, escrow, user_id):
+        self._unindex_party(self._by_seller, escrow.seller_id, escrow.group_id)
+        escrow.seller_id = user_id
+        self._index_party(self._by_seller, user_id, escrow.group_id)
+        self.save(escrow)
+
+    @staticmethod
+    def _index_party(index, user_id, chat_id):
+        if user_id is not None:
+            index.setdefault(user_id, set()).add(chat_id)
+
+    @staticmethod
+    def _unindex_party(index, user_id, chat_id):
+        chats = index.get(user_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del index[user_id]
+
+
+def _apply(directory, changes):
+    added = {ticket: shard for ticket, shard in changes.items() if shard is not None}
+    if added:
+        directory.update(added)
+    for ticket, shard in changes.items():
+        if shard is None:
+            directory.pop(ticket, None)
@@ -0,0 +1,158 @@
+"""Run the bot as SHARDS worker processes behind one update router.
+
+    SHARDS=4 python shards.py
+
+The router receives every update, through polling or the webhook depending
+on BOT_MODE. It forwards each update to one worker: ``chat_id % SHARDS``
+for ordinary updates, and the ticket's owner for admin callbacks and
+/ticket commands, which are looked up in a ticket -> shard directory.
+/stats and /open answer from the admin group's own worker and so cover
+its partition only. Each worker runs the normal handlers from bot.py on
+its own partition of escrows, stored in its own database (escrows.db becomes escrows.shard0.db, escrows.shard1.db, ...).
+Workers watch the same wallets but hand out disjoint deposit targets (see
+deposits.DepositAllocator), so one deposit can only match one worker's escrow.
+A chat always lands on the same worker through one FIFO queue, so updates
+for one escrow are handled in the order they arrived.
+
+Locally the directory is a multiprocessing.Manager dict standing in for a
+shared store such as Redis. Keep SHARDS fixed for a given set of database
+files; changing it moves chats to workers that do not hold their escrows.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from queue import Empty
+
+from telegram import Update
+
+SHARDS = int(os.environ.get("SHARDS", os.cpu_count() or 1))
+TICKET_CALLBACKS = ("payment_received_", "payment_notreceived_", "admin_sent_")
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(update, shards, directory):
+    query = update.callback_query
+    if query is not None and query.data and query.data.startswith(TICKET_CALLBACKS):
+        shard = directory.get(query.data.rsplit("_", 1)[1])
+        if shard is not None:
+            return shard
+    message = update.message
+    words = message.text.split() if message is not None and message.text else ()
+    if len(words) > 1 and words[0].split("@", 1)[0] == "/ticket":
+        shard = directory.get(words[1].upper())
+        if shard is not None:
+            return shard
+    chat = update.effective_chat
+    return (chat.id if chat else 0) % shards
+
+
+def shard_db(path, shard):
+    if not path:
+        return ""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+# ---------------- WORKER ----------------
+def worker_main(shard, shards, queue, directory):
+    os.environ["ESCROW_DB"] = shard_db(os.environ.get("ESCROW_DB", "escrows.db"), shard)
+    os.environ["AUDIT_DIR"] = shard_db(os.environ.get("AUDIT_DIR", "audit"), shard)
+    os.environ["SHARD"] = f"{shard}/{shards}"  # a disjoint share of deposit addresses and dust offsets
+    if int(os.environ.get("METRICS_PORT", 0)):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + shard)  # one endpoint per worker
+    import bot
+    from outbox import Outbox
+
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - shard{shard} - %(name)s - %(levelname)s - %(message)s")
+    # Every worker posts to the admin group, so each gets an equal slice of its rate limit.
+    bot.outbox = Outbox(per_chat_rate=17 / 60 / shards, global_rate=30 / shards)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the router decides when to stop
+    asyncio.run(serve(bot, shard, queue, directory))
+
+
+async def serve(bot, shard, queue, directory):
+    app = bot.build_application()
+    await app.initialize()
+    await app.post_init(app)
+    bot.escrows.publish(directory, shard)
+    await app.start()
+    try:
+        while True:
+            batch = await asyncio.to_thread(_drain, queue)
+            for data in batch:
+                if data is None:
+                    return
+                await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+
+def _drain(queue, limit=256):
+    batch = [queue.get()]
+    while batch[-1] is not None and len(batch) < limit:
+        try:
+            batch.append(queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
+
+# ---------------- ROUTER ----------------
+async def route(bot, queues, directory):
+    # The router only needs the Bot and the Updater; no handlers run here.
+    app = bot.build_application()
+    await app.initialize()
+    if bot.BOT_MODE == "webhook":
+        await app.updater.start_webhook(**bot.webhook_settings())
+    else:
+        await app.updater.start_polling()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, app.update_queue.put_nowait, None)
+    logger.info("Routing updates to %d shards", len(queues))
+    try:
+        while True:
+            update = await app.update_queue.get()
+            if update is None:
+                break
+            if isinstance(update, Update):
+                queues[shard_for(update, len(queues), directory)].put(update.to_dict())
+    finally:
+        await app.updater.stop()
+        await app.shutdown()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - router - %(name)s - %(levelname)s - %(message)s")
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    directory = manager.dict()  # ticket -> shard
+    queues = [ctx.Queue() for _ in range(SHARDS)]
+    workers = [ctx.Process(target=worker_main, args=(shard, SHARDS, queues[shard], directory), name=f"shard{shard}")
+               for shard in range(SHARDS)]
+    for worker in workers:
+        worker.start()
+
+    # The router keeps no escrows; import bot only for its config and Application factory.
+    os.environ["ESCROW_DB"] = ""
+    os.environ["AUDIT_DIR"] = ""
+    import bot
+    try:
+        asyncio.run(route(bot, queues, directory))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join(timeout=15)
+            if worker.is_alive():
+                worker.terminate()
+        manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+from escrow import Status
+
+# Roles a user can act in for a given escrow.
+ANYONE = "anyone"
+BUYER = "buyer"
+SELLER = "seller"
+ADMIN = "admin"
+SYSTEM = "system"
+
+# Escrow statuses, aliased for the transition table below.
+NEW = Status.NEW
+CRYPTO_SELECTION = Status.CRYPTO_SELECTION
+AWAITING_AMOUNT = Status.AWAITING_AMOUNT
+AWAITING_PAYMENT = Status.AWAITING_PAYMENT
+AWAITING_ADMIN_CONFIRMATION = Status.AWAITING_ADMIN_CONFIRMATION
+PAYMENT_CONFIRMED = Status.PAYMENT_CONFIRMED
+AWAITING_BUYER_ACTION = Status.AWAITING_BUYER_ACTION
+AWAITING_SELLER_WALLET = Status.AWAITING_SELLER_WALLET
+AWAITING_ADMIN_RELEASE = Status.AWAITING_ADMIN_RELEASE
+DISPUTED = Status.DISPUTED
+COMPLETED = Status.COMPLETED
+CANCELLED = Status.CANCELLED
+
+# Once the buyer may have paid, either party can freeze the trade.
+DISPUTABLE = (
+    AWAITING_PAYMENT, AWAITING_ADMIN_CONFIRMATION, PAYMENT_CONFIRMED,
+    AWAITING_BUYER_ACTION, AWAITING_SELLER_WALLET, AWAITING_ADMIN_RELEASE,
+)
+
+Transition = namedtuple("Transition", "source action role target guard")
+
+# (source states, action, roles, target, guard)
+RULES = (
+    ((NEW,), "join_buyer", (ANYONE,), NEW, lambda e: not e.buyer_id),
+    ((NEW,), "join_seller", (ANYONE,), NEW, lambda e: not e.seller_id),
+    ((NEW,), "both_joined", (SYSTEM,), CRYPTO_SELECTION, lambda e: e.buyer_id and e.seller_id),
+    ((NEW, CRYPTO_SELECTION, AWAITING_AMOUNT), "cancel_escrow", (ANYONE,), CANCELLED, None),
+    ((CRYPTO_SELECTION,), "select_crypto", (BUYER,), AWAITING_AMOUNT, None),
+    ((AWAITING_AMOUNT,), "set_amount", (BUYER,), AWAITING_PAYMENT, None),
+    ((AWAITING_PAYMENT,), "buyer_paid", (BUYER,), AWAITING_ADMIN_CONFIRMATION, None),
+    ((AWAITING_ADMIN_CONFIRMATION,), "payment_received", (ADMIN,), PAYMENT_CONFIRMED, None),
+    # A matching on-chain deposit, whether or not the buyer pressed "I've Paid" yet.
+    ((AWAITING_PAYMENT, AWAITING_ADMIN_CONFIRMATION), "payment_received", (SYSTEM,), PAYMENT_CONFIRMED, None),
+    ((AWAITING_ADMIN_CONFIRMATION,), "payment_notreceived", (ADMIN,), AWAITING_PAYMENT, None),
+    ((PAYMENT_CONFIRMED,), "seller_sent_goods", (SELLER,), AWAITING_BUYER_ACTION, None),
+    ((AWAITING_BUYER_ACTION,), "buyer_release_funds", (BUYER,), AWAITING_SELLER_WALLET, None),
+    ((AWAITING_SELLER_WALLET, AWAITING_ADMIN_RELEASE), "set_wallet", (SELLER,), AWAITING_ADMIN_RELEASE, None),
+    ((AWAITING_ADMIN_RELEASE,), "admin_sent", (ADMIN,), COMPLETED, None),
+    (DISPUTABLE, "dispute", (BUYER, SELLER), DISPUTED, None),
+    # Abandoned trades, fired by expiry.POLICIES.
+    ((AWAITING_AMOUNT, AWAITING_PAYMENT), "expire", (SYSTEM,), CANCELLED, None),
+    (DISPUTABLE, "escalate", (SYSTEM,), DISPUTED, None),
+)
+
+
+def compile_rules(rules):
+    table = {}
+    for sources, action, roles, target, guard in rules:
+        for source in sources:
+            for role in roles:
+                key = (source, action, role)
+                if key in table:
+                    raise ValueError(f"duplicate transition {key}")
+                table[key] = Transition(source, action, role, target, guard)
+    return table
+
+
+TRANSITIONS = compile_rules(RULES)
+
+
+def roles_of(escrow, user_id, is_admin_chat=False):
+    if is_admin_chat:
+        return (ADMIN,)
+    roles = []
+    if user_id == escrow.buyer_id:
+        roles.append(BUYER)
+    if user_id == escrow.seller_id:
+        roles.append(SELLER)
+    roles.append(ANYONE)
+    return roles
+
+
+def resolve(escrow, action, roles):
+    """Return the Transition allowed for ``action`` right now, or None."""
+    state = escrow.status
+    for role in roles:
+        transition = TRANSITIONS.get((state, action, role))
+        if transition is not None:
+            if transition.guard is None or transition.guard(escrow):
+                return transition
+            return None
+    return None
+
+
+def callback_action(data):
+    """Map raw callback_data to a transition action name."""
+    if data.startswith("crypto_"):
+        return "select_crypto"
+    if data.startswith("payment_received_"):
+        return "payment_received"
+    if data.startswith("payment_notreceived_"):
+        return "payment_notreceived"
+    if data.startswith("admin_sent_"):
+        return "admin_sent"
+    return data
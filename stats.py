@@ -0,0 +1,128 @@
+import time
+from collections import Counter
+
+from escrow import Status
+from money import COIN_DECIMALS, FIAT_DECIMALS, fees
+
+CLOSED = frozenset({Status.COMPLETED, Status.CANCELLED})
+
+
+def day_of(timestamp):
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+class DayTotals:
+    """What closed (and what went into dispute) on one UTC day."""
+
+    __slots__ = ("completed", "cancelled", "disputed", "volume", "fees", "crypto_volume", "crypto_fees")
+
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.disputed = 0
+        self.volume = Counter()  # fiat -> fiat settled
+        self.fees = Counter()  # fiat -> fiat fees taken
+        self.crypto_volume = Counter()  # coin -> crypto settled
+        self.crypto_fees = Counter()  # coin -> crypto fees taken
+
+    def add(self, other):
+        self.completed += other.completed
+        self.cancelled += other.cancelled
+        self.disputed += other.disputed
+        self.volume.update(other.volume)
+        self.fees.update(other.fees)
+        self.crypto_volume.update(other.crypto_volume)
+        self.crypto_fees.update(other.crypto_fees)
+        return self
+
+
+class TradeStats:
+    """Running aggregates over all escrows, kept current transition by transition.
+
+    ``track`` is called whenever an escrow changes status, like
+    ExpiryScheduler.track. It remembers what each open escrow last
+    contributed (status, coin, fiat, amount) and swaps that for the new
+    contribution, so the open counts by status and coin and the open volume
+    per fiat currency stay exact without scanning the registry. An escrow reaching
+    COMPLETED or CANCELLED leaves the open figures and is added to the
+    totals of the UTC day it closed on. ``record`` adds an escrow that
+    closed before a restart. Every query reads counters only.
+    """
+
+    def __init__(self, fee_rate, clock=time.time, keep_days=7):
+        self.fee_rate = fee_rate
+        self.clock = clock
+        self.keep_days = keep_days
+        self.by_status = Counter()  # open escrows per status
+        self.by_coin = Counter()  # open escrows per coin, once chosen
+        self.open_volume = Counter()  # fiat -> amount of open escrows, once quoted
+        self.days = {}  # "YYYY-MM-DD" -> DayTotals
+        self._open = {}  # ticket -> (status, coin, fiat, fiat_amount) last counted
+
+    def __len__(self):
+        return len(self._open)
+
+    def track(self, escrow):
+        previous = self._open.pop(escrow.ticket, None)
+        if previous is not None:
+            self._count(*previous, -1)
+        status = escrow.status
+        if status in CLOSED:
+            if previous is not None:  # a closed escrow is tracked once, from open
+                self.record(escrow)
+            return
+        if status is Status.DISPUTED and (previous is None or previous[0] is not Status.DISPUTED):
+            # Restored disputes count too, on the day they were opened.
+            self.day(escrow.status_since).disputed += 1
+        current = (status, escrow.crypto, escrow.fiat, escrow.fiat_amount)
+        self._open[escrow.ticket] = current
+        self._count(*current, 1)
+
+    def record(self, escrow):
+        if escrow.status not in CLOSED:
+            return
+        totals = self.day(escrow.status_since)
+        if escrow.status is Status.CANCELLED:
+            totals.cancelled += 1
+            return
+        totals.completed += 1
+        if escrow.fiat_amount is not None:
+            totals.volume[escrow.fiat] += escrow.fiat_amount
+            totals.fees[escrow.fiat] += fees(escrow.fiat_amount, FIAT_DECIMALS[escrow.fiat], self.fee_rate).fee
+        if escrow.crypto_amount is not None:
+            totals.crypto_volume[escrow.crypto] += escrow.crypto_amount
+            totals.crypto_fees[escrow.crypto] += fees(escrow.crypto_amount, COIN_DECIMALS[escrow.crypto],
+                                                      self.fee_rate).fee
+
+    def _count(self, status, coin, fiat, amount, sign):
+        self.by_status[status] += sign
+        if coin is not None:
+            self.by_coin[coin] += sign
+        if amount is not None:
+            self.open_volume[fiat] += sign * amount
+
+    def day(self, at=None):
+        key = day_of(self.clock() if at is None else at)
+        totals = self.days.get(key)
+        if totals is None:
+            totals = self.days[key] = DayTotals()
+            if len(self.days) > self.keep_days:
+                del self.days[min(self.days)]
+        return totals
+
+    def today(self):
+        return self.day()
+
+    def recent(self, days):
+        """Totals over the last ``days`` UTC days, today included (at most keep_days)."""
+        now = self.clock()
+        keys = {day_of(now - 86400 * i) for i in range(days)}
+        totals = DayTotals()
+        for key in keys & self.days.keys():
+            totals.add(self.days[key])
+        return totals
+
+    def since(self, days):
+        """Start of the UTC day ``days - 1`` days ago, for seeding ``record`` from storage."""
+        now = self.clock()
+        return now - now % 86400 - 86400 * (days - 1)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+from deposits import Target
+from escrow import Escrow
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """Store that persists nothing; escrows live only in the registry."""
+
+    def mark_dirty(self, escrow):
+        pass
+
+    def mark_closed(self, escrow):
+        pass
+
+    def load_open(self):
+        return []
+
+    def load_closed(self, since):
+        return []
+
+    def mark_cooling(self, target, until):
+        pass
+
+    def mark_used(self, txid, at):
+        pass
+
+    def load_cooling(self, now):
+        return []
+
+    def load_used(self, since):
+        return []
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteStore:
+    """Escrow rows in an embedded SQLite database (WAL mode).
+
+    Writes are group-committed: ``mark_dirty``/``mark_closed`` only record the
+    escrow, and a flush shortly afterwards (or once ``batch_size`` escrows are
+    pending) serialises every pending escrow and commits them in a single
+    transaction off the event loop. Repeated updates to one escrow inside a
+    flush window collapse into one row write. Deposit targets cooling down
+    after release and transaction ids already matched to a payment ride
+    along in the same commits, so a restart keeps both.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS escrows ("
+        " ticket TEXT PRIMARY KEY,"
+        " chat_id INTEGER NOT NULL,"
+        " status TEXT,"
+        " is_open INTEGER NOT NULL,"
+        " updated_at REAL NOT NULL,"
+        " data TEXT NOT NULL)",
+        # Partial index: recovery reads only open rows, however much history piles up.
+        "CREATE INDEX IF NOT EXISTS escrows_open ON escrows (chat_id) WHERE is_open = 1",
+        # Restarts re-read only the last few days of closed trades for the admin stats.
+        "CREATE INDEX IF NOT EXISTS escrows_closed ON escrows (updated_at) WHERE is_open = 0",
+        # units as text: wei amounts overflow SQLite integers.
+        "CREATE TABLE IF NOT EXISTS deposit_cooldowns ("
+        " coin TEXT NOT NULL, address TEXT NOT NULL, units TEXT NOT NULL, until REAL NOT NULL,"
+        " PRIMARY KEY (coin, address, units))",
+        "CREATE TABLE IF NOT EXISTS used_txids (txid TEXT PRIMARY KEY, at REAL NOT NULL)",
+    )
+
+    def __init__(self, path, batch_size=256, flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.commits = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._pending = {}  # ticket -> (escrow, is_open)
+        self._cooling = {}  # Target -> reusable after, not yet written
+        self._used = {}  # txid -> matched at, not yet written
+        self._flush_lock = asyncio.Lock()
+        self._timer = None
+
+    def mark_dirty(self, escrow):
+        self._pending[escrow.ticket] = (escrow, True)
+        self._schedule()
+
+    def mark_closed(self, escrow):
+        self._pending[escrow.ticket] = (escrow, False)
+        self._schedule()
+
+    def mark_cooling(self, target, until):
+        if target.address:  # targets without an address are never watched
+            self._cooling[target] = until
+            self._schedule()
+
+    def mark_used(self, txid, at):
+        self._used[txid] = at
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no loop (startup / scripts): the next flush() picks it up
+        if len(self._pending) + len(self._cooling) + len(self._used) >= self.batch_size:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not (self._pending or self._cooling or self._used):
+                return
+            pending, self._pending = self._pending, {}
+            cooling, self._cooling = self._cooling, {}
+            used, self._used = self._used, {}
+            now = time.time()
+            # Snapshot on the loop thread so handlers can keep mutating escrows.
+            rows = [
+                (ticket, escrow.group_id, escrow.status.value, int(is_open), now, escrow.dumps())
+                for ticket, (escrow, is_open) in pending.items()
+            ]
+            holds = [(target.coin, target.address, str(target.units), until) for target, until in cooling.items()]
+            try:
+                await asyncio.to_thread(self._write, rows, holds, list(used.items()))
+            except sqlite3.Error:
+                logger.exception("Persisting %d escrows failed; will retry", len(rows))
+                for ticket, entry in pending.items():
+                    self._pending.setdefault(ticket, entry)
+                for target, until in cooling.items():
+                    self._cooling.setdefault(target, until)
+                for txid, at in used.items():
+                    self._used.setdefault(txid, at)
+                self._schedule()
+
+    def _write(self, rows, holds=(), used=()):
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO escrows (ticket, chat_id, status, is_open, updated_at, data)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(ticket) DO UPDATE SET chat_id = excluded.chat_id, status = excluded.status,"
+                " is_open = excluded.is_open, updated_at = excluded.updated_at, data = excluded.data",
+                rows
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deposit_cooldowns (coin, address, units, until) VALUES (?, ?, ?, ?)", holds
+            )
+            self._conn.executemany("INSERT OR REPLACE INTO used_txids (txid, at) VALUES (?, ?)", used)
+        self.commits += 1
+
+    def load_open(self):
+        cursor = self._conn.execute("SELECT data FROM escrows INDEXED BY escrows_open WHERE is_open = 1")
+        return [Escrow.loads(data) for (data,) in cursor]
+
+    def load_closed(self, since):
+        cursor = self._conn.execute(
+            "SELECT data FROM escrows INDEXED BY escrows_closed WHERE is_open = 0 AND updated_at >= ?", (since,)
+        )
+        return [Escrow.loads(data) for (data,) in cursor]
+
+    def load_cooling(self, now):
+        """(Target, until) for targets still cooling at ``now``, soonest free first; drops the rest."""
+        self._conn.execute("DELETE FROM deposit_cooldowns WHERE until <= ?", (now,))
+        cursor = self._conn.execute("SELECT coin, address, units, until FROM deposit_cooldowns ORDER BY until")
+        return [(Target(coin, address, int(units)), until) for coin, address, units, until in cursor]
+
+    def load_used(self, since):
+        """(txid, matched at) for txids matched since ``since``, oldest first; drops the rest."""
+        self._conn.execute("DELETE FROM used_txids WHERE at < ?", (since,))
+        return list(self._conn.execute("SELECT txid, at FROM used_txids ORDER BY at"))
+
+    async def close(self):
+        await self.flush()
+        self._conn.close()
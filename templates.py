@@ -0,0 +1,347 @@
+from operator import itemgetter
+from string import Formatter
+
+MARKDOWN = "Markdown"
+
+
+def escape_markdown(text):
+    # Legacy Markdown: these start an entity outside code spans and are escaped with a backslash.
+    return str(text).replace("\\", "\\\\").replace("_", "\\_").replace("*", "\\*").replace("`", "\\`").replace("[", "\\[")
+
+
+def escape_code(text):
+    # Inside a code span nothing can be escaped; a backtick would end the span early.
+    return str(text).replace("`", "'")
+
+
+ESCAPERS = {"md": escape_markdown, "code": escape_code}
+
+
+class Template:
+    """A message body compiled once into a %-format string and a field getter.
+
+    ``constants`` are substituted at compile time. Each remaining ``{field}``
+    gets its escaping chosen up front: none for messages without a parse
+    mode or for ``trusted`` fields the bot formats itself, Markdown escaping
+    otherwise, and code escaping for fields inside backticks. Escaped values are looked up under ``field__md`` /
+    ``field__code`` so a Message escapes each value once for all variants.
+    """
+
+    __slots__ = ("source", "parse_mode", "keys", "_format", "_getter")
+
+    def __init__(self, source, parse_mode=None, constants=None, trusted=()):
+        constants = constants or {}
+        self.source = source
+        self.parse_mode = parse_mode
+        self.keys = {}  # key -> (field, escaper name or None)
+        chunks = []
+        order = []
+        in_code = False
+        for literal, field, spec, conversion in Formatter().parse(source):
+            chunks.append(literal.replace("%", "%%"))
+            if parse_mode == MARKDOWN:
+                in_code ^= literal.count("`") % 2 == 1
+            if field is None:
+                continue
+            if spec or conversion or not field.isidentifier():
+                raise ValueError(f"only plain {{field}} placeholders are supported: {field!r} in {source!r}")
+            if field in constants:
+                chunks.append(str(constants[field]).replace("%", "%%"))
+                continue
+            if parse_mode != MARKDOWN or field in trusted:
+                escaper = None
+            else:
+                escaper = "code" if in_code else "md"
+            key = field if escaper is None else f"{field}__{escaper}"
+            self.keys[key] = (field, escaper)
+            order.append(key)
+            chunks.append("%s")
+        self._format = "".join(chunks)
+        if len(order) > 1:
+            self._getter = itemgetter(*order)
+        else:
+            # itemgetter returns a bare value, not a tuple, for a single key.
+            self._getter = lambda env: tuple(env[key] for key in order)
+
+    def render(self, values):
+        return self.format(environment(values, self.keys))
+
+    def format(self, env):
+        return self._format % self._getter(env)
+
+
+def environment(values, keys):
+    """Map every key a template needs to its (escaped) value."""
+    return {
+        key: values[field] if escaper is None else ESCAPERS[escaper](values[field])
+        for key, (field, escaper) in keys.items()
+    }
+
+
+class Message:
+    """The group and admin variants of one notification, rendered from the same values."""
+
+    __slots__ = ("name", "variants", "keys")
+
+    def __init__(self, name, variants, constants=None, trusted=()):
+        self.name = name
+        self.variants = {
+            variant: Template(source, parse_mode, constants, trusted)
+            for variant, (parse_mode, source) in variants.items()
+        }
+        self.keys = {}
+        for template in self.variants.values():
+            self.keys.update(template.keys)
+
+    def render(self, values):
+        """Return send_message keyword arguments (text, parse_mode) per variant."""
+        env = environment(values, self.keys)
+        rendered = {}
+        for variant, template in self.variants.items():
+            if template.parse_mode:
+                rendered[variant] = {"text": template.format(env), "parse_mode": template.parse_mode}
+            else:
+                rendered[variant] = {"text": template.format(env)}
+        return rendered
+
+
+def compile_messages(catalogue, trusted=None, **constants):
+    trusted = TRUSTED if trusted is None else trusted
+    return {name: Message(name, variants, constants, trusted) for name, variants in catalogue.items()}
+
+
+# ---------------- CATALOGUE ----------------
+# Fields the bot generates itself (tickets, formatted numbers, registry symbols and codes); never escaped.
+TRUSTED = frozenset({"ticket", "coin", "fiat", "fiat_label", "amount", "crypto_amount", "fee", "payout", "payout_crypto"})
+
+# name -> variant -> (parse_mode, source). {fee_percent} is a compile-time constant; {fiat} and {fiat_label} are
+# the escrow's currency symbol and code.
+MESSAGES = {
+    "joined": {
+        "group": (None, "🤝 Status: New Trade\n📄 Action: @{username} joined as {label}\n🎟️ Ticket: {ticket}"),
+        "admin": (None, "🤝 Status: {role} Joined\n🎟️ Ticket: {ticket}\n👤 {role}: @{username}"),
+    },
+    "both_joined": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Both Parties Joined ✅\n"
+            "👤 Buyer: @{buyer}\n"
+            "👤 Seller: @{seller}\n"
+            "📄 Action: Buyer select payment method 👇",
+        ),
+    },
+    "cancelled": {
+        "group": (None, "Escrow cancelled. Use /escrow to start again."),
+        "admin": (None, "❌ Escrow {ticket} was cancelled."),
+    },
+    "crypto_selected": {
+        "group": (MARKDOWN, "📄 Action: You selected {coin} 🪙\n✍️ Response: Type the amount in {fiat_label} using: `/amount 100`"),
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Amount 💷\n"
+            "🪙 Crypto: {coin}\n👤 Buyer: @{username}\n📄 Action: Buyer selected payment method",
+        ),
+    },
+    "amount_set": {
+        "group": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Payment ⏳\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 {crypto_amount} {coin}\n\n"
+            "📄 Send exact amount to wallet:\n\n`{deposit_wallet}`\n\n"
+            "👇Mark as paid once done",
+        ),
+    },
+    "buyer_paid": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Payment ⏳\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "📄 Response: Please wait whilst we confirm this transaction...",
+        ),
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Payment ⏳\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "👤 Buyer: @{buyer}\n"
+            "👤 Seller: @{seller}\n"
+            "📄 Action: Payment awaiting admin confirmation",
+        ),
+    },
+    "payment_received": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Payment Confirmed ✅\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "📄 Action: Seller can now send goods/services to buyer\n"
+            "👇 Response: Confirm below when done",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Payment Confirmed ✅\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n📄 Action: Payment confirmed by admin",
+        ),
+    },
+    "payment_detected": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Payment Confirmed ✅\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "📄 Action: Seller can now send goods/services to buyer\n"
+            "👇 Response: Confirm below when done",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Payment Confirmed ✅\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Payment detected on-chain ({confirmations} confirmations)\n🔗 Tx: `{txid}`",
+        ),
+    },
+    "payment_notreceived": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Payment ❌\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n"
+            "📄 Response: Payment has not yet been received. You will receive a message once it has confirmed on our system.",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Payment ❌\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n📄 Action: Payment not received",
+        ),
+    },
+    "goods_sent": {
+        "group": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Seller marked goods as sent 📦\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Buyer confirm and press **Release Funds**\nNOTE Only open dispute if:\n - You can not resolve it between you!\n- No response from buyer within 30 minutes.\n- You believe you are getting scammed. ",
+        ),
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Goods Sent 📦\n"
+            "👤 Seller: @{seller}\n👤 Buyer: @{buyer}\n📄 Action: Seller marked goods as sent",
+        ),
+    },
+    "awaiting_wallet": {
+        "group": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Seller Wallet ⏳\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "📄 Action: Buyer confirmed goods were received.\n💬 Response: Seller type /wallet and then paste your {coin} wallet address\n (E.G /wallet 0x1284k18493btc)",
+        ),
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Seller Wallet ⏳\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Buyer confirmed goods received. Waiting for sellers wallet.",
+        ),
+    },
+    "release_requested": {
+        "group": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Processing Payment...⏳\n\n"
+            "💷 Trade Amount: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "💸 Escrow Fee ({fee_percent}%): {fiat}{fee} ({fiat_label})\n"
+            "🏦 Amount Being Released: {fiat}{payout} ({fiat_label})\n\n"
+            "📄 Response: Funds are being sent to seller, you will receive an update in this chat when payment has been sent.",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Awaiting Admin Release ⏳\n\n"
+            "💷 Trade Amount: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "💸 Escrow Fee ({fee_percent}%): {fiat}{fee} ({fiat_label})\n"
+            "🏦 Send To Seller: {fiat}{payout} ({fiat_label})\n\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "👛 Seller Wallet: `{wallet}`\n\n📄 Response: Please confirm funds release",
+        ),
+    },
+    "completed": {
+        "group": (
+            MARKDOWN,
+            "🎉 Trade Completed!\n\n"
+            "🎟️ Ticket: {ticket}\n"
+            "💷 Amount Released: {fiat}{payout} ({fiat_label})\n"
+            "🪙 Crypto Amount: ({payout_crypto} {coin})\n"
+            "💸 Escrow Fee Taken: {fiat}{fee} ({fiat_label})\n\n"
+            "📄 Response: Funds have successfully been sent to seller.\n\n"
+            "🫡 Thank you for using K1 Escrow Bot, see you soon! \n\nYou can now close this group.",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Trade Completed ✅\n\n"
+            "💷 Amount Sent: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "💸 Escrow Fee ({fee_percent}%): {fiat}{fee} ({fiat_label})\n"
+            "🏦 Amount After Fee: {fiat}{payout} ({fiat_label})\n\n"
+            "📄 Action: Funds have been released to sellers wallet.",
+        ),
+    },
+    "disputed": {
+        "group": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Trade disputed by @{username}. Escrow is now paused. Please wait for admin to review.",
+        ),
+        "admin": (
+            MARKDOWN,
+            "🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Dispute opened by @{username}. "
+            "Bot cannot generate an invite link. Please ask a participant to provide a manual invite link or add you to the group to review.",
+        ),
+    },
+    # Sent by the expiry scheduler; {idle} is how long the trade has waited, {waiting} what it waits for.
+    "reminder": {
+        "group": (None, "⏰ Reminder\n🎟️ Ticket: {ticket}\n📄 Action: {waiting}"),
+    },
+    "expired": {
+        "group": (None, "⌛ Escrow {ticket} was cancelled after {idle} without activity. Use /escrow to start again."),
+        "admin": (
+            None,
+            "⌛ Escrow {ticket} expired after {idle} without activity and was cancelled.\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}",
+        ),
+    },
+    "escalated": {
+        "group": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
+            "📄 Action: No activity for {idle}. Escrow is now paused. Please wait for admin to review.",
+        ),
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: Trade Disputed ⚠️\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label}) ({crypto_amount} {coin})\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "📄 Action: Escalated automatically after {idle} without activity. Please review.",
+        ),
+    },
+    # Admin commands; list fields arrive as ready-made lines.
+    "stats": {
+        "admin": (
+            None,
+            "📊 Today (UTC)\n✅ Completed: {completed}\n💷 Volume: {volume}\n"
+            "💰 Fees: {fees} | {crypto_fees}\n❌ Cancelled: {cancelled}\n⚠️ Disputes: {disputed}\n\n"
+            "📅 Last 7 days: {week_completed} completed, {week_volume} volume, {week_fees} fees\n"
+            "📂 Open: {open} trades, {open_volume} quoted",
+        ),
+    },
+    "open_trades": {
+        "admin": (None, "📂 Open trades: {open}\n\n📌 By status:\n{by_status}\n\n🪙 By coin:\n{by_coin}"),
+    },
+    "ticket_info": {
+        "admin": (
+            None,
+            "🎟️ Ticket: {ticket}\n📌 Status: {status} (for {since})\n"
+            "👤 Buyer: @{buyer}\n👤 Seller: @{seller}\n"
+            "💷 Amount: {fiat}{amount} ({fiat_label})\n🪙 Crypto: {crypto_amount} {coin}\n"
+            "📥 Deposit: {deposit}\n📤 Seller wallet: {wallet}\n\n🧾 History (UTC):\n{history}",
+        ),
+    },
+}
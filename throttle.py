@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+from outbox import TokenBucket
+
+
+class Throttle:
+    """Flood limits applied to incoming updates before any handler runs.
+
+    Each user and each chat gets a token bucket (``*_rate`` updates per
+    second, bursts of ``*_burst``). A callback identical to one the same
+    user pressed on the same message within ``dedupe_window`` seconds is a
+    duplicate. ``check`` returns why an update should be dropped, or None,
+    using dict lookups and clock reads only. Buckets are kept for the
+    ``max_tracked`` most recently seen users and chats; an evicted bucket has
+    normally refilled anyway. Updates from ``exempt_chats`` always pass.
+    """
+
+    def __init__(self, user_rate=1.0, user_burst=8, chat_rate=3.0, chat_burst=20, dedupe_window=1.0,
+                 exempt_chats=(), max_tracked=50_000, clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.dedupe_window = dedupe_window
+        self.exempt_chats = frozenset(exempt_chats)
+        self.max_tracked = max_tracked
+        self.clock = clock
+        self.stats = {"passed": 0, "user_limited": 0, "chat_limited": 0, "duplicate": 0}
+        self._users = OrderedDict()  # user_id -> TokenBucket, least recently seen first
+        self._chats = OrderedDict()  # chat_id -> TokenBucket, least recently seen first
+        self._recent = OrderedDict()  # (user_id, message_id, data) -> pressed at, oldest first
+
+    def __len__(self):
+        return len(self._users) + len(self._chats)
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, self.clock)
+            if len(buckets) > self.max_tracked:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def _duplicate(self, user_id, query):
+        now = self.clock()
+        recent = self._recent
+        while recent:
+            key, pressed = next(iter(recent.items()))
+            if now - pressed < self.dedupe_window:
+                break
+            del recent[key]
+        key = (user_id, query.message.message_id if query.message else query.inline_message_id, query.data)
+        if key in recent:
+            return True
+        recent[key] = now
+        return False
+
+    def check(self, update):
+        chat = update.effective_chat
+        if chat is not None and chat.id in self.exempt_chats:
+            return None
+        user = update.effective_user
+        query = update.callback_query
+        if query is not None and user is not None and self.dedupe_window and self._duplicate(user.id, query):
+            reason = "duplicate"
+        else:
+            # Both buckets must have a token before either is charged.
+            users = self._bucket(self._users, user.id, self.user_rate, self.user_burst) if user else None
+            chats = self._bucket(self._chats, chat.id, self.chat_rate, self.chat_burst) if chat else None
+            if users is not None and users.wait_time():
+                reason = "user_limited"
+            elif chats is not None and chats.wait_time():
+                reason = "chat_limited"
+            else:
+                if users is not None:
+                    users.take()
+                if chats is not None:
+                    chats.take()
+                self.stats["passed"] += 1
+                return None
+        self.stats[reason] += 1
+        return reason
@@ -0,0 +1,52 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class UsernameCache:
+    """Bounded LRU/TTL cache of ``@username`` keyed by (chat_id, user_id).
+
+    Entries are normally seeded from ``from_user`` when a party joins, so
+    rendering a trade message does not need a ``get_chat_member`` call.
+    Misses fall back to the API, concurrently when several are needed.
+    """
+
+    def __init__(self, maxsize=10_000, ttl=6 * 3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # (chat_id, user_id) -> (username, stored_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def remember(self, chat_id, user):
+        self._store((chat_id, user.id), user.username)
+
+    def _store(self, key, username):
+        self._entries[key] = (username, self.clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def peek(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        if self.clock() - entry[1] >= self.ttl:
+            del self._entries[key]
+            return None, False
+        self._entries.move_to_end(key)
+        return entry[0], True
+
+    async def get(self, bot, chat_id, user_id):
+        username, hit = self.peek(chat_id, user_id)
+        if hit:
+            return username
+        member = await bot.get_chat_member(chat_id, user_id)
+        self._store((chat_id, user_id), member.user.username)
+        return member.user.username
+
+    async def get_many(self, bot, chat_id, user_ids):
+        return await asyncio.gather(*(self.get(bot, chat_id, user_id) for user_id in user_ids))